@@ -0,0 +1,447 @@
+"""
+Adaptive air speed and transmit power.
+
+The basestation receives all nodes with one radio, so the air speed is a setting of the whole network while
+the transmit power is chosen per node. RateController runs on the basestation. From the RSSI and the losses
+(gaps in the fragment message ids, see fragment.py) of every node's link it picks
+
+- the fastest AirSpeed at which every link keeps margin_db above the receiver sensitivity at full power
+  and no link falls below target_pdr, going faster one step at a time,
+- for every node the lowest TransmitPower that keeps margin_db at that air speed.
+
+The settings are broadcast in RateMessages every announce_interval seconds. Air speed changes are announced
+lead seconds in advance, so basestation and nodes (RateFollower) switch at the same time with
+LoRaHatDriver.reconfigure. A node that has not heard the basestation for fallback_timeout seconds, e.g.
+because it missed a switch, returns to the configured air speed. So does the basestation if a node that was
+active before a switch is not heard for fallback_timeout seconds after it, and it does not try that air
+speed again for a while. Both sides then meet at the configured air speed.
+
+    controller = RateController(lora_hat.config)    # basestation
+    while True:
+        timeout = controller.poll(lora_hat)
+        for message, packet in lora_hat.receive_messages(timeout, metadata=True):
+            controller.observe(message, packet)
+
+    follower = RateFollower(150, lora_hat.config)   # node, between its transmissions
+    follower.receive(lora_hat)
+    follower.poll(lora_hat)
+
+Without enable_RSSI_byte the controller only slows down on losses.
+"""
+
+import logging
+import math
+import struct
+import time
+from collections import deque
+from typing import Optional
+
+from driver import AIR_SPEED_MODULATION, AirSpeed, TransmitPower
+from fragment import MESSAGE_ID_MASK
+from message import DeserializeError, Message, Topic, register_topic
+
+# SNR needed to demodulate per spreading factor, from the SX126x datasheet
+SNR_LIMIT_DB = {5: -2.5, 6: -5.0, 7: -7.5, 8: -10.0, 9: -12.5, 10: -15.0, 11: -17.5, 12: -20.0}
+NOISE_FIGURE_DB = 6.0
+TRANSMIT_POWER_DBM = {
+    TransmitPower.TP_22dBm: 22,
+    TransmitPower.TP_17dBm: 17,
+    TransmitPower.TP_12dBm: 12,
+    TransmitPower.TP_10dBm: 10,
+}
+# slowest first
+AIR_SPEEDS = sorted(AirSpeed, key=lambda a: a.value)
+# weakest first
+TRANSMIT_POWERS = sorted(TransmitPower, key=TRANSMIT_POWER_DBM.get)
+BROADCAST_ADDRESS = 0xFFFF
+
+
+def sensitivity(air_speed: AirSpeed) -> float:
+    """Estimated receiver sensitivity in dBm, see AIR_SPEED_MODULATION."""
+    spreading_factor, bandwidth = AIR_SPEED_MODULATION[air_speed]
+    return -174 + 10 * math.log10(bandwidth) + NOISE_FIGURE_DB + SNR_LIMIT_DB[spreading_factor]
+
+
+class RateMessage(Message):
+    """
+    Settings broadcast by the basestation.
+
+    Content is a dict with
+    - air_speed: AirSpeed of the network, or the one to switch to
+    - switch_in: seconds until the switch to air_speed, None if it is the current one
+    - transmit_power: dict node address -> TransmitPower
+    """
+
+    topic = Topic.RATE
+    _header = struct.Struct(">Bf")
+    _entry = struct.Struct(">HB")
+
+    def __init__(self, content, sender: int, topic: Topic = Topic.RATE):
+        super().__init__(content, sender, topic)
+
+    @classmethod
+    def _check_content(cls, content):
+        if not isinstance(content.get("air_speed"), AirSpeed):
+            raise TypeError(f"{cls.__name__} expects an AirSpeed as air_speed.")
+        if any(not isinstance(p, TransmitPower) for p in content["transmit_power"].values()):
+            raise TypeError(f"{cls.__name__} expects TransmitPowers as transmit_power.")
+        return {
+            "air_speed": content["air_speed"],
+            "switch_in": content.get("switch_in"),
+            "transmit_power": dict(content["transmit_power"]),
+        }
+
+    def _serialize(self):
+        switch_in = self.content["switch_in"]
+        parts = [self._header.pack(self.content["air_speed"].value, -1.0 if switch_in is None else switch_in)]
+        for address, power in self.content["transmit_power"].items():
+            parts.append(self._entry.pack(address, power.value))
+        return b"".join(parts)
+
+    @classmethod
+    def _deserialize(cls, bytes_: bytes):
+        bytes_ = bytes(bytes_)
+        air_speed, switch_in = cls._header.unpack_from(bytes_)
+        entries = bytes_[cls._header.size :]
+        if len(entries) % cls._entry.size:
+            raise ValueError("Truncated transmit power entry.")
+        return {
+            "air_speed": AirSpeed(air_speed),
+            "switch_in": None if switch_in < 0 else switch_in,
+            "transmit_power": {
+                address: TransmitPower(power) for address, power in cls._entry.iter_unpack(entries)
+            },
+        }
+
+
+register_topic(Topic.RATE, RateMessage)
+
+
+class _Link:
+    def __init__(self, window: int):
+        # path loss in dB of the received messages
+        self.path_loss = deque(maxlen=window)
+        # True per received, False per lost message
+        self.received = deque(maxlen=window)
+        self.last_id = None
+        self.last_seen = None
+        self.transmit_power = None
+
+    def pdr(self) -> float:
+        return sum(self.received) / len(self.received)
+
+    def mean_path_loss(self) -> Optional[float]:
+        if not self.path_loss:
+            return None
+        return sum(self.path_loss) / len(self.path_loss)
+
+    def clear(self):
+        self.path_loss.clear()
+        self.received.clear()
+
+
+class RateController:
+    """
+    Picks air speed and transmit powers on the basestation, see module docstring.
+
+    :param config: The configuration of the basestation. Its air speed is the fallback of the network,
+    its transmit power the initial one of the nodes.
+    :param target_pdr: Packet delivery ratio every link has to keep.
+    :param margin_db: RSSI margin above the receiver sensitivity.
+    :param window: Number of messages per link the statistics are computed over.
+    :param min_samples: Number of messages of a link since the last change before it is evaluated.
+    :param lead: Seconds between the announcement of an air speed change and the switch.
+    :param announce_interval: Seconds between broadcasts of the settings.
+    :param fallback_timeout: Seconds without a message of a node after a switch before falling back.
+    """
+
+    def __init__(
+        self,
+        config,
+        target_pdr: float = 0.9,
+        margin_db: float = 10.0,
+        window: int = 20,
+        min_samples: int = 10,
+        lead: float = 6.0,
+        announce_interval: float = 2.0,
+        fallback_timeout: float = 30.0,
+    ):
+        self.address = config["module_address"]
+        self.air_speed = config["air_speed"]
+        self.fallback_air_speed = config["air_speed"]
+        self.default_transmit_power = config["transmit_power"]
+        self.target_pdr = target_pdr
+        self.margin_db = margin_db
+        self.window = window
+        self.min_samples = min_samples
+        self.lead = lead
+        self.announce_interval = announce_interval
+        self.fallback_timeout = fallback_timeout
+        self.links = {}
+        self.n_switches = 0
+        self.n_fallbacks = 0
+        # (time.monotonic(), AirSpeed) of an announced switch
+        self._switch = None
+        self._switched = None
+        # nodes that were active at the last switch
+        self._expected = set()
+        # fastest air speed to try and until when, lowered after a fallback
+        self._max_air_speed = AIR_SPEEDS[-1]
+        self._max_air_speed_until = None
+        self._next_announce = None
+
+    def observe(self, message: bytes, packet, now: Optional[float] = None):
+        """
+        Account for a received message.
+
+        :param message: The serialized message.
+        :param packet: The driver.Packet that completed it, see LoRaHatDriver.receive_messages.
+        :param now: time.monotonic(), for testing.
+        """
+        now = time.monotonic() if now is None else now
+        try:
+            _, sender, _ = Message.parse_header(message)
+        except DeserializeError:
+            return
+        link = self.links.get(int(sender))
+        if link is None:
+            link = self.links[int(sender)] = _Link(self.window)
+        if packet.message_id is not None:
+            if link.last_id is not None:
+                n_lost = (packet.message_id - link.last_id - 1) & MESSAGE_ID_MASK
+                # larger gaps are a restart of the sender's driver, e.g. after a switch
+                if n_lost < self.window:
+                    link.received.extend([False] * n_lost)
+            link.last_id = packet.message_id
+        link.received.append(True)
+        if packet.rssi is not None:
+            power = link.transmit_power or self.default_transmit_power
+            link.path_loss.append(TRANSMIT_POWER_DBM[power] - packet.rssi)
+        link.last_seen = now
+
+    def _margin(self, path_loss: float, air_speed: AirSpeed, power: TransmitPower) -> float:
+        return TRANSMIT_POWER_DBM[power] - path_loss - sensitivity(air_speed)
+
+    def decide(self):
+        """
+        The settings for the current statistics.
+
+        :return: The air speed and the changed transmit powers (dict node address -> TransmitPower).
+        """
+        links = {a: link for a, link in self.links.items() if len(link.received) >= self.min_samples}
+        current = AIR_SPEEDS.index(self.air_speed)
+        lossy = {a for a, link in links.items() if link.pdr() < self.target_pdr}
+        strongest = TRANSMIT_POWERS[-1]
+        if not links:
+            target = current
+        elif any((links[a].transmit_power or self.default_transmit_power) == strongest for a in lossy):
+            target = max(current - 1, 0)
+        elif lossy:
+            # raise the power first
+            target = current
+        else:
+            path_losses = [link.mean_path_loss() for link in links.values()]
+            if None in path_losses:
+                target = current
+            else:
+                fits = [
+                    i
+                    for i, air_speed in enumerate(AIR_SPEEDS)
+                    if all(self._margin(loss, air_speed, strongest) >= self.margin_db for loss in path_losses)
+                ]
+                best = max(fits, default=0)
+                target = best if best < current else min(best, current + 1)
+        target = min(target, AIR_SPEEDS.index(self._max_air_speed))
+        air_speed = AIR_SPEEDS[target]
+
+        powers = {}
+        for address, link in links.items():
+            power = link.transmit_power or self.default_transmit_power
+            if address in lossy:
+                new_power = TRANSMIT_POWERS[min(TRANSMIT_POWERS.index(power) + 1, len(TRANSMIT_POWERS) - 1)]
+            elif link.mean_path_loss() is not None:
+                new_power = next(
+                    (
+                        p
+                        for p in TRANSMIT_POWERS
+                        if self._margin(link.mean_path_loss(), air_speed, p) >= self.margin_db
+                    ),
+                    strongest,
+                )
+            else:
+                new_power = power
+            if new_power != power:
+                powers[address] = new_power
+        return air_speed, powers
+
+    def poll(self, lora_hat, now: Optional[float] = None, announce: bool = True) -> float:
+        """
+        Switch the air speed if it is due, otherwise adapt the settings and broadcast them.
+
+        :param lora_hat: The basestation's LoRaHatDriver.
+        :param now: time.monotonic(), for testing.
+        :param announce: Whether the basestation may send now, e.g. not outside the downlink of tdma.py.
+        Otherwise only a due switch is applied.
+        :return: Seconds until poll has to be called again.
+        """
+        now = time.monotonic() if now is None else now
+        due = self._next_announce is None or now >= self._next_announce
+        if self._switch is not None and now >= self._switch[0]:
+            self._apply_switch(lora_hat, now)
+        elif self._switch is None and announce:
+            if self._max_air_speed_until is not None and now >= self._max_air_speed_until:
+                self._max_air_speed = AIR_SPEEDS[-1]
+                self._max_air_speed_until = None
+            if self._missing_nodes(now):
+                logging.warning(
+                    f"Nodes {sorted(self._missing_nodes(now))} were not heard since the switch to "
+                    f"{self.air_speed.name}, falling back to {self.fallback_air_speed.name}."
+                )
+                self.n_fallbacks += 1
+                self._max_air_speed = AIR_SPEEDS[max(AIR_SPEEDS.index(self.air_speed) - 1, 0)]
+                self._max_air_speed_until = now + 10 * self.fallback_timeout
+                air_speed, powers = self.fallback_air_speed, {}
+                self._expected = set()
+            else:
+                air_speed, powers = self.decide()
+            for address, power in powers.items():
+                self.links[address].transmit_power = power
+                self.links[address].clear()
+            if air_speed != self.air_speed:
+                logging.info(f"Switching to {air_speed.name} in {self.lead} s.")
+                self._switch = (now + self.lead, air_speed)
+            due = due or powers or air_speed != self.air_speed
+        if announce and due:
+            self._announce(lora_hat, now)
+        # the next announcement is up to the caller if it may not send now
+        wait = self._next_announce - now if announce else math.inf
+        if self._switch is not None:
+            wait = min(wait, self._switch[0] - now)
+        return max(wait, 0)
+
+    def _missing_nodes(self, now: float) -> set:
+        if self._switched is None or now - self._switched < self.fallback_timeout:
+            return set()
+        if self.air_speed == self.fallback_air_speed:
+            return set()
+        return {a for a in self._expected if self.links[a].last_seen < self._switched}
+
+    def _apply_switch(self, lora_hat, now: float):
+        _, air_speed = self._switch
+        self._switch = None
+        if lora_hat.reconfigure(air_speed=air_speed):
+            self.air_speed = air_speed
+            self.n_switches += 1
+        else:
+            logging.error(f"Could not switch to {air_speed.name}.")
+        self._switched = now
+        self._expected = {
+            a for a, link in self.links.items() if now - link.last_seen < self.fallback_timeout
+        }
+        for link in self.links.values():
+            link.clear()
+
+    def _announce(self, lora_hat, now: float):
+        content = {
+            "air_speed": self.air_speed,
+            "switch_in": None,
+            "transmit_power": {
+                a: link.transmit_power for a, link in self.links.items() if link.transmit_power is not None
+            },
+        }
+        if self._switch is not None:
+            content["switch_in"] = self._switch[0] - now
+            content["air_speed"] = self._switch[1]
+        message = RateMessage(content, self.address)
+        lora_hat.send_message(message.serialize(), target_address=BROADCAST_ADDRESS)
+        self._next_announce = now + self.announce_interval
+
+
+class RateFollower:
+    """
+    Applies the settings of the basestation on a node, see module docstring.
+
+    :param address: The node's address, the sender of its messages. The basestation keys the transmit powers
+    by it, it is not the module address.
+    :param config: The configuration of the node. Its air speed is the fallback.
+    :param fallback_timeout: Seconds without a RateMessage before returning to the fallback air speed.
+    """
+
+    def __init__(self, address: int, config, fallback_timeout: float = 30.0):
+        self.address = address
+        self.fallback_air_speed = config["air_speed"]
+        self.fallback_timeout = fallback_timeout
+        self.n_switches = 0
+        self.n_fallbacks = 0
+        self._switch = None
+        self._transmit_power = None
+        self._last_heard = time.monotonic()
+
+    def handle(self, message: bytes, packet=None, now: Optional[float] = None) -> bool:
+        """
+        Take the settings of a received message.
+
+        :param message: Any received serialized message.
+        :param packet: The driver.Packet that completed it, switch_in is measured from its arrival. Without it
+        from now.
+        :param now: time.monotonic(), for testing.
+        :return: Whether it was a RateMessage.
+        """
+        now = time.monotonic() if now is None else now
+        if packet is not None:
+            # Packet.time is time.time()
+            now -= max(time.time() - packet.time, 0.0)
+        try:
+            topic, _, _ = Message.parse_header(message)
+            if topic != Topic.RATE:
+                return False
+            rate = RateMessage.from_bytes(message)
+        except DeserializeError:
+            return False
+        self._last_heard = now
+        if rate.content["switch_in"] is not None:
+            self._switch = (now + rate.content["switch_in"], rate.content["air_speed"])
+        power = rate.content["transmit_power"].get(self.address)
+        if power is not None:
+            self._transmit_power = power
+        return True
+
+    def receive(self, lora_hat):
+        """Handle all received messages without waiting. Other messages than RateMessages are dropped."""
+        while lora_hat.readable():
+            for message, packet in lora_hat.receive_messages(timeout=0, metadata=True):
+                self.handle(message, packet)
+
+    def poll(self, lora_hat, now: Optional[float] = None) -> float:
+        """
+        Apply due changes.
+
+        :param lora_hat: The node's LoRaHatDriver.
+        :param now: time.monotonic(), for testing.
+        :return: Seconds until poll has to be called again.
+        """
+        now = time.monotonic() if now is None else now
+        changes = {}
+        if self._switch is not None and now >= self._switch[0]:
+            changes["air_speed"] = self._switch[1]
+            self._switch = None
+            self.n_switches += 1
+        elif now - self._last_heard >= self.fallback_timeout:
+            if lora_hat.air_speed != self.fallback_air_speed:
+                logging.warning(
+                    f"Basestation not heard for {self.fallback_timeout} s, "
+                    f"falling back to {self.fallback_air_speed.name}."
+                )
+                changes["air_speed"] = self.fallback_air_speed
+                self.n_fallbacks += 1
+            self._switch = None
+            self._last_heard = now
+        if self._transmit_power is not None and self._transmit_power != lora_hat.transmit_power:
+            changes["transmit_power"] = self._transmit_power
+        if changes and not lora_hat.reconfigure(**changes):
+            logging.error(f"Could not apply {changes}.")
+
+        wait = self._last_heard + self.fallback_timeout - now
+        if self._switch is not None:
+            wait = min(wait, self._switch[0] - now)
+        return max(wait, 0)
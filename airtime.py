@@ -0,0 +1,63 @@
+"""
+Time on air of LoRa packets.
+
+See Semtech AN1200.13 "LoRa Modem Designer's Guide" for the formula.
+"""
+
+import math
+
+PREAMBLE_LEN = 8  # symbols
+CODING_RATE = 1  # 4/(4 + CODING_RATE), i.e. 4/5
+
+
+def time_on_air(
+    n_bytes: int,
+    spreading_factor: int,
+    bandwidth: float,
+    coding_rate: int = CODING_RATE,
+    preamble_len: int = PREAMBLE_LEN,
+    explicit_header: bool = True,
+    crc: bool = True,
+) -> float:
+    """
+    Time on air of a single LoRa packet.
+
+    :param n_bytes: Payload length in bytes.
+    :param spreading_factor: Spreading factor (5-12).
+    :param bandwidth: Bandwidth in Hz.
+    :param coding_rate: Coding rate 1-4 for 4/5 - 4/8.
+    :param preamble_len: Number of preamble symbols.
+    :param explicit_header: Whether the packet has an explicit header.
+    :param crc: Whether the packet has a payload CRC.
+    :return: Time on air in seconds.
+    """
+    symbol_time = 2 ** spreading_factor / bandwidth
+    # low data rate optimization is mandated for symbols longer than 16 ms
+    low_data_rate_optimize = symbol_time > 0.016
+
+    preamble_time = (preamble_len + 4.25) * symbol_time
+    numerator = 8 * n_bytes - 4 * spreading_factor + 28 + 16 * crc - 20 * (not explicit_header)
+    denominator = 4 * (spreading_factor - 2 * low_data_rate_optimize)
+    n_payload_symbols = 8 + max(
+        math.ceil(numerator / denominator) * (coding_rate + 4), 0
+    )
+    return preamble_time + n_payload_symbols * symbol_time
+
+
+def split_time_on_air(
+    n_bytes: int, max_packet_len: int, spreading_factor: int, bandwidth: float
+) -> float:
+    """
+    Time on air of n_bytes when they are split into packets of at most max_packet_len bytes.
+
+    :param n_bytes: Number of bytes to transmit.
+    :param max_packet_len: Maximum payload length of a single packet.
+    :param spreading_factor: Spreading factor (5-12).
+    :param bandwidth: Bandwidth in Hz.
+    :return: Total time on air in seconds.
+    """
+    n_full, rest = divmod(n_bytes, max_packet_len)
+    total = n_full * time_on_air(max_packet_len, spreading_factor, bandwidth)
+    if rest:
+        total += time_on_air(rest, spreading_factor, bandwidth)
+    return total
@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Optional
+
+import metrics
+from driver import CONFIG_TIMEOUT, MODULE_BUFFER_SIZE, LoRaHatDriver, split_rssi
+from fragment import Fragmenter, Reassembler
+from framing import DELIMITER, FrameDecoder, encode_frame
+
+# the metrics of driver.py, packets are not delimited here so only bytes are counted on reception
+_tx_bytes = metrics.counter("lora_tx_bytes_total")
+_tx_packets = metrics.counter("lora_tx_packets_total")
+_tx_messages = metrics.counter("lora_tx_messages_total")
+_tx_wait = metrics.histogram("lora_tx_wait_seconds")
+_rx_bytes = metrics.counter("lora_rx_bytes_total")
+_rx_messages = metrics.counter("lora_rx_messages_total")
+_frame_errors = metrics.counter("lora_frame_errors_total")
+_rssi = metrics.gauge("lora_rx_rssi_dbm")
+_rx_dropped = metrics.counter("lora_rx_dropped_messages_total", "Messages dropped because the queue was full.")
+
+
+class AsyncLoRaHatDriver:
+    """
+    asyncio interface to the LoRa hat.
+
+    Received bytes are read from the serial file descriptor via loop.add_reader, parsed into frames
+    (see framing.py) and reassembled into messages (see fragment.py), so radio, IPC and timers can share
+    one event loop without threads. Messages are compatible with LoRaHatDriver.send_message/receive_messages.
+
+    Usage:
+
+        async with AsyncLoRaHatDriver(lora_hat_config) as lora_hat:
+            await lora_hat.send(message.serialize())
+            async for message_bytes in lora_hat:
+                ...
+    """
+
+    def __init__(
+        self,
+        config,
+        port: str = "/dev/ttyS0",
+        gpio=None,
+        max_queued_messages: int = 64,
+        persist_config: bool = False,
+        config_cache: Optional[str] = None,
+        csma_threshold: Optional[float] = None,
+        csma_max_delay: float = 2.0,
+    ):
+        self.driver = LoRaHatDriver(
+            config,
+            port,
+            gpio,
+            persist_config,
+            config_cache,
+            csma_threshold=csma_threshold,
+            csma_max_delay=csma_max_delay,
+        )
+        self.config = self.driver.config
+        self._frame_decoder = FrameDecoder()
+        self._fragmenter = Fragmenter(self.driver.fragment_len)
+        self._reassembler = Reassembler()
+        self._messages = asyncio.Queue(maxsize=max_queued_messages)
+        # RSSI of the last received packet in dBm if enable_RSSI_byte is set
+        self.last_rssi = None
+        # bytes after the last frame delimiter, may be an RSSI byte
+        self._rssi_tail = b""
+        self._send_lock = asyncio.Lock()
+        # answer to a pending sense_noise
+        self._noise_answer = None
+        self._loop = None
+        self._fd = None
+
+    async def __aenter__(self):
+        # configuration is a one-off handshake with sleeps, keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.driver.apply_config)
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+        self.driver.clean_up()
+        logging.info("Successfully shut down.")
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        return await self.receive()
+
+    def start(self):
+        """Start reading from the (already opened) serial port."""
+        self._loop = asyncio.get_running_loop()
+        self._fd = self.driver.ser.fileno()
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    def stop(self):
+        """Stop reading from the serial port."""
+        if self._loop is not None:
+            self._loop.remove_reader(self._fd)
+            self._loop = None
+
+    async def send(self, message: bytes, block: bool = False) -> float:
+        """
+        Send a message of any size, e.g. a serialized message.Message.
+
+        Like LoRaHatDriver.send the writes are held back while the module's buffer is full.
+
+        :param message: The message to send.
+        :param block: Wait until the message is expected to be transmitted.
+        :return: time.monotonic() at which the transmission is expected to be complete.
+        """
+        async with self._send_lock:
+            for fragment in self._fragmenter.split(message):
+                tx_done = await self._send_frame(fragment)
+        _tx_messages.inc()
+        if block:
+            await asyncio.sleep(max(tx_done - time.monotonic(), 0))
+        return tx_done
+
+    async def receive(self, timeout: Optional[float] = None) -> bytes:
+        """
+        Wait for the next message.
+
+        :param timeout: Maximum time in seconds to wait. None waits forever.
+        :return: The message.
+        :raises asyncio.TimeoutError: If no message was received within timeout.
+        """
+        return await asyncio.wait_for(self._messages.get(), timeout)
+
+    async def sense_noise(self, timeout: float = CONFIG_TIMEOUT) -> Optional[int]:
+        """
+        Sample the ambient noise and wait for the answer, see LoRaHatDriver.sense_noise.
+
+        :param timeout: Maximum time in seconds to wait for the answer.
+        :return: The noise in dBm or None if the module did not answer.
+        """
+        self._noise_answer = self._loop.create_future()
+        self.driver.request_noise_rssi()
+        try:
+            return await asyncio.wait_for(self._noise_answer, timeout)
+        except asyncio.TimeoutError:
+            self.driver._noise_requested = None
+            return None
+        finally:
+            self._noise_answer = None
+
+    async def _listen_before_talk(self, n_bytes: int):
+        # see LoRaHatDriver._listen_before_talk
+        start = time.monotonic()
+        n_busy = 0
+        while True:
+            noise = await self.sense_noise()
+            backoff = self.driver.csma_backoff(noise, n_busy, n_bytes, time.monotonic() - start)
+            if backoff is None:
+                break
+            await asyncio.sleep(backoff)
+            n_busy += 1
+        self.driver.csma_done(n_busy, time.monotonic() - start)
+
+    async def _send_frame(self, payload: bytes) -> float:
+        packet = self.driver.make_packet(encode_frame(payload))
+        delay = max(self.driver.tx_delay(len(packet)), self.driver.write_delay())
+        _tx_wait.observe(delay)
+        await asyncio.sleep(delay)
+        if self.driver.csma_threshold is not None and self.driver.tx_delay(MODULE_BUFFER_SIZE) == 0:
+            await self._listen_before_talk(len(packet))
+        data = memoryview(packet)
+        while data:
+            try:
+                n_written = os.write(self._fd, data)
+                data = data[n_written:]
+            except BlockingIOError:
+                await self._wait_writable()
+        _tx_bytes.inc(len(packet))
+        _tx_packets.inc()
+        return self.driver.register_tx(len(packet))
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        _rx_bytes.inc(len(data))
+        if self.driver._noise_requested is not None:
+            data = self.driver._parse_noise_answer(data)
+            answered = self.driver._noise_requested is None
+            if answered and self._noise_answer is not None and not self._noise_answer.done():
+                self._noise_answer.set_result(self.driver.noise_rssi)
+        if self.driver.enable_RSSI_byte:
+            # packets are not delimited here, the RSSI bytes are found between frames, see split_rssi
+            data = self._rssi_tail + data
+            end = data.rfind(DELIMITER) + 1
+            data, self._rssi_tail = data[:end], data[end:]
+            data, rssi = split_rssi(data)
+            if rssi:
+                self.last_rssi = rssi[-1]
+                _rssi.set(self.last_rssi)
+        n_errors = self._frame_decoder.n_errors
+        for frame in self._frame_decoder.feed(data):
+            message = self._reassembler.add(frame)
+            if message is None:
+                continue
+            _rx_messages.inc()
+            if self._messages.full():
+                logging.warning("Message queue is full, dropping oldest message.")
+                _rx_dropped.inc()
+                self._messages.get_nowait()
+            self._messages.put_nowait(message)
+        if self._frame_decoder.n_errors != n_errors:
+            _frame_errors.inc(self._frame_decoder.n_errors - n_errors)
+
+    async def _wait_writable(self):
+        writable = self._loop.create_future()
+        self._loop.add_writer(
+            self._fd, lambda: writable.done() or writable.set_result(None)
+        )
+        try:
+            await writable
+        finally:
+            self._loop.remove_writer(self._fd)
@@ -1,42 +1,108 @@
-import pickle
 import pprint
-import queue
-import sys
 import threading
 import zmq
 
 import logging.config
 
+import metrics
+from adr import BROADCAST_ADDRESS, RateController
+from delta import DeltaDecoder
 from driver import LoRaHatDriver
-from loraconfig import lora_hat_config, logging_config_dict
-from message import TimeOrientPosMessage, DeserializeError
+from ingress import IngressBuffer
+from lora_zmq import frames_to_publish, make_publisher
+from loraconfig import (
+    adr_config,
+    basestation_ingress_config,
+    basestation_zmq_config,
+    delta_config,
+    enable_adr,
+    enable_delta,
+    enable_tdma,
+    lora_hat_config,
+    lora_hat_options,
+    logging_config_dict,
+    metrics_config,
+    tdma_config,
+)
+from message import TimeOrientPosMessage, Topic, register_topic
+from tdma import TdmaScheduler
 
 logging.config.dictConfig(logging_config_dict)
 
 
-socket_name = "tcp://127.0.0.1:5555"
+# nodes send data of unknown zmq topics as TimeOrientPosMessage with undefined topic
+register_topic(Topic.UNDEFINED, TimeOrientPosMessage)
 
-q = queue.Queue(maxsize=3)
+
+socket_name = basestation_zmq_config["socket_name"]
+
+# never blocks the radio loop, drops messages if the publisher falls behind
+q = IngressBuffer(**basestation_ingress_config)
+
+metrics.gauge("lora_ingress_depth", "Messages in the ingress buffer.", lambda: len(q))
+metrics.counter("lora_ingress_dropped_total", "Messages dropped by the ingress buffer.", lambda: q.n_dropped)
+metrics.counter(
+    "lora_ingress_replaced_total", "Messages replaced by a newer one of the same sender.", lambda: q.n_replaced
+)
+published = metrics.counter("lora_published_messages_total", "Messages published over zmq.")
 
 
 def write_to_zeromq(socket_name):
     logging.info(f"binding to {socket_name} for zeroMQ IPC")
     context = zmq.Context()
-    socket = context.socket(zmq.PUB)
+    socket = make_publisher(context, basestation_zmq_config["send_hwm"])
     with socket.connect(socket_name):
         logging.info("connected to zeroMQ IPC socket")
 
         while True:
             message = q.get()
-            try:
-                print(TimeOrientPosMessage.from_bytes(message))
-            except DeserializeError as e:
-                logging.error(e)
+            multiparts = frames_to_publish(message, basestation_zmq_config["publish_decoded"])
+            for frames in multiparts:
+                socket.send_multipart(frames, copy=False)
+            published.inc(len(multiparts))
 
 
 threading.Thread(target=write_to_zeromq, daemon=True, args=[socket_name]).start()
+metrics.serve(**metrics_config)
 
-with LoRaHatDriver(lora_hat_config) as lora_hat:
+with LoRaHatDriver(lora_hat_config, **lora_hat_options) as lora_hat:
     logging.debug(f"LoRa hat config: {pprint.pformat(lora_hat.config)}")
+    if not enable_adr and not enable_tdma and not enable_delta:
+        while True:
+            for message in lora_hat.receive_messages():
+                q.put(message)
+
+    controller = RateController(lora_hat.config, **adr_config) if enable_adr else None
+    decoder = DeltaDecoder(delta_config["request_interval"]) if enable_delta else None
+    scheduler = None
+    if enable_tdma:
+        scheduler = TdmaScheduler(
+            lora_hat,
+            tdma_config["nodes"],
+            tdma_config["packets_per_slot"],
+            tdma_config["downlink_packets"],
+            tdma_config["clock_error"],
+        )
     while True:
-        q.put(lora_hat.receive(), block=False)
+        timeout = None
+        if scheduler is not None:
+            timeout = scheduler.poll(lora_hat)
+        # due switches are applied at once, with TDMA settings are only sent between the beacon and the first slot
+        if controller is not None:
+            wait = controller.poll(lora_hat, announce=scheduler is None or scheduler.in_downlink())
+            timeout = wait if timeout is None else min(timeout, wait)
+        if decoder is not None and (scheduler is None or scheduler.in_downlink()):
+            request = decoder.keyframe_request(lora_hat.config["module_address"])
+            if request is not None:
+                lora_hat.send_message(request.serialize(), target_address=BROADCAST_ADDRESS)
+        for message, packet in lora_hat.receive_messages(timeout, metadata=True):
+            if controller is not None:
+                controller.observe(message, packet)
+            if scheduler is not None:
+                scheduler.observe(message)
+            if decoder is not None:
+                # subscribers get QuantizedTimeOrientPosMessages, they do not keep the state of the streams
+                message = decoder.expand(message)
+                if message is None:
+                    continue
+            q.put(message)
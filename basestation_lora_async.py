@@ -0,0 +1,52 @@
+import asyncio
+import pprint
+
+import zmq
+import zmq.asyncio
+
+import logging.config
+
+import metrics
+from async_driver import AsyncLoRaHatDriver
+from lora_zmq import frames_to_publish, make_publisher
+from loraconfig import (
+    basestation_zmq_config,
+    lora_hat_config,
+    lora_hat_options,
+    logging_config_dict,
+    metrics_config,
+)
+from message import TimeOrientPosMessage, Topic, register_topic
+
+logging.config.dictConfig(logging_config_dict)
+
+
+# nodes send data of unknown zmq topics as TimeOrientPosMessage with undefined topic
+register_topic(Topic.UNDEFINED, TimeOrientPosMessage)
+
+
+socket_name = basestation_zmq_config["socket_name"]
+
+published = metrics.counter("lora_published_messages_total", "Messages published over zmq.")
+
+
+async def main():
+    metrics.serve(**metrics_config)
+    logging.info(f"binding to {socket_name} for zeroMQ IPC")
+    context = zmq.asyncio.Context()
+    socket = make_publisher(context, basestation_zmq_config["send_hwm"])
+    with socket.connect(socket_name):
+        logging.info("connected to zeroMQ IPC socket")
+
+        async with AsyncLoRaHatDriver(lora_hat_config, **lora_hat_options) as lora_hat:
+            logging.debug(f"LoRa hat config: {pprint.pformat(lora_hat.config)}")
+            async for message in lora_hat:
+                multiparts = frames_to_publish(message, basestation_zmq_config["publish_decoded"])
+                for frames in multiparts:
+                    # PUB sockets drop instead of blocking at the high water mark
+                    await socket.send_multipart(frames, copy=False)
+                published.inc(len(multiparts))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
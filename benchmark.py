@@ -0,0 +1,183 @@
+"""
+Microbenchmarks of the hot paths that do not need hardware.
+
+Measures per-call latency, memory allocated per call (tracemalloc) and throughput.
+Results are written as JSON so runs can be compared:
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+
+from fragment import Fragmenter, Reassembler
+from framing import FrameDecoder, encode_frame
+from loraconfig import lora_hat_config
+from message import (
+    Message,
+    NumpyMessage,
+    QuantizedTimeOrientPosMessage,
+    TimeOrientPosMessage,
+    Topic,
+)
+from registers import command_to_dict, serialize_config
+
+
+def make_cases():
+    """
+    The benchmark cases.
+
+    :return: dict of name -> (function without arguments, number of bytes processed per call or None)
+    """
+    content = np.arange(8, dtype=np.float32)
+    message = TimeOrientPosMessage(content, 150, topic=Topic.ATTITUDE)
+    message_bytes = message.serialize()
+    quantized_content = np.array([time.time(), 1, 0, 0, 0, 1, 2, 3])
+    quantized = QuantizedTimeOrientPosMessage(quantized_content, 150, Topic.QUANTIZED_ATTITUDE)
+    quantized_bytes = quantized.serialize()
+    config = lora_hat_config.copy()
+    command = serialize_config(config)
+    frame = encode_frame(message_bytes)
+    frame_decoder = FrameDecoder()
+    large_payload = bytes(range(256)) * 8
+    fragmenter = Fragmenter(231)
+    fragments = fragmenter.split(large_payload)
+    reassembler = Reassembler()
+
+    def reassemble():
+        for fragment in fragments:
+            reassembler.add(fragment)
+
+    return {
+        "message_serialize": (message.serialize, len(message_bytes)),
+        "message_from_bytes": (
+            lambda: TimeOrientPosMessage.from_bytes(message_bytes),
+            len(message_bytes),
+        ),
+        "message_decode": (lambda: Message.decode(message_bytes), len(message_bytes)),
+        "numpy_check_content": (lambda: NumpyMessage._check_content(content), None),
+        "quantized_serialize": (quantized.serialize, len(quantized_bytes)),
+        "quantized_from_bytes": (
+            lambda: QuantizedTimeOrientPosMessage.from_bytes(quantized_bytes),
+            len(quantized_bytes),
+        ),
+        "serialize_config": (lambda: serialize_config(config), len(command)),
+        "command_to_dict": (lambda: command_to_dict(command), len(command)),
+        "encode_frame": (lambda: encode_frame(message_bytes), len(message_bytes)),
+        "frame_decoder_feed": (lambda: frame_decoder.feed(frame), len(frame)),
+        "fragment_split": (lambda: fragmenter.split(large_payload), len(large_payload)),
+        "fragment_reassemble": (reassemble, len(large_payload)),
+    }
+
+
+def measure(func, n_bytes=None, min_time=0.2, repeats=5) -> dict:
+    """
+    Benchmark a function.
+
+    :param func: Function without arguments.
+    :param n_bytes: Number of bytes processed per call, for throughput in bytes/s.
+    :param min_time: Minimum duration of a single repeat in seconds.
+    :param repeats: Number of repeats, the per-call latency statistics are taken over them.
+    :return: The results.
+    """
+    # calibrate the number of calls per repeat
+    n_calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(n_calls):
+            func()
+        if time.perf_counter() - start >= min_time / 10:
+            break
+        n_calls *= 2
+    n_calls *= 10
+
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(n_calls):
+            func()
+        latencies.append((time.perf_counter() - start) / n_calls)
+
+    tracemalloc.start()
+    n_alloc_calls = min(n_calls, 1000)
+    before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    for _ in range(n_alloc_calls):
+        func()
+    _, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated_blocks = sum(stat.count for stat in snapshot.statistics("filename"))
+
+    median = statistics.median(latencies)
+    result = {
+        "calls": n_calls * repeats,
+        "latency_median_s": median,
+        "latency_min_s": min(latencies),
+        "latency_stdev_s": statistics.stdev(latencies) if repeats > 1 else 0.0,
+        "calls_per_s": 1 / median,
+        "peak_memory_bytes": peak - before,
+        "retained_blocks_per_call": allocated_blocks / n_alloc_calls,
+    }
+    if n_bytes is not None:
+        result["bytes_per_s"] = n_bytes / median
+    return result
+
+
+def run(name_filter="", min_time=0.2, repeats=5) -> dict:
+    results = {}
+    for name, (func, n_bytes) in make_cases().items():
+        if name_filter in name:
+            results[name] = measure(func, n_bytes, min_time, repeats)
+    return {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version,
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "results": results,
+    }
+
+
+def print_results(report, baseline=None):
+    print(f"{'case':<24}{'latency':>12}{'calls/s':>14}{'peak mem':>12}{'vs baseline':>14}")
+    for name, result in report["results"].items():
+        line = (
+            f"{name:<24}{result['latency_median_s'] * 1e6:>10.2f}us"
+            f"{result['calls_per_s']:>14.0f}{result['peak_memory_bytes']:>11}B"
+        )
+        if baseline is not None and name in baseline["results"]:
+            ratio = (
+                result["latency_median_s"]
+                / baseline["results"][name]["latency_median_s"]
+            )
+            line += f"{ratio:>13.2f}x"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of a previous run to compare with")
+    parser.add_argument("--filter", default="", help="only run cases containing this")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per repeat")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    report = run(args.filter, args.min_time, args.repeats)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(report, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,315 @@
+"""
+Delta encoding of continuous QuantizedTimeOrientPosMessage streams.
+
+A stream is identified by topic and sender. Delta encoded messages have the topic Topic.DELTA, followed by
+the topic of the stream (uint8) and a 1 byte header (keyframe flag in bit 7, sequence number modulo 128
+in bits 0-6):
+
+- keyframe: header | quantized record (14 bytes) | time step in ticks (int16)
+- delta: header | change of the time step in ticks (int8) | change of orientation and position (6 x int8)
+
+Deltas are taken on the quantized integers, so decoding is lossless with respect to
+QuantizedTimeOrientPosMessage. A keyframe is sent every keyframe_interval messages and whenever a change
+does not fit into int8. The decoder drops deltas after a sequence gap until the next keyframe and asks
+for it: the basestation broadcasts a KeyframeRequest for the stream and the node's encoder sends a keyframe
+next (see DeltaEncoder.handle).
+
+    encoder = DeltaEncoder(150)                     # node
+    batch = BatchMessage.pack([encoder.encode(m) for m in messages], 150, max_len)
+    encoder.handle(received_message)
+
+    decoder = DeltaDecoder()                        # basestation
+    message = decoder.expand(received_message)      # None if nothing could be decoded
+    request = decoder.keyframe_request(address)     # broadcast if not None
+"""
+
+import logging
+import struct
+import time
+from typing import Optional
+
+import numpy as np
+
+from message import (
+    BatchMessage,
+    DeserializeError,
+    Message,
+    QuantizedTimeOrientPosMessage,
+    Topic,
+    register_topic,
+    topic_from_id,
+    topic_id,
+)
+
+KEYFRAME_FLAG = 0x80
+SEQUENCE_MASK = 0x7F
+
+_time_step = struct.Struct("<h")
+
+
+class KeyframeRequest(Message):
+    """
+    Streams the basestation cannot decode since a loss.
+
+    Content is a list of (sender, topic id) pairs.
+    """
+
+    topic = Topic.KEYFRAME_REQUEST
+    _entry = struct.Struct(">HB")
+
+    def __init__(self, content, sender: int, topic: Topic = Topic.KEYFRAME_REQUEST):
+        super().__init__(content, sender, topic)
+
+    @classmethod
+    def _check_content(cls, content):
+        return [(int(sender), topic_id(topic)) for sender, topic in content]
+
+    def _serialize(self):
+        return b"".join(self._entry.pack(sender, topic) for sender, topic in self.content)
+
+    @classmethod
+    def _deserialize(cls, bytes_: bytes):
+        bytes_ = bytes(bytes_)
+        if len(bytes_) % cls._entry.size:
+            raise ValueError("Truncated stream entry.")
+        return list(cls._entry.iter_unpack(bytes_))
+
+
+register_topic(Topic.KEYFRAME_REQUEST, KeyframeRequest)
+
+
+class _StreamState:
+    # record is a quantized record array of shape (1,)
+    def __init__(self, record: np.ndarray, time_step: int, sequence: int):
+        self.record = record
+        self.time_step = time_step
+        self.sequence = sequence
+        self.n_since_keyframe = 0
+
+
+def _ticks(record: np.ndarray) -> int:
+    return int(record["time_index"][0]) & ((1 << QuantizedTimeOrientPosMessage._time_bits) - 1)
+
+
+def _largest_index(record: np.ndarray) -> int:
+    return int(record["time_index"][0]) >> QuantizedTimeOrientPosMessage._time_bits
+
+
+def _time_diff(ticks: int, previous_ticks: int) -> int:
+    # difference of the wrapping tick counter in the signed range
+    period = 1 << QuantizedTimeOrientPosMessage._time_bits
+    return (ticks - previous_ticks + period // 2) % period - period // 2
+
+
+def _values(record: np.ndarray) -> np.ndarray:
+    return np.concatenate([record["orientation"][0], record["position"][0]]).astype(np.int64)
+
+
+class DeltaEncoder:
+    """
+    Encodes the messages of one sender, keeping one stream per topic.
+
+    :param sender: The sender of the messages, see handle.
+    :param keyframe_interval: Maximum number of messages per stream from one keyframe to the next.
+    """
+
+    message_cls = QuantizedTimeOrientPosMessage
+
+    def __init__(self, sender: int, keyframe_interval: int = 10):
+        self.sender = sender
+        self.keyframe_interval = keyframe_interval
+        self.n_requests = 0
+        # topic id -> _StreamState
+        self._streams = {}
+
+    def request_keyframe(self, topic=None):
+        """Make the next message of a stream a keyframe, of every stream if topic is None."""
+        if topic is None:
+            self._streams.clear()
+        else:
+            self._streams.pop(topic_id(topic), None)
+
+    def handle(self, message: bytes) -> bool:
+        """
+        Take the streams of a received KeyframeRequest that belong to the sender.
+
+        :param message: Any received serialized message.
+        :return: Whether it was a KeyframeRequest.
+        """
+        try:
+            topic, _, _ = Message.parse_header(message)
+            if topic != Topic.KEYFRAME_REQUEST:
+                return False
+            request = KeyframeRequest.from_bytes(message)
+        except DeserializeError:
+            return False
+        for sender, topic in request.content:
+            if sender == self.sender:
+                self.n_requests += 1
+                self.request_keyframe(topic)
+        return True
+
+    def encode(self, message: QuantizedTimeOrientPosMessage) -> bytes:
+        """
+        Serialize a message as keyframe or delta.
+
+        :param message: The message to encode.
+        :return: The serialized message.
+        """
+        record = self.message_cls.quantize(message.content)
+        stream = topic_id(message.topic)
+        state = self._streams.get(stream)
+        header = bytes([topic_id(Topic.DELTA)]) + message.header_bytes()[1:] + bytes([stream])
+
+        if state is not None:
+            time_step = _time_diff(_ticks(record), _ticks(state.record))
+            sequence = (state.sequence + 1) & SEQUENCE_MASK
+            deltas = np.concatenate(
+                [[time_step - state.time_step], _values(record) - _values(state.record)]
+            )
+            is_delta = (
+                state.n_since_keyframe + 1 < self.keyframe_interval
+                and _largest_index(record) == _largest_index(state.record)
+                and np.all((-128 <= deltas) & (deltas <= 127))
+            )
+            if is_delta:
+                state.record = record
+                state.time_step = time_step
+                state.sequence = sequence
+                state.n_since_keyframe += 1
+                return header + bytes([sequence]) + deltas.astype(np.int8).tobytes()
+        else:
+            time_step = 0
+            sequence = 0
+
+        time_step = int(np.clip(time_step, -32768, 32767))
+        self._streams[stream] = _StreamState(record, time_step, sequence)
+        return header + bytes([KEYFRAME_FLAG | sequence]) + record.tobytes() + _time_step.pack(time_step)
+
+
+class DeltaDecoder:
+    """
+    Decodes delta encoded messages of any number of senders.
+
+    :param request_interval: Minimum time in seconds between two keyframe requests for the same stream.
+    """
+
+    message_cls = QuantizedTimeOrientPosMessage
+
+    def __init__(self, request_interval: float = 1.0):
+        self.request_interval = request_interval
+        self.n_gaps = 0
+        self.n_dropped = 0
+        self._streams = {}
+        # streams to request a keyframe of and the time.monotonic() of their last request
+        self._pending = set()
+        self._requested = {}
+
+    def decode(self, bytes_: bytes, now: Optional[float] = None) -> Optional[QuantizedTimeOrientPosMessage]:
+        """
+        Decode a serialized message.
+
+        :param bytes_: The serialized message.
+        :param now: time.monotonic(), for testing.
+        :return: The message or None if it is a delta that cannot be applied after a loss.
+        """
+        _, sender, n_bytes_header = self.message_cls.parse_header(bytes_)
+        try:
+            stream = bytes_[n_bytes_header]
+            topic = topic_from_id(stream)
+            body = bytes_[n_bytes_header + 1 :]
+            key = (int(sender), stream)
+            flags = body[0]
+            sequence = flags & SEQUENCE_MASK
+            if flags & KEYFRAME_FLAG:
+                record_len = self.message_cls._record_dtype.itemsize
+                record = np.frombuffer(
+                    body[1 : 1 + record_len], dtype=self.message_cls._record_dtype
+                ).copy()
+                if len(record) != 1:
+                    raise ValueError("Keyframe is truncated.")
+                (time_step,) = _time_step.unpack(body[1 + record_len : 3 + record_len])
+                state = self._streams[key] = _StreamState(record, time_step, sequence)
+                self._pending.discard(key)
+            else:
+                state = self._streams.get(key)
+                if state is None or sequence != (state.sequence + 1) & SEQUENCE_MASK:
+                    if state is not None:
+                        logging.debug(
+                            f"Sequence gap from {sender} on {topic}, waiting for keyframe."
+                        )
+                        self.n_gaps += 1
+                        del self._streams[key]
+                    self.n_dropped += 1
+                    self._request(key, now)
+                    return None
+                deltas = np.frombuffer(body[1:8], dtype=np.int8).astype(np.int64)
+                if len(deltas) != 7:
+                    raise ValueError("Delta is truncated.")
+                state.time_step += int(deltas[0])
+                period = 1 << self.message_cls._time_bits
+                ticks = (_ticks(state.record) + state.time_step) % period
+                values = _values(state.record) + deltas[1:]
+                record = state.record.copy()
+                record["time_index"] = (
+                    _largest_index(state.record) << self.message_cls._time_bits
+                ) | ticks
+                record["orientation"] = values[:3]
+                record["position"] = values[3:]
+                state.record = record
+                state.sequence = sequence
+        except Exception as e:
+            raise DeserializeError() from e
+
+        content = self.message_cls.dequantize(state.record)[0]
+        return self.message_cls(content, sender, topic)
+
+    def _request(self, key: tuple, now: Optional[float]):
+        now = time.monotonic() if now is None else now
+        last = self._requested.get(key)
+        if last is None or now - last >= self.request_interval:
+            self._pending.add(key)
+            self._requested[key] = now
+
+    def expand(self, message: bytes) -> Optional[bytes]:
+        """
+        Replace delta encoded messages, also within a BatchMessage, by QuantizedTimeOrientPosMessages.
+
+        Consumers of the result need no decoder state.
+
+        :param message: A received serialized message.
+        :return: The serialized message or None if nothing is left after dropping undecodable deltas.
+        """
+        try:
+            topic, sender, _ = Message.parse_header(message)
+            if topic == Topic.DELTA:
+                decoded = self.decode(message)
+                return None if decoded is None else decoded.serialize()
+            if topic != Topic.BATCH:
+                return message
+            entries = BatchMessage.from_bytes(message).content
+        except DeserializeError:
+            return message
+        if not any(entry[0] == topic_id(Topic.DELTA) for entry in entries):
+            return message
+        expanded = []
+        for entry in entries:
+            entry = self.expand(bytes(entry))
+            if entry is not None:
+                expanded.append(entry)
+        if not expanded:
+            return None
+        return BatchMessage(expanded, sender).serialize()
+
+    def keyframe_request(self, sender: int) -> Optional[KeyframeRequest]:
+        """
+        The streams that need a keyframe since the last call.
+
+        :param sender: Address of the basestation.
+        :return: The request to broadcast or None.
+        """
+        if not self._pending:
+            return None
+        request = KeyframeRequest(sorted(self._pending), sender)
+        self._pending.clear()
+        return request
@@ -2,12 +2,46 @@
 # -*- coding: UTF-8 -*-
 
 # import RPi.GPIO as GPIO
+import hashlib
+import json
 import logging
+import os
+import random
+import select
 import serial
+import threading
 import time
 
-
-from enum import Enum
+from collections import deque
+
+from typing import NamedTuple, Optional
+
+import metrics
+from airtime import split_time_on_air
+from fragment import SINGLE_HEADER_LEN, Fragmenter, Reassembler
+from framing import DELIMITER, FrameDecoder, encode_frame, max_payload_len
+# the register map and its enums are also available from this module
+from registers import (
+    CFG_HEADER,
+    KEY_REG,
+    NOISE_HEADER,
+    NOISE_REG,
+    NUM_REG,
+    PERSISTENT_CFG_HEADER,
+    RET_HEADER,
+    START_REG,
+    AirSpeed,
+    BaudRate,
+    ConfigError,
+    PacketLen,
+    ParityBit,
+    TransmitPower,
+    WORMode,
+    WORPeriod,
+    changed_registers,
+    command_to_dict,
+    serialize_config,
+)
 
 try:
     import RPi.GPIO as GPIO
@@ -53,324 +87,92 @@ except ImportError:
 # RET_REG = [b'\xC1\x00\x09\x01\x02\x03\x62\x00\x41\x03\x00\x00']
 
 
-CFG_HEADER = 0xC2  # Header to use if we want to set registers.
-RET_HEADER = 0xC1  # Header of the answer after registers have been set. Use it to check if set was successful.
-START_REG = 0x00  # begin with the first register
-NUM_REG = 0x09  # set 9 registers
-
-
-class BaudRate(Enum):
-    BR_1200 = 0b000
-    BR_2400 = 0b001
-    BR_4800 = 0b010
-    BR_9600 = 0b011
-    BR_19200 = 0b100
-    BR_38400 = 0b101
-    BR_57600 = 0b110
-    BR_115200 = 0b111
-
-
-class ParityBit(Enum):
-    PB_8N1 = 0b00
-    PB_8O1 = 0b01
-    PB_8E1 = 0b10
-
-
-class AirSpeed(Enum):
-    AS_0_3K = 0b000
-    AS_1_2K = 0b001
-    AS_2_4K = 0b010
-    AS_4_8K = 0b011
-    AS_9_6K = 0b100
-    AS_19_2K = 0b101
-    AS_38_4K = 0b110
-    AS_62_5K = 0b111
-
-
-class PacketLen(Enum):
-    PL_240B = 0b00
-    PL_128B = 0b01
-    PL_64B = 0b10
-    PL_32B = 0b11
-
-
-class TransmitPower(Enum):
-    TP_22dBm = 0b00
-    TP_17dBm = 0b01
-    TP_12dBm = 0b10
-    TP_10dBm = 0b11
-
-
-class WORMode(Enum):
-    WOR_transmit = 0b0
-    WOR_listen = 0b1
-
-
-class WORPeriod(Enum):
-    WP_500ms = 0b000
-    WP_1000ms = 0b001
-    WP_1500ms = 0b010
-    WP_2000ms = 0b011
-    WP_2500ms = 0b100
-    WP_3000ms = 0b101
-    WP_3500ms = 0b110
-    WP_4000ms = 0b111
-
-
-def serialize_config(config):
-    command = [0] * 12
-
-    # set header
-    command[0] = CFG_HEADER
-    command[1] = START_REG
-    command[2] = NUM_REG
-
-    # set registers
-    command[3] = make_reg_00h_byte(config["module_address"])
-    command[4] = make_reg_01h_byte(config["module_address"])
-    command[5] = make_reg_02h_byte(config["net_id"])
-    command[6] = make_reg_03h_byte(
-        config["baud_rate"], config["parity_bit"], config["air_speed"]
-    )
-    command[7] = make_reg_04h_byte(
-        config["packet_len"], config["enable_ambient_noise"], config["transmit_power"]
-    )
-    command[8] = make_reg_05h_byte(config["channel"])
-    command[9] = make_reg_06h_byte(
-        config["enable_RSSI_byte"],
-        config["enable_point_to_point_mode"],
-        config["enable_relay_function"],
-        config["enable_LBT"],
-        config["WOR_mode"],
-        config["WOR_period"],
-    )
-    command[10] = make_reg_07h_byte(config["key"])
-    command[11] = make_reg_08h_byte(config["key"])
-
-    return bytes(command)
-
-
-def make_reg_00h_byte(module_address: int) -> int:
-    """
-    Make the high bits of the module address.
-
-    Note that when module address is 0xFFFF (=65535), it works as broadcasting and listening address
-    and LoRa module doesn't filter address anymore.
-
-    from node_100_main.py:
-    under the same frequence,if set 65535,the node can receive
-    messages from another node of address is 0 to 65534 and similarly,
-    the address 0 to 65534 of node can receive messages while
-    the another note of address is 65535 sends.
-    otherwise two node must be same the address and frequence
-
-    :param module_address: The address of the module.
-    :return: High bits of address.
-    """
-
-    assert 0 <= module_address < 2 ** 16
-    address_str = format(module_address, "016b")
-    assert len(address_str) == 16
-    return int(address_str[:8], 2)
-
-
-def make_reg_01h_byte(module_address: int) -> int:
-    """
-    Make the low bits of the module address.
-
-    Note that when module address is 0xFFFF (=65535), it works as broadcasting and listening address
-    and LoRa module doesn't filter address anymore.
-
-    from node_100_main.py:
-    under the same frequence,if set 65535,the node can receive
-    messages from another node of address is 0 to 65534 and similarly,
-    the address 0 to 65534 of node can receive messages while
-    the another note of address is 65535 sends.
-    otherwise two node must be same the address and frequence
-
-    :param module_address: The address of the module.
-    :return: Low bits of address.
-    """
-
-    assert 0 <= module_address < 2 ** 16
-    address_str = format(module_address, "016b")
-    assert len(address_str) == 16
-    return int(address_str[8:], 2)
-
-
-def make_reg_02h_byte(net_id: int) -> int:
-    """
-    Make (check) Network ID.
-
-    net_id is used to distinguish networks.
-    If you want communication between two modules, you need to set their net_id to same ID.
-
-    :param net_id: The network ID.
-    :return: The network ID.
-    """
-
-    if 0 <= net_id <= 256 and type(net_id) == int:
-        return net_id
-    else:
-        raise ValueError(f"net_id must be an int between 0 and 256, but was {net_id}.")
-
-
-def make_reg_03h_byte(
-    baud_rate: BaudRate, parity_bit: ParityBit, air_speed: AirSpeed
-) -> int:
-    """
-    Make the byte for REG0.
-
-    baud rate(7-5), parity bit(4-3), wireless air speed / bps (2-0)
-
-    :param baud_rate: The baud rate for the serial connection. Must be equal on the Pi's side and on the hat's side.
-    Possible values are: 1200, 2400, 4800, 9600, 19200, 38400, 57600, 115200
-    :param parity_bit: The parity bit. Possible values are: '8N1', '8O1', '8E1'
-    :param air_speed: The air speed. Higher the speed, smaller the latency and shorter the communicating distance.
-    Possible values are: '0.3K', '1.2K', '2.4K', '4.8K', '9.6K', '19.2K', '38.4K', '62.5K'
-    :return: The value for REG0.
-    """
-
-    baud_rate_shift = 5
-    parity_bit_shift = 3
-
-    return (
-        (baud_rate.value << baud_rate_shift)
-        | (parity_bit.value << parity_bit_shift)
-        | air_speed.value
-    )
-
-
-def make_reg_04h_byte(
-    packet_len: PacketLen, enable_ambient_noise: bool, transmit_power: TransmitPower
-) -> int:
-    """
-    Make the byte for REG1.
-
-    packet_len(7-6), enable_ambient_noise(5), transmit_power(1-0) (reserved / unused: (4-2))
-
-    :param packet_len: The size of packages in bytes. If size is exceeded messages are split.
-    Possible values are: 240, 128, 64, 32
-    :param enable_ambient_noise: After enabling, you can send command 0xC0 0xC1 0xC2 0xC3 to read register
-    in Transmit Mode or WOR Mode.
-    :param transmit_power: The transmit power. Possible values are: '22dBm', '17dBm', '12dBm', '10dBm'
-    :return: The value for REG1.
-    """
-
-    packet_len_shift = 6
-    ambient_noise_shift = 5
-
-    return (
-        (packet_len.value << packet_len_shift)
-        | (int(enable_ambient_noise) << ambient_noise_shift)
-        | transmit_power.value
-    )
-
-
-def make_reg_05h_byte(channel: int) -> int:
-    """
-    Make the byte for REG2 (channel)
-
-    Channel control (CH) 0-83. 84 channels in total
-
-    18 default for SX1262, 23 default for SX1268
-
-    850.125 + CH *1MHz. Default 868.125MHz(SX1262),
-    410.125 + CH *1MHz. Default 433.125MHz(SX1268)
-
-    :param channel: The channel.
-    :return: The channel / value for REG2.
-    """
-
-    if 0 <= channel <= 83:
-        return channel
-    else:
-        raise RuntimeError(
-            f"Invalid channel, channel must be between 0-83, but was {channel}."
-        )
-
-
-def make_reg_06h_byte(
-    enable_RSSI_byte: bool,
-    enable_point_to_point_mode: bool,
-    enable_relay_function: bool,
-    enable_LBT: bool,
-    WOR_mode: WORMode,
-    WOR_period: WORPeriod,
-) -> int:
+# A packet is considered complete once the UART has been idle for this many character times.
+IDLE_GAP_CHARS = 5
+# Lower bound for the idle gap, covers scheduling jitter and the UART FIFO timeout at high baud rates.
+MIN_IDLE_GAP = 0.005
+# Size of the module's serial buffer. Data written while it is full is lost.
+MODULE_BUFFER_SIZE = 1000
+# Time the module needs to switch its mode.
+MODE_SWITCH_DELAY = 0.1
+# Time to wait for the answer to a register command.
+CONFIG_TIMEOUT = 1.0
+# Answer to a noise RSSI request for NOISE_REG and the RSSI of the last packet.
+NOISE_ANSWER = bytes([RET_HEADER, NOISE_REG, 2])
+# Largest exponent of the random backoff of listen before talk, in units of the packet's time on air.
+CSMA_MAX_EXPONENT = 6
+# Interval in seconds at which listen checks its event.
+LISTEN_INTERVAL = 0.01
+
+
+PACKET_LEN_BYTES = {
+    PacketLen.PL_240B: 240,
+    PacketLen.PL_128B: 128,
+    PacketLen.PL_64B: 64,
+    PacketLen.PL_32B: 32,
+}
+
+# The module does not document its LoRa modulation parameters. These (spreading factor, bandwidth in Hz) pairs
+# have a raw bit rate close to the nominal air speed and are used to estimate the time on air.
+AIR_SPEED_MODULATION = {
+    AirSpeed.AS_0_3K: (12, 125000),  # 293 bps
+    AirSpeed.AS_1_2K: (11, 250000),  # 1074 bps
+    AirSpeed.AS_2_4K: (11, 500000),  # 2148 bps
+    AirSpeed.AS_4_8K: (10, 500000),  # 3906 bps
+    AirSpeed.AS_9_6K: (9, 500000),  # 7031 bps
+    AirSpeed.AS_19_2K: (7, 500000),  # 21875 bps
+    AirSpeed.AS_38_4K: (6, 500000),  # 37500 bps
+    AirSpeed.AS_62_5K: (5, 500000),  # 62500 bps
+}
+
+# shared by all drivers of the process, see metrics.py
+_tx_bytes = metrics.counter("lora_tx_bytes_total", "Bytes written to the module.")
+_tx_packets = metrics.counter("lora_tx_packets_total", "Packets written to the module.")
+_tx_messages = metrics.counter("lora_tx_messages_total", "Messages sent with send_message.")
+_tx_wait = metrics.histogram("lora_tx_wait_seconds", "Time writes were held back for the module's buffer.")
+_rx_bytes = metrics.counter("lora_rx_bytes_total", "Bytes read from the module.")
+_rx_packets = metrics.counter("lora_rx_packets_total", "Packets read from the module.")
+_rx_messages = metrics.counter("lora_rx_messages_total", "Reassembled messages.")
+_frame_errors = metrics.counter("lora_frame_errors_total", "Received bytes that did not form a valid frame.")
+_config_time = metrics.histogram("lora_config_seconds", "Duration of configuration handshakes.")
+_rssi = metrics.gauge("lora_rx_rssi_dbm", "RSSI of the last received packet.")
+_noise_rssi = metrics.gauge("lora_noise_rssi_dbm", "Last sampled ambient noise.")
+_csma_samples = metrics.counter("lora_csma_samples_total", "Channel samples of listen before talk.")
+_csma_busy = metrics.counter("lora_csma_busy_total", "Channel samples above the noise threshold.")
+_csma_forced = metrics.counter("lora_csma_forced_total", "Transmissions on a busy channel after the maximum delay.")
+_csma_wait = metrics.histogram("lora_csma_wait_seconds", "Time transmissions were deferred by listen before talk.")
+
+
+def rssi_to_dbm(value: int) -> int:
+    """Convert an RSSI byte of the module to dBm."""
+    return -(256 - value)
+
+
+def split_rssi(data: bytes):
     """
-    Make the byte for REG3.
-
-    enable_RSSI_byte(7), enable_point_to_point_mode(6), enable_relay_function(5), enable_LBT(4), WOR_mode(3), WOR_period (2-0)
-
-    :param enable_RSSI_byte: After enabling, data sent to serial port is added with a RSSI byte after receiving.
-    :param enable_point_to_point_mode: When point to point transmitting, module will recognize the first three byte as
-    Address High + Address Low + Channel and wireless transmit it. Default: False = transparent mode
-    :param enable_relay_function: If target address is not module itself, module will forward data.
-    To avoid data echo, we recommend you to use this function in point to point mode,
-    that is target address is different with source address.
-    :param enable_LBT: Module will listen before transmit wireless data.
-    This function can be used to avoid interference, however, it also clause longer latency.
-    The MAX LBT time is 2s, after 2s, data is forced to transmit.
-    :param WOR_mode: (Wake over Radio?). This setting only work for Mode 1.
-    Receiver waits for 1000ms after receive wireless data and forward,and then enter WOR mode again.
-    User can send data to serial port and forward via wireless network during this interval.
-    Every serial byte will refresh this interval time (1000ms).
-    You much send the first byte in 1000ms.
-    0 -> WOR transmit (default) Module is enabled to receive/transmit, and wakeup code is added to transmitted data.
-    1 -> WOR Sender Module is disable to send data. Module is working in WOR listen mode. Consumption is reduced
-    :param WOR_period: This setting only work for Mode 1; Longer the Period time of WOR listen,
-    lower the average consumption, however, longer the latency The settings of receiver and sender must be same.
-    Possible values are: 500, 1000, 1500, 2000, 2500, 3000, 3500, 4000
-    :return: The value for REG3.
-    """
-
-    RSSI_byte_shift = 7
-    point_to_point_mode_shift = 6
-    relay_function_shift = 5
-    LBT_shift = 4
-    WOR_mode_shift = 3
+    Remove the RSSI bytes of framed packets that were read at once.
 
-    return (
-        (int(enable_RSSI_byte) << RSSI_byte_shift)
-        | (int(enable_point_to_point_mode) << point_to_point_mode_shift)
-        | (int(enable_relay_function) << relay_function_shift)
-        | (int(enable_LBT) << LBT_shift)
-        | (WOR_mode.value << WOR_mode_shift)
-        | WOR_period.value
-    )
+    Every packet sent with send_frame ends with a frame delimiter, so with enable_RSSI_byte the RSSI byte
+    of a packet is a single byte between frame delimiters. An encoded frame is at least 3 bytes long.
 
-
-def make_reg_07h_byte(key: int) -> int:
+    :param data: Bytes as read from the serial port.
+    :return: The data without RSSI bytes and the RSSI values in dBm.
     """
-    Make high bits of key.
+    segments = data.split(DELIMITER)
+    rssi = [rssi_to_dbm(s[0]) for s in segments if len(s) == 1]
+    return DELIMITER.join(b"" if len(s) == 1 else s for s in segments), rssi
 
-    This key is used to encrypting to avoid wireless data intercepted by similar modules;
-    This key is work as calculation factor when module is encrypting wireless data.
 
-    :param key: The encryption key. (0-2^16-1)
-    :return: The high bits of the key.
-    """
-    assert 0 <= key < 2 ** 16
-    key_str = format(key, "016b")
-    assert len(key_str) == 16
-    return int(key_str[:8], 2)
+class Packet(NamedTuple):
+    """A packet read from the serial port."""
 
-
-def make_reg_08h_byte(key: int) -> int:
-    """
-    Make low bits of key.
-
-    This key is used to encrypting to avoid wireless data intercepted by similar modules;
-    This key is work as calculation factor when module is encrypting wireless data.
-
-    :param key: The encryption key. (0-2^16-1)
-    :return: The high bits of the key.
-    """
-    assert 0 <= key < 2 ** 16
-    key_str = format(key, "016b")
-    assert len(key_str) == 16
-    return int(key_str[8:], 2)
+    data: bytes
+    # in dBm, None if enable_RSSI_byte is not set
+    rssi: Optional[int]
+    # time.time() at which the packet was complete, when it was read, see LoRaHatDriver.listen
+    time: float
+    # fragment message id of the message the packet completed, see receive_messages
+    message_id: Optional[int] = None
 
 
 class LoRaHatDriver:
@@ -378,7 +180,80 @@ class LoRaHatDriver:
     M0 = 22
     M1 = 27
 
-    def __init__(self, config):
+    def __init__(
+        self,
+        config,
+        port: str = "/dev/ttyS0",
+        gpio=None,
+        persist_config: bool = False,
+        config_cache: Optional[str] = None,
+        noise_interval: Optional[float] = None,
+        csma_threshold: Optional[float] = None,
+        csma_max_delay: float = 2.0,
+    ):
+        """
+        :param config: The configuration, see loraconfig.py.
+        :param port: The serial port the hat is connected to.
+        :param gpio: Module or object with the RPi.GPIO interface to switch the hat's mode.
+        Defaults to RPi.GPIO (or Mock.GPIO if it is not available).
+        :param persist_config: Write the registers with 0xC0, so the hat keeps them after a power cycle.
+        :param config_cache: Path of a file that remembers the configuration written to the hat,
+        see apply_config. None disables it.
+        :param noise_interval: Sample the ambient noise every noise_interval seconds while receiving,
+        see request_noise_rssi. Needs enable_ambient_noise. None disables it.
+        :param csma_threshold: Listen before talk in send: the channel is busy while the ambient noise is at or
+        above this RSSI in dBm. Needs enable_ambient_noise. None disables it.
+        :param csma_max_delay: Maximum time in seconds listen before talk defers a transmission.
+        """
+        if csma_threshold is not None and not config["enable_ambient_noise"]:
+            raise ConfigError("csma_threshold needs enable_ambient_noise.")
+        self.persist_config = persist_config
+        self.csma_threshold = csma_threshold
+        self.csma_max_delay = csma_max_delay
+        self.csma_stats = {"samples": 0, "busy": 0, "deferred": 0, "forced": 0, "deferred_time": 0.0}
+        self.config_cache = config_cache
+        self.noise_interval = noise_interval
+        # last sampled ambient noise in dBm and its time.time()
+        self.noise_rssi = None
+        self.noise_time = None
+        self._noise_requested = None
+        self._noise_due = None
+        # packets read while waiting for the answer to a noise request, see sense_noise, or in listen
+        self._received = deque()
+        # noise requests may be written while another thread sends
+        self._write_lock = threading.Lock()
+        # whether the hat keeps the current registers after a power cycle
+        self._config_persistent = False
+
+        try:
+            self.target_address = config["target_address"]
+        except KeyError:
+            logging.warning(
+                "target_address was not supplied in config. "
+                "Will not be able to send messages in point to point mode."
+            )
+            self.target_address = None
+
+        self.gpio = GPIO if gpio is None else gpio
+        self.gpio.setmode(self.gpio.BCM)  # https://raspberrypi.stackexchange.com/a/12967
+        self.gpio.setwarnings(False)  # suppress channel already in use warning
+        self.gpio.setup(self.M0, self.gpio.OUT)
+        self.gpio.setup(self.M1, self.gpio.OUT)
+
+        # create serial object but do not open file yet
+        self.ser = serial.Serial()
+        self.ser.port = port
+
+        self._frame_decoder = FrameDecoder()
+        self._reassembler = Reassembler()
+        # (expected end of transmission, number of bytes) of the packets written to the module
+        self._tx_queue = deque()
+        # time.monotonic() at which the last written byte has left the UART
+        self._uart_idle = None
+        self._set_config(config)
+
+    def _set_config(self, config):
+        serialize_config(config)  # validate
         self.config = config
         self.module_address = config["module_address"]
         self.net_id = config["net_id"]
@@ -397,24 +272,13 @@ class LoRaHatDriver:
         self.WOR_period = config["WOR_period"]
         self.key = config["key"]
 
-        try:
-            self.target_address = config["target_address"]
-        except KeyError:
-            logging.warning(
-                "target_address was not supplied in config. "
-                "Will not be able to send messages in point to point mode."
-            )
-            self.target_address = None
-
-        GPIO.setmode(GPIO.BCM)  # https://raspberrypi.stackexchange.com/a/12967
-        GPIO.setwarnings(False)  # suppress channel already in use warning
-        GPIO.setup(self.M0, GPIO.OUT)
-        GPIO.setup(self.M1, GPIO.OUT)
-
-        # create serial object but do not open file yet
-        self.ser = serial.Serial()
-        self.ser.port = "/dev/ttyS0"
-        self.ser.baudrate = 9600
+        # the module talks 9600 baud in configuration mode, see apply_config
+        self.ser.baudrate = int(self.baud_rate.name.split("_")[1])
+        # every fragment is sent as one frame that fills a whole radio packet
+        self.fragment_len = max_payload_len(PACKET_LEN_BYTES[self.packet_len])
+        self._fragmenter = Fragmenter(self.fragment_len)
+        # longest message that is sent in a single radio packet
+        self.packet_message_len = self.fragment_len - SINGLE_HEADER_LEN
 
     def __enter__(self):
         self.apply_config()
@@ -422,83 +286,582 @@ class LoRaHatDriver:
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.ser.close()
-        GPIO.cleanup()
+        self.gpio.cleanup()
         logging.info("Successfully shut down.")
 
     def apply_config(self):
-
-        command_bytes = serialize_config(self.config)
-        answer_bytes = bytes([RET_HEADER]) + command_bytes[1:]
-
-        # enter configuration mode
-        GPIO.output(self.M0, GPIO.LOW)
-        GPIO.output(self.M1, GPIO.HIGH)
-        time.sleep(1)
+        """
+        Open the serial port and make sure the hat runs with the configuration.
+
+        The registers are read back first and only the range that differs is written, so a restart
+        usually does not write anything. The key cannot be read back, so the key registers are written as well
+        unless config_cache says the configuration was written to the hat on this port before.
+        """
+        start = time.monotonic()
+        try:
+            self._apply_config()
+        finally:
+            _config_time.observe(time.monotonic() - start)
+
+    def _apply_config(self):
+        fingerprint = self._config_fingerprint(self.config)
+        cache = self._load_config_cache()
+        cached = cache.get(self.ser.port, {})
+        # the key cannot be read back, it is only known if this configuration has been written before
+        key_known = cached.get("fingerprint") == fingerprint
+        persistent = key_known and cached.get("persistent", False)
 
         self.ser.open()
+        self._enter_config_mode()
+        current = self.read_config_from_hat()
+        if current is None:
+            registers = (START_REG, NUM_REG)
+        else:
+            current["key"] = self.key
+            registers = changed_registers(current, self.config)
+            if not key_known:
+                # e.g. a hat that still has the key of an earlier configuration
+                start = KEY_REG if registers is None else registers[0]
+                registers = (start, NUM_REG - start)
+        if self.persist_config and (registers is not None or not persistent):
+            # persist all registers at once
+            registers = (START_REG, NUM_REG)
+
+        if registers is None:
+            logging.info("Hat already runs with the configuration, skipping write.")
+            self._config_persistent = persistent
+        elif self._write_registers(self.config, *registers, persist=self.persist_config):
+            self._config_persistent = self.persist_config
+            cache[self.ser.port] = {"fingerprint": fingerprint, "persistent": self._config_persistent}
+            self._save_config_cache(cache)
+        self._leave_config_mode()
+
+    def reconfigure(self, **changes):
+        """
+        Change settings at runtime, e.g. reconfigure(channel=20, air_speed=AirSpeed.AS_9_6K).
+
+        Only the smallest contiguous range of registers that contains all changes is written.
+        Data still buffered in the module is transmitted first, configuration mode would drop it.
+        The changes are never persisted, even with persist_config, so the hat returns to the configuration
+        after a power cycle and frequent changes, e.g. by adr.py, do not wear its flash.
+
+        :param changes: The new settings, see loraconfig.py.
+        :return: Whether the hat accepted the new configuration.
+        """
+        config = dict(self.config, **changes)
+        registers = changed_registers(self.config, config)
+        if registers is None:
+            return True
+        time.sleep(self.tx_delay(MODULE_BUFFER_SIZE))
+        start = time.monotonic()
+        self._enter_config_mode()
+        success = self._write_registers(config, *registers, persist=False)
+        self._leave_config_mode()
+        _config_time.observe(time.monotonic() - start)
+        if success:
+            self._set_config(config)
+            cache = self._load_config_cache()
+            # the hat returns to the persisted registers after a power cycle, so the cache must not skip
+            # configuration mode
+            self._config_persistent = False
+            cache[self.ser.port] = {
+                "fingerprint": self._config_fingerprint(config),
+                "persistent": self._config_persistent,
+            }
+            self._save_config_cache(cache)
+        return success
+
+    def _write_registers(self, config, start: int, length: int, persist: bool = False) -> bool:
+        header = PERSISTENT_CFG_HEADER if persist else CFG_HEADER
+        command = serialize_config(config, start, length, header)
+        logging.info(f"Writing registers {start}-{start + length - 1}.")
+        answer = bytes([RET_HEADER]) + command[1:]
+        if self._config_command(command, len(answer)) == answer:
+            logging.info("Successfully applied configuration.")
+            return True
+        logging.error("Could not apply configuration.")
+        return False
+
+    def _enter_config_mode(self):
+        # the module always talks 9600 baud in configuration mode
+        self.gpio.output(self.M0, self.gpio.LOW)
+        self.gpio.output(self.M1, self.gpio.HIGH)
+        time.sleep(MODE_SWITCH_DELAY)
+        self.ser.baudrate = 9600
         self.ser.reset_input_buffer()
 
-        if self.ser.is_open:
-            logging.info("Serial port is open, trying to write configuration.")
-            self.ser.write(command_bytes)
-            wait_counter = 0
-            while True:
-                if self.ser.in_waiting > 0:  # there is something to read
-                    time.sleep(0.1)
-                    read_buffer = self.ser.read(self.ser.in_waiting)
-                    if read_buffer == answer_bytes:
-                        logging.info("Successfully applied configuration.")
-                        # enter operation mode
-                        GPIO.output(self.M1, GPIO.LOW)
-                        time.sleep(0.01)
-                        break
-                elif wait_counter >= 100:
-                    logging.error("Could not apply configuration. Aborting.")
-                    break
-                else:
-                    time.sleep(0.1)
-                    wait_counter += 1
-
-        # afterwards set the baudrate to the just configured
-        if self.baud_rate != BaudRate.BR_9600:
-            self.ser.baudrate = int(self.baud_rate.name.split("_")[1])
-
-    def send(self, message: bytes):
+    def _leave_config_mode(self):
+        self.gpio.output(self.M1, self.gpio.LOW)
+        time.sleep(0.01)
+        self.ser.baudrate = int(self.baud_rate.name.split("_")[1])
+
+    @staticmethod
+    def _config_fingerprint(config) -> str:
+        return hashlib.sha256(serialize_config(config)).hexdigest()
+
+    def send(self, message: bytes, block: bool = False, target_address: Optional[int] = None) -> float:
+        """
+        Write a message to the module.
+
+        The write is held back while the module's buffer is filled with data that has not been transmitted yet.
+        The time on air is estimated from air speed, packet length and message size.
+
+        :param message: The message to send.
+        :param block: Wait until the message is expected to be transmitted.
+        :param target_address: Overrides the configured target_address in point to point mode.
+        :return: time.monotonic() at which the transmission is expected to be complete.
+        """
+        packet = self.make_packet(message, target_address)
+        delay = max(self.tx_delay(len(packet)), self.write_delay())
+        _tx_wait.observe(delay)
+        time.sleep(delay)
+        # the module sends queued packets back to back, the channel is sensed before it starts
+        if self.csma_threshold is not None and self.tx_delay(MODULE_BUFFER_SIZE) == 0:
+            self._listen_before_talk(len(packet))
+        with self._write_lock:
+            self.ser.write(packet)
+        _tx_bytes.inc(len(packet))
+        _tx_packets.inc()
+        tx_done = self.register_tx(len(packet))
+        if block:
+            time.sleep(max(tx_done - time.monotonic(), 0))
+        return tx_done
+
+    def make_packet(self, message: bytes, target_address: Optional[int] = None) -> bytes:
+        """
+        Make the bytes to write to the serial port for a message.
+
+        In point to point mode the target address and channel are prepended.
+
+        :param message: The message to send.
+        :param target_address: Overrides the configured target_address, e.g. 0xFFFF to broadcast.
+        :return: The bytes for the serial port.
+        """
+        if target_address is None:
+            target_address = self.target_address
         # message = message + "\r\n".encode("utf-8")
 
         if self.enable_point_to_point_mode:
             # point to point -> requires prepended target address
             # When point to point transmitting, module will recognize the
             # first three byte as Address High + Address Low + Channel. and wireless transmit it
-            if self.target_address is None:
+            if target_address is None:
                 raise RuntimeError(
                     "When sending in point to point transmitting mode "
                     "target_address has to be set in config."
                 )
-            address_header = bytearray(3)
-            address_header[0] = make_reg_00h_byte(self.target_address)
-            address_header[1] = make_reg_01h_byte(self.target_address)
-            address_header[2] = make_reg_05h_byte(self.channel)
+            address_header = target_address.to_bytes(2, "big") + bytes([self.channel])
+            message = address_header + message
+
+        return message
+
+    def receive(self, timeout: Optional[float] = None) -> bytes:
+        """
+        Wait for a packet and return its bytes without the RSSI byte, see receive_packet.
 
-            message = bytes(address_header) + message
+        :param timeout: Maximum time in seconds to wait for the first byte. None waits forever.
+        :return: The received bytes. Empty if the timeout expired before anything was received.
+        """
+        packet = self.receive_packet(timeout)
+        return b"" if packet is None else packet.data
 
-        self.ser.write(message)
+    def receive_packet(self, timeout: Optional[float] = None) -> Optional[Packet]:
+        """
+        Wait for a packet.
 
-    def receive(self) -> bytes:
+        Blocks on the serial file descriptor instead of polling, so no CPU is used while the channel is quiet.
+        The end of a packet is detected by the UART being idle for IDLE_GAP_CHARS character times
+        at the current baud rate. If enable_RSSI_byte is set, the last byte is removed and returned as rssi.
+        Answers to noise requests are removed as well, see request_noise_rssi.
+
+        :param timeout: Maximum time in seconds to wait for the first byte. None waits forever.
+        :return: The packet or None if the timeout expired before anything was received.
+        """
         if self.module_address != 0xFFFF and self.enable_point_to_point_mode:
             logging.warning(
                 "Module address is not set to 0xFFFF (broadcast address) and point to point mode is enabled. "
                 "Will only receive messages from nodes with the same module address."
             )
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._received:
+                return self._received.popleft()
+            now = time.monotonic()
+            wait = None if deadline is None else max(deadline - now, 0)
+            if self.noise_interval is not None and self.enable_ambient_noise:
+                next_sample = self._sample_noise(now)
+                wait = next_sample if wait is None else min(wait, next_sample)
+            if not self._wait_readable(wait):
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+                continue
+            packet = self._read_packet()
+            if packet is not None:
+                return packet
+
+    def _read_packet(self) -> Optional[Packet]:
+        # read until the UART is idle, None if it was only the answer to a noise request
+        idle_gap = self.idle_gap()
+        read_buffer = bytearray()
+        while True:
+            read_buffer += self.ser.read(max(self.ser.in_waiting, 1))
+            if not self._wait_readable(idle_gap):
+                break
+        data = self._parse_noise_answer(bytes(read_buffer))
+        if not data:
+            return None
+        _rx_bytes.inc(len(data))
+        _rx_packets.inc()
+        rssi = None
+        if self.enable_RSSI_byte:
+            data, rssi = data[:-1], rssi_to_dbm(data[-1])
+            _rssi.set(rssi)
+        return Packet(data, rssi, time.time())
+
+    def sense_noise(self, timeout: float = CONFIG_TIMEOUT) -> Optional[int]:
+        """
+        Sample the ambient noise and wait for the answer. Needs enable_ambient_noise.
+
+        Packets received meanwhile are kept for receive_packet, so no other thread may receive at the same time.
+
+        :param timeout: Maximum time in seconds to wait for the answer.
+        :return: The noise in dBm or None if the module did not answer.
+        """
+        self.request_noise_rssi()
+        deadline = time.monotonic() + timeout
+        while self._noise_requested is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._wait_readable(remaining):
+                return None
+            packet = self._read_packet()
+            if packet is not None:
+                self._received.append(packet)
+        return self.noise_rssi
+
+    def listen(self, duration: float, event: Optional[threading.Event] = None):
+        """
+        Wait and read the packets that arrive meanwhile, e.g. instead of time.sleep between transmissions.
+
+        Packets left in the serial buffer are only time-stamped once they are read, see Packet.time, which is too
+        late to synchronise to them (see tdma.py). Packets read here are kept for receive_packet, so no other
+        thread may receive at the same time.
+
+        :param duration: Time in seconds to wait. Reading a packet may take longer than that.
+        :param event: Return early once it is set, it is checked every LISTEN_INTERVAL seconds.
+        """
+        deadline = time.monotonic() + duration
+        while event is None or not event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if event is not None:
+                remaining = min(remaining, LISTEN_INTERVAL)
+            if self._wait_readable(remaining):
+                packet = self._read_packet()
+                if packet is not None:
+                    self._received.append(packet)
+
+    def readable(self) -> bool:
+        """Whether receive_packet returns without waiting for data, see listen."""
+        return bool(self._received) or self.ser.in_waiting > 0
+
+    def _listen_before_talk(self, n_bytes: int):
+        # defer while the channel is busy
+        start = time.monotonic()
+        n_busy = 0
         while True:
-            if self.ser.in_waiting > 0:  # there is something to read
-                time.sleep(0.1)
-                read_buffer = self.ser.read(self.ser.in_waiting)
-                return read_buffer
+            backoff = self.csma_backoff(self.sense_noise(), n_busy, n_bytes, time.monotonic() - start)
+            if backoff is None:
+                break
+            time.sleep(backoff)
+            n_busy += 1
+        self.csma_done(n_busy, time.monotonic() - start)
+
+    def csma_backoff(self, noise: Optional[int], n_busy: int, n_bytes: int, elapsed: float) -> Optional[float]:
+        """
+        Account for a channel sample of listen before talk and return the time to defer the transmission.
+
+        The backoff is random between 0 and 2 ** n_busy times the time on air of the packet. A channel that
+        is still busy after csma_max_delay or a sample without answer do not defer it.
+
+        :param noise: The sampled noise in dBm, None if the module did not answer.
+        :param n_busy: Number of busy samples before this one.
+        :param n_bytes: Size of the packet.
+        :param elapsed: Time the transmission has been deferred.
+        :return: The backoff in seconds or None to transmit now.
+        """
+        self.csma_stats["samples"] += 1
+        _csma_samples.inc()
+        if noise is None or noise < self.csma_threshold:
+            return None
+        self.csma_stats["busy"] += 1
+        _csma_busy.inc()
+        remaining = self.csma_max_delay - elapsed
+        if remaining <= 0:
+            logging.debug(f"Channel still busy after {self.csma_max_delay} s, sending anyway.")
+            self.csma_stats["forced"] += 1
+            _csma_forced.inc()
+            return None
+        slot = self.time_on_air(n_bytes)
+        return min(random.uniform(0, slot * 2 ** min(n_busy, CSMA_MAX_EXPONENT)), remaining)
+
+    def csma_done(self, n_busy: int, elapsed: float):
+        """Account for a transmission that listen before talk deferred n_busy times for elapsed seconds."""
+        if n_busy:
+            self.csma_stats["deferred"] += 1
+            self.csma_stats["deferred_time"] += elapsed
+            _csma_wait.observe(elapsed)
+
+    @property
+    def busy_ratio(self) -> float:
+        """Share of the channel samples of listen before talk that found the channel busy."""
+        samples = self.csma_stats["samples"]
+        return self.csma_stats["busy"] / samples if samples else 0.0
+
+    def request_noise_rssi(self):
+        """
+        Ask the module for the ambient noise without waiting for the answer.
+
+        The answer arrives with the received data and is picked out by receive_packet, which updates
+        noise_rssi and noise_time. With noise_interval, receive_packet requests samples itself.
+        Needs enable_ambient_noise.
+        """
+        with self._write_lock:
+            self.ser.write(NOISE_HEADER + bytes([NOISE_REG, 2]))
+        self._noise_requested = time.monotonic()
+
+    def _sample_noise(self, now: float) -> float:
+        # request a sample if it is due, return the seconds until something has to be done
+        if self._noise_requested is not None and now - self._noise_requested >= CONFIG_TIMEOUT:
+            logging.debug("Noise request was not answered.")
+            self._noise_requested = None
+        if self._noise_requested is None and (self._noise_due is None or now >= self._noise_due):
+            self.request_noise_rssi()
+            self._noise_due = now + self.noise_interval
+        wait = self._noise_due - now
+        if self._noise_requested is not None:
+            wait = min(wait, self._noise_requested + CONFIG_TIMEOUT - now)
+        return max(wait, 0)
+
+    def _parse_noise_answer(self, data: bytes) -> bytes:
+        # remove the answer to a pending noise request from received data
+        if self._noise_requested is None:
+            return data
+        i = data.find(NOISE_ANSWER)
+        if i < 0 or len(data) < i + len(NOISE_ANSWER) + 2:
+            return data
+        values = data[i + len(NOISE_ANSWER) : i + len(NOISE_ANSWER) + 2]
+        self.noise_rssi = rssi_to_dbm(values[0])
+        self.noise_time = time.time()
+        self._noise_requested = None
+        _noise_rssi.set(self.noise_rssi)
+        return data[:i] + data[i + len(NOISE_ANSWER) + 2 :]
+
+    def send_frame(self, payload: bytes, block: bool = False, target_address: Optional[int] = None) -> float:
+        """
+        Send a payload as a self-synchronising frame, see framing.py.
+
+        :param payload: The bytes to send, e.g. a serialized message.
+        :param block: Wait until the frame is expected to be transmitted.
+        :param target_address: Overrides the configured target_address in point to point mode.
+        :return: time.monotonic() at which the transmission is expected to be complete.
+        """
+        return self.send(encode_frame(payload), block, target_address)
+
+    def receive_frames(self, timeout: Optional[float] = None) -> list:
+        """
+        Wait for a packet and return the payloads of all frames it completes.
+
+        Partial frames are kept until the rest arrives, invalid data is dropped.
+
+        :param timeout: Maximum time in seconds to wait for the first byte. None waits forever.
+        :return: The frame payloads, may be empty.
+        """
+        return self._receive_frames(timeout)[0]
+
+    def _receive_frames(self, timeout: Optional[float]):
+        packet = self.receive_packet(timeout)
+        if packet is None:
+            return [], None
+        data = packet.data
+        if self.enable_RSSI_byte:
+            # RSSI bytes of earlier packets if several were read at once
+            data, _ = split_rssi(data)
+        n_errors = self._frame_decoder.n_errors
+        frames = self._frame_decoder.feed(data)
+        if self._frame_decoder.n_errors != n_errors:
+            _frame_errors.inc(self._frame_decoder.n_errors - n_errors)
+        return frames, packet
+
+    def send_message(self, message: bytes, block: bool = False, target_address: Optional[int] = None) -> float:
+        """
+        Send a message of any size, e.g. a serialized message.Message.
+
+        The message is split into fragments (see fragment.py) that are sent as one frame per radio packet.
+
+        :param message: The message to send.
+        :param block: Wait until the message is expected to be transmitted.
+        :param target_address: Overrides the configured target_address in point to point mode.
+        :return: time.monotonic() at which the transmission is expected to be complete.
+        """
+        for fragment in self._fragmenter.split(message):
+            tx_done = self.send_frame(fragment, target_address=target_address)
+        _tx_messages.inc()
+        if block:
+            time.sleep(max(tx_done - time.monotonic(), 0))
+        return tx_done
+
+    def receive_messages(self, timeout: Optional[float] = None, metadata: bool = False) -> list:
+        """
+        Wait for a packet and return all messages it completes.
+
+        :param timeout: Maximum time in seconds to wait for the first byte. None waits forever.
+        :param metadata: Return (message, packet) pairs. The Packet that completed the message holds
+        its RSSI, receive time and message id (see fragment.py).
+        :return: The reassembled messages, may be empty.
+        """
+        frames, packet = self._receive_frames(timeout)
+        messages = []
+        for fragment in frames:
+            message = self._reassembler.add(fragment)
+            if message is not None:
+                if metadata:
+                    message = (message, packet._replace(message_id=self._reassembler.last_message_id))
+                messages.append(message)
+        _rx_messages.inc(len(messages))
+        return messages
+
+    def idle_gap(self) -> float:
+        """
+        Time in seconds without incoming bytes after which a packet is considered complete.
+        """
+        return max(IDLE_GAP_CHARS * self.char_time(), MIN_IDLE_GAP)
+
+    def char_time(self) -> float:
+        """Time in seconds to transfer one byte over the serial port."""
+        bits_per_char = 10 if self.parity_bit == ParityBit.PB_8N1 else 11
+        return bits_per_char / self.ser.baudrate
+
+    def time_on_air(self, n_bytes: int) -> float:
+        """
+        Estimated time in seconds the module needs to transmit n_bytes written to it.
+
+        Accounts for the split into packets of packet_len bytes.
+        """
+        spreading_factor, bandwidth = AIR_SPEED_MODULATION[self.air_speed]
+        return split_time_on_air(
+            n_bytes, PACKET_LEN_BYTES[self.packet_len], spreading_factor, bandwidth
+        )
+
+    def tx_delay(self, n_bytes: int, now: Optional[float] = None) -> float:
+        """
+        Time in seconds to hold back a write of n_bytes so the module's buffer does not overflow.
+
+        :param n_bytes: Number of bytes to write.
+        :param now: Current time, defaults to time.monotonic(). Allows to run on a virtual clock.
+        """
+        if now is None:
+            now = time.monotonic()
+        while self._tx_queue and self._tx_queue[0][0] <= now:
+            self._tx_queue.popleft()
+
+        delay = 0.0
+        queued = sum(n for _, n in self._tx_queue)
+        for tx_end, n in self._tx_queue:
+            if queued + n_bytes <= MODULE_BUFFER_SIZE:
+                break
+            queued -= n
+            delay = tx_end - now
+        return delay
+
+    def write_delay(self, now: Optional[float] = None) -> float:
+        """
+        Time in seconds to hold back the next write so the module takes it as a packet of its own.
+
+        The module splits the serial data into packets at pauses of the idle gap. Without the pause, writes
+        are joined and in point to point mode the address header of the next packet would be sent as payload.
+
+        :param now: Current time, defaults to time.monotonic(). Allows to run on a virtual clock.
+        """
+        if self._uart_idle is None:
+            return 0.0
+        if now is None:
+            now = time.monotonic()
+        return max(self._uart_idle + self.idle_gap() - now, 0.0)
+
+    def register_tx(self, n_bytes: int, now: Optional[float] = None) -> float:
+        """
+        Account for n_bytes that have just been written to the module.
+
+        :param n_bytes: Number of bytes written.
+        :param now: Current time, defaults to time.monotonic(). Allows to run on a virtual clock.
+        :return: Time at which their transmission is expected to be complete.
+        """
+        if now is None:
+            now = time.monotonic()
+        tx_start = now + n_bytes * self.char_time()
+        self._uart_idle = tx_start
+        if self._tx_queue:
+            tx_start = max(tx_start, self._tx_queue[-1][0])
+        tx_end = tx_start + self.time_on_air(n_bytes)
+        self._tx_queue.append((tx_end, n_bytes))
+        return tx_end
+
+    def _wait_readable(self, timeout: Optional[float]) -> bool:
+        if self.ser.in_waiting > 0:
+            return True
+        readable, _, _ = select.select([self.ser], [], [], timeout)
+        return bool(readable)
+
+    def read_config_from_hat(self) -> Optional[dict]:
+        """
+        Read the registers of the hat. It has to be in configuration mode with the serial port open.
+
+        :return: The configuration as returned by command_to_dict or None if the hat did not answer.
+        The key is always 0, it cannot be read.
+        """
+        command = bytes([RET_HEADER, START_REG, NUM_REG])
+        answer = self._config_command(command, len(command) + NUM_REG)
+        if answer[: len(command)] != command:
+            logging.error(f"Could not read configuration, answer was {answer.hex()}.")
+            return None
+        try:
+            return command_to_dict(answer)
+        except ConfigError as e:
+            logging.error(f"Could not parse configuration {answer.hex()}: {e}")
+            return None
 
-    def read_config_from_hat(self):
-        pass
+    def _config_command(self, command: bytes, answer_len: int) -> bytes:
+        # write a register command and read up to answer_len bytes of the answer
+        self.ser.reset_input_buffer()
+        self.ser.write(command)
+        answer = bytearray()
+        deadline = time.monotonic() + CONFIG_TIMEOUT
+        while len(answer) < answer_len:
+            if not self._wait_readable(max(deadline - time.monotonic(), 0)):
+                break
+            answer += self.ser.read(min(self.ser.in_waiting, answer_len - len(answer)) or 1)
+        return bytes(answer)
+
+    def _load_config_cache(self) -> dict:
+        if self.config_cache is None:
+            return {}
+        try:
+            with open(self.config_cache) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_config_cache(self, cache: dict):
+        if self.config_cache is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.config_cache)), exist_ok=True)
+            with open(self.config_cache, "w") as f:
+                json.dump(cache, f)
+        except OSError as e:
+            logging.warning(f"Could not write config cache {self.config_cache}: {e}")
 
     def clean_up(self):
         self.ser.close()
-        GPIO.cleanup()
+        self.gpio.cleanup()
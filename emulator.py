@@ -0,0 +1,429 @@
+"""
+Emulator of the SX126X LoRa HAT on a pseudo terminal.
+
+Every LoRaHatEmulator opens a pty whose slave end (port) replaces /dev/ttyS0, and provides a fake GPIO
+object (gpio) for the M0/M1 mode pins:
+
+    air = Air()
+    emulator = LoRaHatEmulator(air)
+    with LoRaHatDriver(lora_hat_config, port=emulator.port, gpio=emulator.gpio) as lora_hat:
+        ...
+
+Emulated are:
+- configuration mode: 0xC0/0xC2 register writes answered with 0xC1, 0xC1 register reads.
+  Registers written with 0xC0 survive power_cycle().
+- transmission mode: the noise RSSI command 0xC0 0xC1 0xC2 0xC3 (if enabled), point to point headers,
+  splitting into packets of packet_len bytes, the time on air at the configured air speed,
+  the size of the serial buffer and the RSSI byte after received packets (if enabled).
+
+Modules on the same Air receive each other's packets if channel, air speed, net id and addresses match.
+While a module transmits, the noise RSSI of the other modules on its channel is the packet RSSI.
+Packets can be dropped randomly with loss_probability. Collisions are not emulated, see simulator.py.
+"""
+
+import argparse
+import logging
+import os
+import random
+import select
+import threading
+import time
+import tty
+from collections import deque
+from typing import Optional
+
+from airtime import time_on_air
+from driver import (
+    AIR_SPEED_MODULATION,
+    CFG_HEADER,
+    MODULE_BUFFER_SIZE,
+    NOISE_HEADER,
+    NUM_REG,
+    PACKET_LEN_BYTES,
+    PERSISTENT_CFG_HEADER,
+    RET_HEADER,
+    LoRaHatDriver,
+)
+from registers import command_to_dict
+
+ERROR_ANSWER = bytes([0xFF, 0xFF, 0xFF])
+DEFAULT_REGISTERS = bytes([0x00, 0x00, 0x00, 0x62, 0x00, 0x12, 0x03, 0x00, 0x00])
+
+# The module transmits what it has buffered once the UART has been idle for this long.
+UART_IDLE_GAP = 0.003
+
+NORMAL_MODE = 0
+WOR_MODE = 1
+CONFIG_MODE = 2
+SLEEP_MODE = 3
+
+
+class FakeGPIO:
+    """Stands in for RPi.GPIO, keeps the output level of every pin."""
+
+    BCM = "BCM"
+    OUT = "OUT"
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self):
+        self.pins = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction):
+        self.pins.setdefault(pin, self.LOW)
+
+    def output(self, pin, value):
+        self.pins[pin] = value
+
+    def cleanup(self):
+        pass
+
+
+class Air:
+    """
+    The radio channel shared by emulated modules.
+
+    :param loss_probability: Probability that a receiver misses a packet.
+    :param rssi: RSSI of received packets in dBm.
+    :param noise_rssi: Ambient noise in dBm while no module transmits.
+    :param seed: Seed for the loss injection.
+    """
+
+    def __init__(
+        self,
+        loss_probability: float = 0.0,
+        rssi: int = -60,
+        noise_rssi: int = -110,
+        seed: Optional[int] = None,
+    ):
+        self.loss_probability = loss_probability
+        self.rssi = rssi
+        self.noise_rssi = noise_rssi
+        self.n_lost = 0
+        self._modules = []
+        # module -> (channel, time.monotonic() at the end of its transmission)
+        self._transmissions = {}
+        self._random = random.Random(seed)
+
+    def add(self, module):
+        self._modules.append(module)
+
+    def remove(self, module):
+        self._modules.remove(module)
+
+    def transmit(self, sender, channel: int, duration: float):
+        """Occupy the channel for the time on air of a packet."""
+        self._transmissions[sender] = (channel, time.monotonic() + duration)
+
+    def noise(self, module, channel: int) -> int:
+        """The noise RSSI a module measures on a channel."""
+        now = time.monotonic()
+        for other, (other_channel, end) in list(self._transmissions.items()):
+            if other is not module and other_channel == channel and end > now:
+                return self.rssi
+        return self.noise_rssi
+
+    def deliver(self, sender, packet: bytes, target_address: Optional[int], channel: int):
+        for module in list(self._modules):
+            if module is sender or not module.can_receive(sender, target_address, channel):
+                continue
+            if self._random.random() < self.loss_probability:
+                self.n_lost += 1
+                continue
+            module.receive(packet, self.rssi)
+
+
+class _UartMessage:
+    # bytes written to the module without a pause, in point to point mode they share a header
+    def __init__(self, data: bytes):
+        self.data = bytearray(data)
+        self.header = None
+
+
+class LoRaHatEmulator:
+    """
+    One emulated LoRa hat.
+
+    :param air: The channel to transmit on.
+    :param registers: Initial register values REG0-REG8.
+    :param auto_config: Also accept register commands in transmission mode.
+    Needed if the driver runs in another process and cannot switch the mode via gpio.
+    """
+
+    def __init__(
+        self, air: Air, registers: bytes = DEFAULT_REGISTERS, auto_config: bool = False
+    ):
+        self.air = air
+        self.registers = bytearray(registers)
+        self.persistent_registers = bytearray(registers)
+        self.auto_config = auto_config
+        self.gpio = FakeGPIO()
+        self.n_sent = 0
+        self.n_received = 0
+        self.n_overflow = 0  # bytes dropped because the serial buffer was full
+        self.last_rssi = None
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self.port = os.ttyname(self._slave)
+
+        self._config = None
+        self._lock = threading.Condition()
+        self._messages = deque()
+        self._n_buffered = 0
+        self._last_rx = 0.0
+        self._running = True
+        self._threads = [
+            threading.Thread(target=self._uart_loop, daemon=True),
+            threading.Thread(target=self._radio_loop, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        air.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.air.remove(self)
+        self._running = False
+        with self._lock:
+            self._lock.notify_all()
+        for thread in self._threads:
+            thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def power_cycle(self):
+        """Restore the registers last written with 0xC0 and drop buffered data."""
+        with self._lock:
+            self.registers[:] = self.persistent_registers
+            self._config = None
+            self._messages.clear()
+            self._n_buffered = 0
+
+    @property
+    def mode(self) -> int:
+        m0 = self.gpio.pins.get(LoRaHatDriver.M0, FakeGPIO.LOW)
+        m1 = self.gpio.pins.get(LoRaHatDriver.M1, FakeGPIO.LOW)
+        return int(m0 == FakeGPIO.HIGH) | int(m1 == FakeGPIO.HIGH) << 1
+
+    @property
+    def config(self) -> dict:
+        """The current registers as config dict."""
+        if self._config is None:
+            self._config = command_to_dict(
+                bytes([RET_HEADER, 0x00, NUM_REG]) + self.registers
+            )
+        return self._config
+
+    def can_receive(self, sender, target_address: Optional[int], channel: int) -> bool:
+        if self.mode not in (NORMAL_MODE, WOR_MODE):
+            return False
+        config = self.config
+        sender_config = sender.config
+        if (
+            config["channel"] != channel
+            or config["air_speed"] != sender_config["air_speed"]
+            or config["net_id"] != sender_config["net_id"]
+        ):
+            return False
+        address = config["module_address"]
+        if target_address is None:
+            # transparent mode, modules with the same address communicate
+            target_address = sender_config["module_address"]
+        return 0xFFFF in (address, target_address) or address == target_address
+
+    def receive(self, packet: bytes, rssi: int):
+        """Output a packet received over the air on the serial port."""
+        self.last_rssi = rssi
+        if self.config["enable_RSSI_byte"]:
+            packet = packet + bytes([256 + rssi])
+        try:
+            os.write(self._master, packet)
+            self.n_received += 1
+        except BlockingIOError:
+            logging.debug("Emulator serial output is full, dropping received packet.")
+
+    def _write(self, data: bytes):
+        try:
+            os.write(self._master, data)
+        except BlockingIOError:
+            logging.debug("Emulator serial output is full, dropping answer.")
+
+    def _uart_loop(self):
+        command = bytearray()
+        while self._running:
+            readable, _, _ = select.select([self._master], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except BlockingIOError:
+                continue
+            if self.mode == CONFIG_MODE:
+                command += data
+                command = self._handle_commands(command)
+            elif data.startswith(NOISE_HEADER):
+                self._handle_noise_command(data)
+            elif self.auto_config and data[0] in (
+                CFG_HEADER,
+                PERSISTENT_CFG_HEADER,
+                RET_HEADER,
+            ):
+                self._handle_commands(bytearray(data))
+            elif self.mode == NORMAL_MODE:
+                self._buffer(data)
+
+    def _handle_commands(self, buffer: bytearray) -> bytearray:
+        while len(buffer) >= 3:
+            header, start, length = buffer[:3]
+            if header in (CFG_HEADER, PERSISTENT_CFG_HEADER):
+                if len(buffer) < 3 + length:
+                    break
+                if start + length > len(self.registers):
+                    self._write(ERROR_ANSWER)
+                else:
+                    with self._lock:
+                        self.registers[start : start + length] = buffer[3 : 3 + length]
+                        if header == PERSISTENT_CFG_HEADER:
+                            self.persistent_registers[:] = self.registers
+                        self._config = None
+                    self._write(bytes([RET_HEADER]) + buffer[1 : 3 + length])
+                del buffer[: 3 + length]
+            elif header == RET_HEADER:
+                if start + length > len(self.registers):
+                    self._write(ERROR_ANSWER)
+                else:
+                    self._write(
+                        bytes([RET_HEADER, start, length])
+                        + self.registers[start : start + length]
+                    )
+                del buffer[:3]
+            else:
+                self._write(ERROR_ANSWER)
+                buffer.clear()
+        return buffer
+
+    def _handle_noise_command(self, data: bytes):
+        if not self.config["enable_ambient_noise"] or len(data) < 6:
+            self._write(ERROR_ANSWER)
+            return
+        start, length = data[4], data[5]
+        values = bytes(
+            [
+                256 + self.air.noise(self, self.config["channel"]),
+                0 if self.last_rssi is None else 256 + self.last_rssi,
+            ]
+        )
+        self._write(bytes([RET_HEADER, start, length]) + values[start : start + length])
+
+    def _buffer(self, data: bytes):
+        with self._lock:
+            space = MODULE_BUFFER_SIZE - self._n_buffered
+            if len(data) > space:
+                logging.debug(f"Emulator serial buffer is full, dropping {len(data) - space} bytes.")
+                self.n_overflow += len(data) - space
+                data = data[:space]
+            if not data:
+                return
+            now = time.monotonic()
+            if self._messages and now - self._last_rx < UART_IDLE_GAP:
+                self._messages[-1].data += data
+            else:
+                self._messages.append(_UartMessage(data))
+            self._n_buffered += len(data)
+            self._last_rx = now
+            self._lock.notify()
+
+    def _next_packet(self):
+        # called with self._lock held, returns (payload, header, number of buffered bytes consumed)
+        while self._running:
+            if not self._messages:
+                self._lock.wait()
+                continue
+            config = self.config
+            packet_len = PACKET_LEN_BYTES[config["packet_len"]]
+            message = self._messages[0]
+            complete = (
+                len(self._messages) > 1
+                or time.monotonic() - self._last_rx >= UART_IDLE_GAP
+            )
+            needs_header = config["enable_point_to_point_mode"] and message.header is None
+            if not complete and len(message.data) < 3 * needs_header + packet_len:
+                self._lock.wait(UART_IDLE_GAP)
+                continue
+
+            consumed = 0
+            if needs_header:
+                message.header = bytes(message.data[:3])
+                del message.data[:3]
+                consumed += 3
+            payload = bytes(message.data[:packet_len])
+            del message.data[:packet_len]
+            consumed += len(payload)
+            if complete and not message.data:
+                self._messages.popleft()
+            if payload:
+                return payload, message.header, consumed
+            self._n_buffered -= consumed
+        return None
+
+    def _radio_loop(self):
+        while self._running:
+            with self._lock:
+                packet = self._next_packet()
+            if packet is None:
+                continue
+            payload, header, consumed = packet
+
+            config = self.config
+            if header is None:
+                target_address = None
+                channel = config["channel"]
+            else:
+                target_address = header[0] << 8 | header[1]
+                channel = header[2]
+            spreading_factor, bandwidth = AIR_SPEED_MODULATION[config["air_speed"]]
+            n_bytes_on_air = len(payload) + (0 if header is None else len(header))
+            duration = time_on_air(n_bytes_on_air, spreading_factor, bandwidth)
+            self.air.transmit(self, channel, duration)
+            time.sleep(duration)
+
+            self.air.deliver(self, payload, target_address, channel)
+            self.n_sent += 1
+            with self._lock:
+                self._n_buffered -= consumed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Emulate LoRa hats on pseudo terminals. "
+        "Drivers in other processes cannot switch the mode, register commands are accepted in any mode."
+    )
+    parser.add_argument("-n", "--n-hats", type=int, default=2)
+    parser.add_argument("--loss", type=float, default=0.0, help="packet loss probability")
+    parser.add_argument("--rssi", type=int, default=-60, help="RSSI of packets in dBm")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    air = Air(loss_probability=args.loss, rssi=args.rssi)
+    emulators = [LoRaHatEmulator(air, auto_config=True) for _ in range(args.n_hats)]
+    for emulator in emulators:
+        print(emulator.port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for emulator in emulators:
+            emulator.close()
@@ -0,0 +1,171 @@
+"""
+Fragmentation of payloads that do not fit into a single radio packet.
+
+Most messages fit into a single packet, they start with a 2 byte header:
+
+    1 (bit 15) | message id (bits 0-14)
+
+Fragments of longer messages start with a 6 byte header:
+
+    0 (bit 15) | message id (bits 0-14) | sender (uint16) | fragment index (uint8) | fragment count (uint8)
+
+The basestation receives the fragments of many nodes interleaved, so incomplete messages are kept per sender.
+The radio does not tell who sent a packet and the module addresses of the nodes may all be the same, so the
+sender is a random id per Fragmenter unless it is given. The message id starts at a random value per Fragmenter
+and counts modulo 2**15, see MESSAGE_ID_MASK.
+"""
+
+import logging
+import random
+import struct
+import time
+from collections import OrderedDict
+from typing import Optional
+
+_single_header = struct.Struct(">H")
+_header = struct.Struct(">HHBB")
+SINGLE_HEADER_LEN = _single_header.size
+HEADER_LEN = _header.size
+MAX_FRAGMENTS = 255
+MESSAGE_ID_MASK = 0x7FFF
+_SINGLE_FLAG = 0x8000
+
+
+class Fragmenter:
+    """
+    Splits payloads into fragments of at most fragment_len bytes (header included).
+
+    Payloads of up to fragment_len - SINGLE_HEADER_LEN bytes are not split.
+
+    :param fragment_len: Maximum length of a fragment.
+    :param sender: Sender id in the fragment header, random if None.
+    """
+
+    def __init__(self, fragment_len: int, sender: Optional[int] = None):
+        if fragment_len <= HEADER_LEN:
+            raise ValueError(
+                f"fragment_len must be larger than the header ({HEADER_LEN} bytes), but was {fragment_len}."
+            )
+        self.fragment_len = fragment_len
+        self.sender = random.getrandbits(16) if sender is None else sender
+        self._next_id = random.getrandbits(15)
+
+    def split(self, data: bytes) -> list:
+        """
+        Split data into fragments.
+
+        All fragments but the last one have exactly fragment_len bytes.
+
+        :param data: The payload.
+        :return: The fragments, in order.
+        """
+        message_id = self._next_id
+        if len(data) <= self.fragment_len - SINGLE_HEADER_LEN:
+            self._next_id = (self._next_id + 1) & MESSAGE_ID_MASK
+            return [_single_header.pack(_SINGLE_FLAG | message_id) + data]
+
+        chunk_len = self.fragment_len - HEADER_LEN
+        count = -(-len(data) // chunk_len)
+        if count > MAX_FRAGMENTS:
+            raise ValueError(
+                f"Payload of {len(data)} bytes needs more than {MAX_FRAGMENTS} fragments."
+            )
+        self._next_id = (self._next_id + 1) & MESSAGE_ID_MASK
+        return [
+            _header.pack(message_id, self.sender, index, count)
+            + data[index * chunk_len : (index + 1) * chunk_len]
+            for index in range(count)
+        ]
+
+
+class _Partial:
+    def __init__(self, count: int, created: float):
+        self.count = count
+        self.created = created
+        self.fragments = {}
+        self.n_bytes = 0
+
+
+class Reassembler:
+    """
+    Puts fragments back together.
+
+    Incomplete messages are dropped once they are older than timeout or, oldest first,
+    when the buffered fragments exceed max_bytes.
+    """
+
+    def __init__(self, timeout: float = 30.0, max_bytes: int = 64 * 1024):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.n_complete = 0
+        self.n_dropped = 0
+        # message id of the last complete message, consecutive per sender
+        self.last_message_id = None
+        # (sender, message id) -> _Partial
+        self._partials = OrderedDict()
+        self._n_bytes = 0
+
+    def add(self, fragment: bytes, now: Optional[float] = None) -> Optional[bytes]:
+        """
+        Add a received fragment.
+
+        :param fragment: The fragment including its header.
+        :param now: Current time.monotonic(), for testing.
+        :return: The complete payload if this was its last missing fragment, otherwise None.
+        """
+        if len(fragment) >= SINGLE_HEADER_LEN and fragment[0] & (_SINGLE_FLAG >> 8):
+            (message_id,) = _single_header.unpack_from(fragment)
+            self.n_complete += 1
+            self.last_message_id = message_id & MESSAGE_ID_MASK
+            return fragment[SINGLE_HEADER_LEN:]
+        if len(fragment) < HEADER_LEN:
+            logging.debug("Dropping fragment without header.")
+            self.n_dropped += 1
+            return None
+        message_id, sender, index, count = _header.unpack_from(fragment)
+        if index >= count:
+            logging.debug(f"Dropping fragment {index} of {count}.")
+            self.n_dropped += 1
+            return None
+
+        data = fragment[HEADER_LEN:]
+
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+
+        key = (sender, message_id)
+        partial = self._partials.get(key)
+        if partial is not None and partial.count != count:
+            # message id has been reused after a restart
+            self._drop(key)
+            partial = None
+        if partial is None:
+            partial = self._partials[key] = _Partial(count, now)
+
+        if index not in partial.fragments:
+            partial.fragments[index] = data
+            partial.n_bytes += len(data)
+            self._n_bytes += len(data)
+
+        if len(partial.fragments) == count:
+            del self._partials[key]
+            self._n_bytes -= partial.n_bytes
+            self.n_complete += 1
+            self.last_message_id = message_id
+            return b"".join(partial.fragments[i] for i in range(count))
+
+        while self._n_bytes > self.max_bytes:
+            self._drop(next(iter(self._partials)))
+        return None
+
+    def _expire(self, now: float):
+        while self._partials:
+            key, partial = next(iter(self._partials.items()))
+            if now - partial.created < self.timeout:
+                break
+            self._drop(key)
+
+    def _drop(self, key: tuple):
+        partial = self._partials.pop(key)
+        self._n_bytes -= partial.n_bytes
+        self.n_dropped += 1
@@ -0,0 +1,154 @@
+"""
+Self-synchronising frames on top of the transparent UART stream.
+
+Each frame is COBS encoded (https://en.wikipedia.org/wiki/Consistent_Overhead_Byte_Stuffing)
+and enclosed in zero bytes:
+
+    0x00 | COBS(payload + CRC-16) | 0x00
+
+COBS removes every zero byte from the encoded data, so a zero byte always marks a frame boundary.
+A receiver that starts in the middle of the stream or sees garbage resynchronises at the next delimiter,
+and the CRC rejects frames that were cut off or corrupted on the way.
+"""
+
+import binascii
+
+DELIMITER = b"\x00"
+CRC_LEN = 2
+# Frames longer than this are dropped by the decoder, which bounds its memory use.
+MAX_FRAME_LEN = 4096
+
+
+class FrameError(ValueError):
+    """Raised if a frame could not be decoded."""
+
+    pass
+
+
+def _crc16(data: bytes) -> bytes:
+    # CRC-16/CCITT-FALSE
+    return binascii.crc_hqx(data, 0xFFFF).to_bytes(CRC_LEN, "big")
+
+
+def _cobs_encode(data: bytes) -> bytes:
+    encoded = bytearray()
+    for block in data.split(b"\x00"):
+        while len(block) >= 0xFE:
+            encoded.append(0xFF)
+            encoded += block[:0xFE]
+            block = block[0xFE:]
+        encoded.append(len(block) + 1)
+        encoded += block
+    return bytes(encoded)
+
+
+def _cobs_decode(data: bytes) -> bytes:
+    decoded = bytearray()
+    i = 0
+    n = len(data)
+    while i < n:
+        code = data[i]
+        if code == 0:
+            raise FrameError("Unexpected zero byte in COBS data.")
+        end = i + code
+        if end > n:
+            raise FrameError("COBS data is truncated.")
+        decoded += data[i + 1 : end]
+        i = end
+        if code < 0xFF and i < n:
+            decoded.append(0)
+    return bytes(decoded)
+
+
+def encode_frame(payload: bytes) -> bytes:
+    """
+    Wrap a payload into a frame.
+
+    :param payload: The bytes to send.
+    :return: The frame including leading and trailing delimiter.
+    """
+    return DELIMITER + _cobs_encode(payload + _crc16(payload)) + DELIMITER
+
+
+def decode_frame(encoded: bytes) -> bytes:
+    """
+    Unwrap the payload of a single frame.
+
+    :param encoded: The frame without delimiters.
+    :return: The payload.
+    """
+    data = _cobs_decode(encoded)
+    if len(data) < CRC_LEN:
+        raise FrameError("Frame is too short.")
+    payload, crc = data[:-CRC_LEN], data[-CRC_LEN:]
+    if _crc16(payload) != crc:
+        raise FrameError("CRC mismatch.")
+    return payload
+
+
+def frame_len(payload_len: int) -> int:
+    """Maximum number of bytes a payload of payload_len bytes occupies on the wire."""
+    n = payload_len + CRC_LEN
+    return n + n // 0xFE + 1 + 2 * len(DELIMITER)
+
+
+def max_payload_len(max_frame_len: int) -> int:
+    """Largest payload length whose frame is guaranteed to fit into max_frame_len bytes."""
+    payload_len = max_frame_len - CRC_LEN - 1 - 2 * len(DELIMITER)
+    while frame_len(payload_len) > max_frame_len:
+        payload_len -= 1
+    return payload_len
+
+
+class FrameDecoder:
+    """
+    Incremental parser that turns arbitrary chunks of the byte stream into frame payloads.
+
+    Bytes that do not form a valid frame are dropped and counted in n_errors.
+    """
+
+    def __init__(self, max_frame_len: int = MAX_FRAME_LEN):
+        self.max_frame_len = max_frame_len
+        self.n_frames = 0
+        self.n_errors = 0
+        self._buffer = bytearray()
+        self._overflow = False
+
+    def feed(self, data: bytes) -> list:
+        """
+        Add received bytes and return the payloads of all frames completed by them.
+
+        :param data: Bytes as read from the serial port.
+        :return: The payloads of the completed frames, in order.
+        """
+        frames = []
+        start = 0
+        while True:
+            end = data.find(DELIMITER, start)
+            if end < 0:
+                self._append(data[start:])
+                return frames
+            encoded = data[start:end]
+            if self._buffer or self._overflow:
+                self._append(encoded)
+                encoded = bytes(self._buffer)
+                self._buffer.clear()
+            start = end + 1
+
+            if self._overflow or len(encoded) > self.max_frame_len:
+                self._overflow = False
+                self.n_errors += 1
+            elif encoded:
+                try:
+                    frames.append(decode_frame(encoded))
+                    self.n_frames += 1
+                except FrameError:
+                    self.n_errors += 1
+
+    def _append(self, data: bytes):
+        if self._overflow:
+            return
+        self._buffer += data
+        if len(self._buffer) > self.max_frame_len:
+            self._buffer.clear()
+            self._overflow = True
@@ -0,0 +1,124 @@
+"""
+Bounded buffer between the radio receive loop and slower consumers.
+
+put never blocks and never raises: when the buffer is full, a message is dropped according to the
+DropPolicy and counted. The buffer never holds more than maxlen messages, so its memory is bounded by
+maxlen times the largest message the driver reassembles.
+
+    buffer = IngressBuffer(64, DropPolicy.LATEST_PER_SENDER)
+    buffer.put(message_bytes)        # radio thread
+    message_bytes = buffer.get()     # consumer thread
+"""
+
+import itertools
+import logging
+import threading
+from collections import OrderedDict
+from enum import Enum
+from typing import Optional
+
+from message import DeserializeError, Message
+
+
+class DropPolicy(Enum):
+    # drop the oldest buffered message, consumers see the most recent data
+    DROP_OLDEST = "drop_oldest"
+    # drop the new message, consumers see an unbroken stream up to the overload
+    DROP_NEWEST = "drop_newest"
+    # keep only the most recent message of every sender, older ones are replaced
+    LATEST_PER_SENDER = "latest_per_sender"
+
+
+class IngressBuffer:
+    """
+    Thread-safe bounded FIFO of received messages.
+
+    :param maxlen: Maximum number of buffered messages.
+    :param policy: What to drop when the buffer is full, see DropPolicy.
+    :param high_water: Depth at which a warning is logged, defaults to 3/4 of maxlen. The warning is
+    repeated after the depth fell below half of it.
+    """
+
+    def __init__(self, maxlen: int, policy: DropPolicy = DropPolicy.DROP_OLDEST, high_water: Optional[int] = None):
+        if maxlen < 1:
+            raise ValueError(f"maxlen must be positive, but was {maxlen}.")
+        self.maxlen = maxlen
+        self.policy = DropPolicy(policy)
+        self.high_water = max(1, maxlen * 3 // 4) if high_water is None else high_water
+        self.n_put = 0
+        self.n_dropped = 0
+        # messages replaced by a newer one of the same sender
+        self.n_replaced = 0
+        self.max_depth = 0
+        self._above_high_water = False
+        # keys are senders for LATEST_PER_SENDER and running numbers otherwise
+        self._messages = OrderedDict()
+        self._keys = itertools.count()
+        self._not_empty = threading.Condition()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def _key(self, message: bytes):
+        if self.policy == DropPolicy.LATEST_PER_SENDER:
+            try:
+                _, sender, _ = Message.parse_header(message)
+                return int(sender)
+            except DeserializeError:
+                pass
+        return ("message", next(self._keys))
+
+    def put(self, message: bytes) -> bool:
+        """
+        Add a message without blocking.
+
+        :return: False if the message was dropped.
+        """
+        with self._not_empty:
+            self.n_put += 1
+            key = self._key(message)
+            if key in self._messages:
+                del self._messages[key]
+                self.n_replaced += 1
+            elif len(self._messages) >= self.maxlen:
+                self.n_dropped += 1
+                if self.policy == DropPolicy.DROP_NEWEST:
+                    return False
+                self._messages.popitem(last=False)
+            self._messages[key] = message
+
+            depth = len(self._messages)
+            self.max_depth = max(self.max_depth, depth)
+            if depth >= self.high_water and not self._above_high_water:
+                self._above_high_water = True
+                logging.warning(
+                    f"Ingress buffer reached {depth} of {self.maxlen} messages, "
+                    f"{self.n_dropped} dropped so far."
+                )
+            self._not_empty.notify()
+            return True
+
+    def get(self, timeout: Optional[float] = None) -> Optional[bytes]:
+        """
+        Remove the oldest message.
+
+        :param timeout: Seconds to wait for a message, None waits forever.
+        :return: The message or None on timeout.
+        """
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: self._messages, timeout):
+                return None
+            _, message = self._messages.popitem(last=False)
+            if len(self._messages) < self.high_water // 2:
+                self._above_high_water = False
+            return message
+
+    def stats(self) -> dict:
+        with self._not_empty:
+            return {
+                "depth": len(self._messages),
+                "max_depth": self.max_depth,
+                "put": self.n_put,
+                "dropped": self.n_dropped,
+                "replaced": self.n_replaced,
+            }
@@ -0,0 +1,327 @@
+"""
+iperf-style link test between two LoRa hats.
+
+The transmit side sends sequence numbered, timestamped probe frames at a target rate or as fast as the
+driver's pacing allows. The receive side reports goodput, packet delivery ratio, one-way latency, RSSI
+(if enable_RSSI_byte is set), the noise floor (if enable_ambient_noise is set) and loss bursts.
+Every probe is one frame that fills one radio packet.
+
+    python lora_perf.py rx --duration 60                  # on the receiving node
+    python lora_perf.py tx --duration 60 --rate 2         # on the sending node
+    python lora_perf.py pair --emulate --sweep            # both sides in one process on emulated hats
+
+One-way latencies use time.time() of both hosts, so their clocks have to be synchronised, e.g. by NTP.
+The pair mode needs both hats in one process: two emulated hats on a pty pair (--emulate) or hats on
+--tx-port and --rx-port whose mode pins can be driven from this host. It can sweep AirSpeed x PacketLen.
+"""
+
+import argparse
+import json
+import struct
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+from driver import AirSpeed, LoRaHatDriver, PacketLen, split_rssi
+from framing import FrameDecoder
+from loraconfig import lora_hat_config
+
+PROBE = 0
+END = 1
+# kind, run id, sequence number (number of sent probes for END), time.time() at sending
+_probe = struct.Struct(">BHId")
+# END frames are repeated so the receiver learns the number of sent probes despite losses
+N_END_FRAMES = 3
+# seconds between noise samples of the receiver
+NOISE_INTERVAL = 1.0
+
+
+def make_probe(kind: int, run_id: int, sequence: int, size: int) -> bytes:
+    """
+    Make a probe frame payload.
+
+    :param kind: PROBE or END.
+    :param run_id: Identifies the test run, probes of other runs are ignored.
+    :param sequence: Sequence number of the probe, number of sent probes for END.
+    :param size: Payload size in bytes, padded with zeros.
+    :return: The payload.
+    """
+    probe = _probe.pack(kind, run_id, sequence, time.time())
+    return probe + bytes(max(size - len(probe), 0))
+
+
+def send_probes(
+    lora_hat: LoRaHatDriver,
+    duration: float,
+    rate: Optional[float] = None,
+    size: Optional[int] = None,
+    run_id: int = 0,
+) -> int:
+    """
+    Send probes for duration seconds.
+
+    :param lora_hat: The driver to send with.
+    :param duration: Seconds to send.
+    :param rate: Probes per second. None saturates the link, limited by the driver's pacing.
+    :param size: Probe payload size in bytes, defaults to the largest that fits into one radio packet.
+    :param run_id: Identifies the test run.
+    :return: Number of sent probes.
+    """
+    if size is None:
+        size = lora_hat.fragment_len
+    start = time.monotonic()
+    sequence = 0
+    while time.monotonic() - start < duration:
+        if rate is not None:
+            time.sleep(max(start + sequence / rate - time.monotonic(), 0))
+        tx_done = lora_hat.send_frame(make_probe(PROBE, run_id, sequence, size))
+        sequence += 1
+    for _ in range(N_END_FRAMES):
+        tx_done = lora_hat.send_frame(make_probe(END, run_id, sequence, _probe.size))
+    time.sleep(max(tx_done - time.monotonic(), 0))
+    return sequence
+
+
+class ProbeReceiver:
+    """
+    Collects received probes and computes the link statistics.
+
+    :param run_id: Only probes of this run are counted.
+    :param rssi_byte: Whether the module appends an RSSI byte to every packet.
+    """
+
+    def __init__(self, run_id: int = 0, rssi_byte: bool = False):
+        self.run_id = run_id
+        self.rssi_byte = rssi_byte
+        self.n_sent = None
+        self.n_duplicates = 0
+        self.n_bytes = 0
+        self.first_sent = None
+        self.last_received = None
+        self._sequences = []
+        self._latencies = []
+        self._rssi = []
+        self._noise = []
+        self._seen = set()
+        self._decoder = FrameDecoder()
+
+    @property
+    def done(self) -> bool:
+        """Whether the sender's END frame has been received."""
+        return self.n_sent is not None
+
+    def feed(self, data: bytes, now: Optional[float] = None, rssi: Optional[int] = None):
+        """
+        Add bytes read from the serial port.
+
+        :param data: The received bytes. With rssi_byte, RSSI bytes between frames are split off.
+        :param now: time.time() of reception.
+        :param rssi: RSSI of the packet in dBm, if the driver already removed it.
+        """
+        now = time.time() if now is None else now
+        if self.rssi_byte:
+            data, rssi_values = split_rssi(data)
+            self._rssi += rssi_values
+        if rssi is not None:
+            self._rssi.append(rssi)
+        for payload in self._decoder.feed(data):
+            if len(payload) < _probe.size:
+                continue
+            kind, run_id, sequence, sent = _probe.unpack_from(payload)
+            if run_id != self.run_id:
+                continue
+            if kind == END:
+                self.n_sent = sequence
+                continue
+            if sequence in self._seen:
+                self.n_duplicates += 1
+                continue
+            self._seen.add(sequence)
+            self._sequences.append(sequence)
+            self._latencies.append(now - sent)
+            self.n_bytes += len(payload)
+            if self.first_sent is None or sent < self.first_sent:
+                self.first_sent = sent
+            self.last_received = now
+
+    def receive(self, lora_hat: LoRaHatDriver, timeout: float):
+        """
+        Receive until the sender's END frame arrives or timeout seconds passed without it.
+        """
+        deadline = time.monotonic() + timeout
+        noise_time = lora_hat.noise_time
+        while not self.done:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            packet = lora_hat.receive_packet(timeout=remaining)
+            if packet is not None:
+                self.feed(packet.data, packet.time, packet.rssi)
+            if lora_hat.noise_time != noise_time:
+                noise_time = lora_hat.noise_time
+                self._noise.append(lora_hat.noise_rssi)
+
+    def loss_bursts(self) -> list:
+        """Lengths of the runs of consecutive lost probes."""
+        n_sent = self.n_sent
+        if n_sent is None:
+            n_sent = max(self._sequences, default=-1) + 1
+        received = np.zeros(n_sent, dtype=bool)
+        received[[s for s in self._sequences if s < n_sent]] = True
+        # boundaries of the runs of False
+        edges = np.diff(np.concatenate([[1], received.astype(np.int8), [1]]))
+        starts = np.flatnonzero(edges == -1)
+        ends = np.flatnonzero(edges == 1)
+        return (ends - starts).tolist()
+
+    def report(self) -> dict:
+        n_received = len(self._sequences)
+        n_sent = self.n_sent
+        if n_sent is None:
+            # the END frames were lost, losses at the end cannot be detected
+            n_sent = max(self._sequences, default=-1) + 1
+        bursts = self.loss_bursts()
+        result = {
+            "sent": n_sent,
+            "received": n_received,
+            "duplicates": self.n_duplicates,
+            "pdr": n_received / n_sent if n_sent else 0.0,
+            "reordered": int(np.sum(np.diff(self._sequences) < 0)) if n_received > 1 else 0,
+            "loss_bursts": len(bursts),
+            "max_loss_burst": max(bursts, default=0),
+            "frame_errors": self._decoder.n_errors,
+        }
+        if n_received:
+            result["goodput_bps"] = 8 * self.n_bytes / max(self.last_received - self.first_sent, 1e-9)
+            latencies = np.array(self._latencies)
+            for percentile in (50, 90, 99):
+                result[f"latency_p{percentile}_s"] = float(np.percentile(latencies, percentile))
+            result["latency_max_s"] = float(latencies.max())
+        if self._rssi:
+            result["rssi_mean_dbm"] = float(np.mean(self._rssi))
+            result["rssi_min_dbm"] = min(self._rssi)
+            result["rssi_max_dbm"] = max(self._rssi)
+        if self._noise:
+            result["noise_mean_dbm"] = float(np.mean(self._noise))
+            result["noise_max_dbm"] = max(self._noise)
+        return result
+
+
+def run_pair(
+    tx_config,
+    rx_config,
+    tx_port: str,
+    rx_port: str,
+    duration: float,
+    rate: Optional[float] = None,
+    size: Optional[int] = None,
+    tx_gpio=None,
+    rx_gpio=None,
+    run_id: int = 0,
+) -> dict:
+    """
+    Send probes from one hat to another in this process.
+
+    :return: The receiver's report.
+    """
+    with LoRaHatDriver(rx_config, rx_port, rx_gpio, noise_interval=NOISE_INTERVAL) as rx_hat, LoRaHatDriver(
+        tx_config, tx_port, tx_gpio
+    ) as tx_hat:
+        receiver = ProbeReceiver(run_id, rssi_byte=rx_config["enable_RSSI_byte"])
+        sender = threading.Thread(
+            target=send_probes, args=(tx_hat, duration, rate, size, run_id), daemon=True
+        )
+        sender.start()
+        # time on air of the packets still queued in the module plus the END frames
+        receiver.receive(rx_hat, duration + 2 + tx_hat.time_on_air(2000))
+        sender.join()
+    return receiver.report()
+
+
+def make_config(**kwargs):
+    config = dict(lora_hat_config, **kwargs)
+    if config["enable_point_to_point_mode"] and config.get("target_address") is None:
+        config["target_address"] = 0xFFFF
+    return config
+
+
+def print_report(report):
+    for key, value in report.items():
+        if isinstance(value, float):
+            value = f"{value:.4g}"
+        print(f"{key:>20}: {value}")
+    if report.get("frame_errors"):
+        print("warning: frames were corrupted or packets joined, the link is not lossless")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("mode", choices=["tx", "rx", "pair"])
+    parser.add_argument("--port", default="/dev/ttyS0", help="serial port in tx and rx mode")
+    parser.add_argument("--tx-port", help="serial port of the sending hat in pair mode")
+    parser.add_argument("--rx-port", help="serial port of the receiving hat in pair mode")
+    parser.add_argument("--emulate", action="store_true", help="use two emulated hats in pair mode")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to send")
+    parser.add_argument("--rate", type=float, help="probes per second, saturates the link if not set")
+    parser.add_argument("--size", type=int, help="probe size in bytes, fills a radio packet if not set")
+    parser.add_argument("--run-id", type=int, default=0)
+    parser.add_argument("--sweep", action="store_true", help="sweep AirSpeed x PacketLen in pair mode")
+    parser.add_argument("--output", help="write the reports to this JSON file")
+    args = parser.parse_args()
+
+    config = make_config()
+    reports = []
+    if args.mode == "tx":
+        with LoRaHatDriver(config, args.port) as lora_hat:
+            n_sent = send_probes(lora_hat, args.duration, args.rate, args.size, args.run_id)
+        print(f"sent {n_sent} probes")
+    elif args.mode == "rx":
+        receiver = ProbeReceiver(args.run_id, rssi_byte=config["enable_RSSI_byte"])
+        with LoRaHatDriver(config, args.port, noise_interval=NOISE_INTERVAL) as lora_hat:
+            print("waiting for probes, press Ctrl+C to stop")
+            try:
+                # the test starts with the first received data
+                packet = lora_hat.receive_packet()
+                receiver.feed(packet.data, packet.time, packet.rssi)
+                receiver.receive(lora_hat, args.duration + 10)
+            except KeyboardInterrupt:
+                pass
+        reports.append(receiver.report())
+        print_report(reports[0])
+    else:
+        if args.sweep:
+            settings = [(a, p) for a in AirSpeed for p in PacketLen]
+        else:
+            settings = [(config["air_speed"], config["packet_len"])]
+        for air_speed, packet_len in settings:
+            config = make_config(air_speed=air_speed, packet_len=packet_len)
+            if args.emulate:
+                from emulator import Air, LoRaHatEmulator
+
+                with LoRaHatEmulator(Air()) as tx_emulator, LoRaHatEmulator(tx_emulator.air) as rx_emulator:
+                    report = run_pair(
+                        config,
+                        config,
+                        tx_emulator.port,
+                        rx_emulator.port,
+                        args.duration,
+                        args.rate,
+                        args.size,
+                        tx_emulator.gpio,
+                        rx_emulator.gpio,
+                        args.run_id,
+                    )
+            else:
+                report = run_pair(
+                    config, config, args.tx_port, args.rx_port, args.duration, args.rate, args.size,
+                    run_id=args.run_id,
+                )
+            report = dict(air_speed=air_speed.name, packet_len=packet_len.name, **report)
+            reports.append(report)
+            print_report(report)
+            print()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(reports, f, indent=2)
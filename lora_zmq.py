@@ -0,0 +1,83 @@
+"""
+zmq framing of received LoRa messages.
+
+The basestation publishes every received message as a multipart message:
+
+    b"LORA/<topic>" | serialized message (| pickled Message, optional)
+
+The topic is the Topic name or the id of a user-defined topic, e.g. b"LORA/ATTITUDE" or b"LORA/42".
+Subscribers filter inside zmq: b"LORA" receives everything, b"LORA/ATTITUDE" only attitude data.
+The entries of a BatchMessage are published as separate messages.
+"""
+
+import logging
+import pickle
+
+import zmq
+
+import metrics
+from message import BatchMessage, DeserializeError, Message, Topic
+
+ZMQ_TOPIC = "LORA".encode("utf-8")
+
+_deserialize_errors = metrics.counter("lora_deserialize_errors_total", "Messages that could not be parsed.")
+
+
+def topic_frame(topic) -> bytes:
+    """The zmq topic frame of a message topic (Topic or user-defined topic id)."""
+    name = topic.name if isinstance(topic, Topic) else str(int(topic))
+    return ZMQ_TOPIC + b"/" + name.encode("utf-8")
+
+
+def make_frames(message_bytes: bytes, decoded: bool = False) -> list:
+    """
+    Make the multipart messages for a received message.
+
+    Only batches are decoded, other messages are passed on as they are.
+
+    :param message_bytes: The serialized message.
+    :param decoded: Add the pickled Message as third frame.
+    :return: List of multipart messages (lists of frames).
+    """
+    topic, _, _ = Message.parse_header(message_bytes)
+    if topic == Topic.BATCH:
+        entries = BatchMessage.from_bytes(message_bytes).content
+    else:
+        entries = [message_bytes]
+
+    multiparts = []
+    for entry in entries:
+        topic, _, _ = Message.parse_header(entry)
+        frames = [topic_frame(topic), entry]
+        if decoded:
+            frames.append(pickle.dumps(Message.decode(entry)))
+        multiparts.append(frames)
+    return multiparts
+
+
+def frames_to_publish(message_bytes: bytes, decoded: bool = False) -> list:
+    """
+    make_frames for the publishing loop of the basestation.
+
+    Messages that cannot be parsed are logged and counted in lora_deserialize_errors_total.
+
+    :return: List of multipart messages, empty if the message could not be parsed.
+    """
+    try:
+        return make_frames(message_bytes, decoded)
+    except DeserializeError as e:
+        _deserialize_errors.inc()
+        logging.error(e)
+        return []
+
+
+def make_publisher(context: zmq.Context, send_hwm: int) -> zmq.Socket:
+    """
+    Make a PUB socket that drops messages for subscribers that fall send_hwm messages behind.
+
+    PUB sockets never block on send, so a slow subscriber cannot stall the sender.
+    """
+    socket = context.socket(zmq.PUB)
+    socket.setsockopt(zmq.SNDHWM, send_hwm)
+    socket.setsockopt(zmq.LINGER, 0)
+    return socket
@@ -11,6 +11,7 @@ from driver import (
     WORMode,
     WORPeriod,
 )
+from ingress import DropPolicy
 
 # %% logging config
 log_config = {
@@ -82,11 +83,92 @@ lora_hat_config = lora_hat_default.copy()
 lora_hat_config["enable_point_to_point_mode"] = True
 lora_hat_config["air_speed"] = AirSpeed.AS_62_5K
 
+# options of LoRaHatDriver besides the registers
+lora_hat_options = {
+    # write the registers with 0xC0 so the hat keeps them after a power cycle. Wears the hat's flash.
+    "persist_config": False,
+    # remembers the configuration written to the hat, so the key registers need not be written on every start
+    "config_cache": os.path.expanduser("~/.cache/msb_lora/config_cache.json"),
+    # listen before talk in software: defer sending while the ambient noise is at or above this RSSI in dBm,
+    # needs enable_ambient_noise. None disables it, the hat's own enable_LBT is not supported by every firmware.
+    "csma_threshold": None,
+    # maximum time in seconds a transmission is deferred before it is sent on a busy channel
+    "csma_max_delay": 2.0,
+}
+
+# zmq publisher of basestation_lora.py, see lora_zmq.py
+basestation_zmq_config = {
+    # e.g. "ipc:///tmp/msb_lora_basestation" for the ipc transport
+    "socket_name": "tcp://127.0.0.1:5555",
+    # messages queued per subscriber, more are dropped so a slow subscriber cannot stall the radio loop
+    "send_hwm": 1000,
+    # add the pickled Message as third frame
+    "publish_decoded": False,
+}
+
+# buffer between the radio and the zmq publisher of basestation_lora.py, see ingress.py
+basestation_ingress_config = {
+    "maxlen": 64,
+    "policy": DropPolicy.DROP_OLDEST,
+    # log a warning at this depth, None for 3/4 of maxlen
+    "high_water": None,
+}
+
+# adaptive air speed and transmit power, see adr.py. Basestation and nodes have to agree on it.
+# The RSSI byte is needed to speed up, the configured air speed is the fallback.
+enable_adr = False
+adr_config = {
+    "target_pdr": 0.9,
+    "margin_db": 10.0,
+    "lead": 6.0,
+    "announce_interval": 2.0,
+    "fallback_timeout": 30.0,
+}
+
+# time division of the uplink, see tdma.py. Basestation and nodes have to agree on it.
+enable_tdma = False
+tdma_config = {
+    # nodes with a slot from the start, other senders get one once they are heard
+    "nodes": [150, 151, 153],
+    # full packets per slot of a node and per frame of the basestation, the beacon included
+    "packets_per_slot": 1,
+    "downlink_packets": 2,
+    # synchronisation error of the nodes' clocks in seconds, part of the guard time
+    "clock_error": 0.01,
+    # nodes send at once if they did not hear a beacon for this many seconds
+    "beacon_timeout": 10.0,
+}
+
+# delta encoding of the nodes' messages, see delta.py. Basestation and nodes have to agree on it.
+enable_delta = False
+delta_config = {
+    # maximum number of messages per stream from one keyframe to the next
+    "keyframe_interval": 10,
+    # minimum time in seconds between two keyframe requests of the basestation for the same stream
+    "request_interval": 1.0,
+}
+
+# Prometheus text endpoint of the entry points, see metrics.py. A port of None disables it.
+metrics_config = {
+    "address": "127.0.0.1",
+    "port": 9464,
+}
+
 # (Partly) overwrite with localconfig
 try:
     import localconfig
 
     lora_hat_config.update(localconfig.lora_hat_config)
+    lora_hat_options.update(getattr(localconfig, "lora_hat_options", {}))
+    basestation_zmq_config.update(getattr(localconfig, "basestation_zmq_config", {}))
+    basestation_ingress_config.update(getattr(localconfig, "basestation_ingress_config", {}))
+    metrics_config.update(getattr(localconfig, "metrics_config", {}))
+    enable_adr = getattr(localconfig, "enable_adr", enable_adr)
+    adr_config.update(getattr(localconfig, "adr_config", {}))
+    enable_tdma = getattr(localconfig, "enable_tdma", enable_tdma)
+    tdma_config.update(getattr(localconfig, "tdma_config", {}))
+    enable_delta = getattr(localconfig, "enable_delta", enable_delta)
+    delta_config.update(getattr(localconfig, "delta_config", {}))
 except ImportError:
     pass
 
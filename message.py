@@ -1,5 +1,5 @@
 import pickle
-import sys
+import time
 
 from abc import ABC, abstractmethod
 from enum import Enum, auto
@@ -11,6 +11,19 @@ class Topic(Enum):
     UNDEFINED = auto()
     IMU = auto()
     ATTITUDE = auto()
+    BATCH = auto()
+    TEXT = auto()
+    # air speed and transmit power commands of the basestation, see adr.py
+    RATE = auto()
+    # frame start and slot assignment of the basestation, see tdma.py
+    BEACON = auto()
+    # IMU and ATTITUDE in the fixed-point format of QuantizedTimeOrientPosMessage
+    QUANTIZED_IMU = auto()
+    QUANTIZED_ATTITUDE = auto()
+    # delta encoded QuantizedTimeOrientPosMessages, need the state of a delta.DeltaDecoder
+    DELTA = auto()
+    # streams the basestation needs a keyframe of, see delta.py
+    KEYFRAME_REQUEST = auto()
 
 
 # https://docs.python-guide.org/scenarios/serialization/
@@ -19,7 +32,42 @@ class Topic(Enum):
 class DeserializeError(ValueError):
     """Raised if a message could not be parsed."""
 
-    pass
+
+# topic id -> Message subclass, see register_topic
+_registry = {}
+
+
+def topic_id(topic) -> int:
+    """The id of a Topic or of a user-defined topic id."""
+    return topic.value if isinstance(topic, Topic) else int(topic)
+
+
+def topic_from_id(id_: int):
+    """The Topic with this id, or the id itself if it is a user-defined topic id."""
+    try:
+        return Topic(id_)
+    except ValueError:
+        return int(id_)
+
+
+def register_topic(topic, message_cls):
+    """
+    Decode messages with this topic as message_cls in Message.decode.
+
+    :param topic: A Topic or a user-defined topic id (int) between 0 and 127 that is not used by Topic.
+    :param message_cls: The Message subclass.
+    """
+    id_ = topic_id(topic)
+    if not 0 <= id_ < 128:
+        raise ValueError(f"topic id must be between 0 and 127, but was {id_}.")
+    if not isinstance(topic, Topic) and isinstance(topic_from_id(id_), Topic):
+        raise ValueError(f"topic id {id_} is used by {Topic(id_)}.")
+    _registry[id_] = message_cls
+
+
+def unregister_topic(topic):
+    """Undo register_topic, e.g. for a user-defined topic in a test."""
+    _registry.pop(topic_id(topic), None)
 
 
 class Message(ABC):
@@ -53,26 +101,171 @@ class Message(ABC):
         return f"{self.topic}, from {self.sender}: {self.content}"
 
     def serialize(self):
+        return self.header_bytes() + self._serialize()
+
+    @staticmethod
+    def decode(bytes_) -> "Message":
+        """
+        Deserialize a message with the Message subclass registered for its topic.
+
+        The payload is passed on as a memoryview of bytes_ and not copied.
+
+        :param bytes_: The serialized message.
+        :return: The message.
+        """
+        buffer = memoryview(bytes_)
+        try:
+            message_cls = _registry[buffer[0]]
+        except (IndexError, KeyError) as e:
+            raise DeserializeError("No Message class registered for topic.") from e
+        return message_cls.from_bytes(buffer)
+
+    def header_bytes(self) -> bytes:
+        """Topic and sender, the start of every serialized message."""
         return (
-            bytes([self.topic.value])
+            bytes([topic_id(self.topic)])
             + np.array(self.sender, dtype=self._sender_dtype).tobytes()
-            + self._serialize()
         )
 
     @classmethod
-    def from_bytes(cls, bytes_: bytes):
-        topic = Topic(bytes_[0])
+    def parse_header(cls, bytes_: bytes):
+        """
+        Parse topic and sender of a serialized message.
+
+        :return: topic (Topic or user-defined topic id), sender and the number of header bytes.
+        """
         n_bytes_sender = np.dtype(cls._sender_dtype).itemsize
-        sender = np.frombuffer(bytes_[1 : 1 + n_bytes_sender], dtype=cls._sender_dtype)[
-            0
-        ]
         try:
-            data = cls._deserialize(bytes_[1 + n_bytes_sender :])
+            topic = topic_from_id(bytes_[0])
+            sender = np.frombuffer(
+                bytes_[1 : 1 + n_bytes_sender], dtype=cls._sender_dtype
+            )[0]
+        except Exception as e:
+            raise DeserializeError() from e
+        return topic, sender, 1 + n_bytes_sender
+
+    @classmethod
+    def from_bytes(cls, bytes_: bytes):
+        topic, sender, n_bytes_header = cls.parse_header(bytes_)
+        try:
+            data = cls._deserialize(bytes_[n_bytes_header:])
         except Exception as e:
             raise DeserializeError() from e
         return cls(data, sender, topic)
 
 
+class BatchMessage(Message):
+    """
+    Container for several serialized messages in one radio packet.
+
+    Content is a list of serialized messages. On the wire every entry is prefixed with its length (uint8).
+    Entries from the batch's own sender omit the sender, which is marked by the high bit of the topic byte.
+    """
+
+    topic = Topic.BATCH
+    _shared_sender_flag = 0x80
+
+    def __init__(self, content, sender: int, topic: Topic = Topic.BATCH):
+        super().__init__(content, sender, topic)
+
+    @classmethod
+    def pack(cls, messages, sender: int, max_len: int) -> list:
+        """
+        Pack messages into as few batches as possible.
+
+        :param messages: The messages to pack, Message instances or serialized messages.
+        :param sender: Sender of the batches.
+        :param max_len: Maximum length of a serialized batch.
+        :return: The batches.
+        """
+        batches = []
+        shared_sender = np.array(sender, dtype=cls._sender_dtype).tobytes()
+        n_bytes_header = 1 + len(shared_sender)
+        entries = []
+        batch_len = n_bytes_header
+        for message in messages:
+            entry = message.serialize() if isinstance(message, Message) else bytes(message)
+            entry_len = 1 + len(entry)
+            if entry[1:n_bytes_header] == shared_sender:
+                entry_len -= n_bytes_header - 1
+            if entries and batch_len + entry_len > max_len:
+                batches.append(cls(entries, sender))
+                entries = []
+                batch_len = n_bytes_header
+            entries.append(entry)
+            batch_len += entry_len
+        if entries:
+            batches.append(cls(entries, sender))
+        return batches
+
+    def unpack(self, message_cls=None):
+        """
+        Decode the entries lazily.
+
+        :param message_cls: The Message subclass of the entries. By default it is looked up by topic,
+        see Message.decode.
+        :return: Generator of the messages.
+        """
+        for entry in self.content:
+            if message_cls is None:
+                yield Message.decode(entry)
+            else:
+                yield message_cls.from_bytes(entry)
+
+    @classmethod
+    def _check_content(cls, content):
+        if any(len(entry) > 255 for entry in content):
+            raise ValueError(f"{cls.__name__} entries must not be longer than 255 bytes.")
+        return list(content)
+
+    def _serialize(self):
+        shared_sender = np.array(self.sender, dtype=self._sender_dtype).tobytes()
+        n_bytes_header = 1 + len(shared_sender)
+        parts = []
+        for entry in self.content:
+            if entry[1:n_bytes_header] == shared_sender:
+                parts.append(bytes([len(entry) - len(shared_sender)]))
+                parts.append(bytes([entry[0] | self._shared_sender_flag]))
+                parts.append(entry[n_bytes_header:])
+            else:
+                parts.append(bytes([len(entry)]))
+                parts.append(entry)
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, bytes_: bytes):
+        topic, sender, n_bytes_header = cls.parse_header(bytes_)
+        try:
+            entries = cls._deserialize(bytes_[n_bytes_header:], bytes_[1:n_bytes_header])
+        except Exception as e:
+            raise DeserializeError() from e
+        return cls(entries, sender, topic)
+
+    @classmethod
+    def _deserialize(cls, bytes_: bytes, shared_sender: bytes = b""):
+        """
+        Parse the entries.
+
+        :param bytes_: The serialized batch without its header.
+        :param shared_sender: The sender of the batch as in the header, inserted into entries that omit it.
+        :return: The serialized entries.
+        """
+        entries = []
+        i = 0
+        while i < len(bytes_):
+            entry_len = bytes_[i]
+            entry = bytes_[i + 1 : i + 1 + entry_len]
+            if len(entry) != entry_len:
+                raise ValueError("Entry is truncated.")
+            if entry[0] & cls._shared_sender_flag:
+                if not shared_sender:
+                    raise ValueError("Entry omits the sender but the shared sender is unknown.")
+                entry = bytes([entry[0] & ~cls._shared_sender_flag]) + bytes(shared_sender) + entry[1:]
+            entries.append(entry)
+            i += 1 + entry_len
+        return entries
+
+
 class TextMessage(Message):
     def __repr__(self):
         return f'{self.__class__.__name__}("{self.content}", {self.sender}, {str(self.topic)})'
@@ -90,7 +283,7 @@ class TextMessage(Message):
 
     @classmethod
     def _deserialize(cls, bytes_: bytes):
-        return bytes_.decode("utf-8")
+        return str(bytes_, "utf-8")
 
 
 class PickleMessage(Message):
@@ -151,3 +344,125 @@ class TimeOrientPosMessage(NumpyMessage):
     @property
     def position(self):
         return self.content[5:8]
+
+
+class QuantizedTimeOrientPosMessage(TimeOrientPosMessage):
+    """
+    TimeOrientPosMessage with a fixed-point wire format of 14 bytes instead of 32.
+
+    - timestamp: 14 bit counter of time_scale steps in the low bits of a uint16. It wraps every
+      2**14 * time_scale seconds and is unwrapped around the receiver's clock (time.time()) on decode.
+    - orientation: smallest three encoding of the unit quaternion. The largest component is dropped
+      (its index is stored in the 2 high bits of the timestamp field), the other three are int16.
+    - position: int16 per axis in position_scale steps around position_offset.
+
+    Content is float64 so decoded timestamps keep their resolution.
+    """
+
+    array_dtype = np.float64
+
+    # value = offset + scale * integer
+    time_scale = 0.004  # s
+    orientation_scale = np.sqrt(0.5) / 32767  # smallest three components are within +-1/sqrt(2)
+    position_scale = 0.001  # m
+    position_offset = np.zeros(3)  # m
+
+    _time_bits = 14
+    _record_dtype = np.dtype(
+        [("time_index", "<u2"), ("orientation", "<i2", 3), ("position", "<i2", 3)]
+    )
+
+    @classmethod
+    def quantize(cls, contents: np.ndarray) -> np.ndarray:
+        """
+        Encode contents into fixed-point records.
+
+        :param contents: One content array of shape (8,) or many of shape (n, 8).
+        :return: Structured array of shape (n,) with dtype _record_dtype.
+        """
+        contents = np.atleast_2d(contents)
+        records = np.empty(len(contents), dtype=cls._record_dtype)
+
+        ticks = np.round(contents[:, 0] / cls.time_scale).astype(np.int64)
+        ticks &= (1 << cls._time_bits) - 1
+
+        q = contents[:, 1:5] / np.linalg.norm(contents[:, 1:5], axis=1, keepdims=True)
+        largest = np.argmax(np.abs(q), axis=1)
+        # q and -q are the same rotation, make the dropped component positive
+        q *= np.where(q[np.arange(len(q)), largest] < 0, -1.0, 1.0)[:, None]
+        smallest_three = q[np.arange(4) != largest[:, None]].reshape(-1, 3)
+
+        records["time_index"] = (largest << cls._time_bits) | ticks
+        records["orientation"] = np.clip(
+            np.round(smallest_three / cls.orientation_scale), -32767, 32767
+        )
+        records["position"] = np.clip(
+            np.round((contents[:, 5:8] - cls.position_offset) / cls.position_scale),
+            -32768,
+            32767,
+        )
+        return records
+
+    @classmethod
+    def dequantize(cls, records: np.ndarray, reference_time=None) -> np.ndarray:
+        """
+        Decode fixed-point records into contents.
+
+        :param records: Structured array with dtype _record_dtype.
+        :param reference_time: Time(s) close to the original timestamps, used to unwrap them.
+        Defaults to time.time().
+        :return: Contents of shape (n, 8).
+        """
+        if reference_time is None:
+            reference_time = time.time()
+        contents = np.empty((len(records), 8), dtype=cls.array_dtype)
+
+        time_index = records["time_index"].astype(np.int64)
+        ticks = time_index & ((1 << cls._time_bits) - 1)
+        period = (1 << cls._time_bits) * cls.time_scale
+        offset = ticks * cls.time_scale - np.asarray(reference_time)
+        contents[:, 0] = reference_time + (offset + period / 2) % period - period / 2
+
+        largest = time_index >> cls._time_bits
+        smallest_three = records["orientation"] * cls.orientation_scale
+        q = contents[:, 1:5]
+        q[np.arange(4) != largest[:, None]] = smallest_three.ravel()
+        q[np.arange(len(q)), largest] = np.sqrt(
+            np.maximum(1.0 - np.sum(smallest_three ** 2, axis=1), 0.0)
+        )
+
+        contents[:, 5:8] = records["position"] * cls.position_scale + cls.position_offset
+        return contents
+
+    @classmethod
+    def round_trip_error(cls, contents: np.ndarray) -> np.ndarray:
+        """
+        Absolute error introduced by quantization.
+
+        :param contents: One content array of shape (8,) or many of shape (n, 8).
+        :return: Absolute error per element, same shape as contents.
+        """
+        original = np.atleast_2d(contents).astype(np.float64)
+        decoded = cls.dequantize(cls.quantize(original), reference_time=original[:, 0])
+        q = original[:, 1:5] / np.linalg.norm(original[:, 1:5], axis=1, keepdims=True)
+        sign = np.where(np.sum(q * decoded[:, 1:5], axis=1) < 0, -1.0, 1.0)
+        original[:, 1:5] = q * sign[:, None]
+        return np.abs(decoded - original).reshape(np.shape(contents))
+
+    def _serialize(self):
+        return self.quantize(self.content).tobytes()
+
+    @classmethod
+    def _deserialize(cls, bytes_: bytes):
+        records = np.frombuffer(bytes_, dtype=cls._record_dtype)
+        if len(records) != 1:
+            raise ValueError(f"Expected {cls._record_dtype.itemsize} bytes but got {len(bytes_)}.")
+        return cls.dequantize(records)[0]
+
+
+register_topic(Topic.IMU, TimeOrientPosMessage)
+register_topic(Topic.ATTITUDE, TimeOrientPosMessage)
+register_topic(Topic.BATCH, BatchMessage)
+register_topic(Topic.TEXT, TextMessage)
+register_topic(Topic.QUANTIZED_IMU, QuantizedTimeOrientPosMessage)
+register_topic(Topic.QUANTIZED_ATTITUDE, QuantizedTimeOrientPosMessage)
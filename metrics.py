@@ -0,0 +1,200 @@
+"""
+In-process metrics of the radio stack.
+
+Counters, gauges and histograms with fixed buckets are registered by name in a Registry and rendered in
+the Prometheus text format, e.g. for curl http://127.0.0.1:9464/metrics after serve():
+
+    tx_bytes = metrics.counter("lora_tx_bytes_total", "Bytes written to the module.")
+    tx_bytes.inc(len(packet))
+
+Metrics are created once per name, so modules can look them up at import time and update them on hot paths
+for the cost of a lock. The value of a metric can also be read from a function at rendering, e.g. the
+depth of a queue.
+"""
+
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+# seconds, from the pacing of single packets to configuration handshakes
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, help: str = "", function: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self._value = 0
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        if self.function is not None:
+            return self.function()
+        return self._value
+
+    def samples(self) -> list:
+        """(name suffix, labels, value) of every line of the metric."""
+        return [("", "", self.value)]
+
+
+class Counter(Metric):
+    """A value that only increases, e.g. the number of received bytes."""
+
+    type = "counter"
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down, e.g. a queue depth."""
+
+    type = "gauge"
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, e.g. durations, in buckets with fixed upper bounds.
+
+    :param buckets: Ascending upper bounds of the buckets, values above the last one are only counted
+    in the total.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str = "", buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+        if list(self.buckets) != sorted(self.buckets):
+            raise ValueError(f"Buckets of {name} must be ascending.")
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def samples(self) -> list:
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            samples.append(("_bucket", f'{{le="{le}"}}', cumulative))
+        samples.append(("_sum", "", total))
+        samples.append(("_count", "", cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif type(metric) != cls:
+                raise ValueError(f"{name} is already registered as {metric.type}.")
+            return metric
+
+    def counter(self, name: str, help: str = "", function=None) -> Counter:
+        return self._get(Counter, name, help, function)
+
+    def gauge(self, name: str, help: str = "", function=None) -> Gauge:
+        return self._get(Gauge, name, help, function)
+
+    def histogram(self, name: str, help: str = "", buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, buckets)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            if metric.help:
+                lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help: str = "", function=None) -> Counter:
+    """Get or create a counter of the default registry."""
+    return REGISTRY.counter(name, help, function)
+
+
+def gauge(name: str, help: str = "", function=None) -> Gauge:
+    """Get or create a gauge of the default registry."""
+    return REGISTRY.gauge(name, help, function)
+
+
+def histogram(name: str, help: str = "", buckets=DEFAULT_BUCKETS) -> Histogram:
+    """Get or create a histogram of the default registry."""
+    return REGISTRY.histogram(name, help, buckets)
+
+
+def serve(port: Optional[int], address: str = "127.0.0.1", registry: Registry = REGISTRY):
+    """
+    Serve the metrics over HTTP in a background thread.
+
+    Failures are logged and do not stop the caller, the radio is more important than its metrics.
+
+    :param port: TCP port, None does not serve.
+    :param address: Address to bind to, the default only accepts local connections.
+    :param registry: The metrics to serve.
+    :return: The server or None.
+    """
+    if port is None:
+        return None
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer((address, port), Handler)
+    except OSError as e:
+        logging.error(f"Could not serve metrics on {address}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on http://{address}:{server.server_port}/metrics")
+    return server
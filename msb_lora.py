@@ -1,7 +1,5 @@
 import pickle
 import pprint
-from collections import deque
-from datetime import datetime
 from socket import gethostname
 import sys
 import threading
@@ -12,18 +10,38 @@ import numpy as np
 
 import logging.config
 
+import metrics
+from adr import RateFollower
+from delta import DeltaEncoder
 from driver import LoRaHatDriver
-from loraconfig import lora_hat_config, logging_config_dict
-from message import Topic, TimeOrientPosMessage
+from loraconfig import (
+    adr_config,
+    delta_config,
+    enable_adr,
+    enable_delta,
+    enable_tdma,
+    lora_hat_config,
+    lora_hat_options,
+    logging_config_dict,
+    metrics_config,
+    tdma_config,
+)
+from message import BatchMessage, QuantizedTimeOrientPosMessage, Topic, TimeOrientPosMessage
+from tdma import TdmaNode
 
 logging.config.dictConfig(logging_config_dict)
 
 socket_name = "tcp://127.0.0.1:5556"
-seconds_between_messages = 1
+no_data_timeout = 1
 
-# thread safe, according to:
-# https://docs.python.org/3/library/collections.html#collections.deque
-buffer = deque(maxlen=1)
+no_new_data = metrics.counter("lora_no_new_data_total", "Intervals of no_data_timeout without new data.")
+sent_batches = metrics.counter("lora_sent_batches_total", "Batches sent.")
+
+# most recent data per zmq topic, all of it is sent in a single batch
+# dict item assignment and popitem are atomic
+buffer = {}
+new_data = threading.Event()
+metrics.gauge("lora_pending_topics", "Topics with data waiting to be sent.", lambda: len(buffer))
 
 
 def read_from_zeromq(socket_name):
@@ -39,37 +57,93 @@ def read_from_zeromq(socket_name):
 
             while True:
                 topic_bin, data_bin = socket.recv_multipart()
-                buffer.append((topic_bin, data_bin))
+                buffer[topic_bin] = data_bin
+                new_data.set()
 
     except Exception as e:
         logging.critical(f"failed to bind to zeromq socket: {e}")
         sys.exit(-1)
 
 
+def receive_downlink(lora_hat, follower, tdma, encoder):
+    # handle the messages of the basestation without waiting, others are dropped
+    while lora_hat.readable():
+        for message, packet in lora_hat.receive_messages(timeout=0, metadata=True):
+            if follower is not None:
+                follower.handle(message, packet)
+            if tdma is not None:
+                tdma.handle(message, packet, lora_hat)
+            if encoder is not None:
+                encoder.handle(message)
+
+
+def make_message(topic_bin, data_bin, sender, encoder=None):
+    topic = topic_bin.decode("utf-8")
+    # data = pickle.loads(data_bin)
+
+    # for debugging: create my own data for now
+    data = np.empty(8, dtype=TimeOrientPosMessage.array_dtype)
+    data[0] = time.time()
+    data[1:] = np.random.standard_normal(7)
+
+    if encoder is not None and topic in ("imu", "attitude"):
+        # float64 keeps the resolution of the timestamp, the orientation has to be a unit quaternion
+        data = data.astype(QuantizedTimeOrientPosMessage.array_dtype)
+        data[0] = time.time()
+        data[1:5] /= np.linalg.norm(data[1:5])
+        topic = Topic.QUANTIZED_IMU if topic == "imu" else Topic.QUANTIZED_ATTITUDE
+        return encoder.encode(QuantizedTimeOrientPosMessage(data, sender, topic=topic))
+
+    if topic == "imu":
+        return TimeOrientPosMessage(data, sender, topic=Topic.IMU)
+    elif topic == "attitude":
+        return TimeOrientPosMessage(data, sender, topic=Topic.ATTITUDE)
+    else:
+        return TimeOrientPosMessage(data, sender)
+
+
 threading.Thread(target=read_from_zeromq, daemon=True, args=[socket_name]).start()
+metrics.serve(**metrics_config)
 
-with LoRaHatDriver(lora_hat_config) as lora_hat:
+with LoRaHatDriver(lora_hat_config, **lora_hat_options) as lora_hat:
     logging.debug(f"LoRa hat config: {pprint.pformat(lora_hat.config)}")
     sender = int(gethostname()[4:8])
+    follower = RateFollower(sender, lora_hat.config, adr_config["fallback_timeout"]) if enable_adr else None
+    tdma = TdmaNode(sender, tdma_config["beacon_timeout"]) if enable_tdma else None
+    encoder = DeltaEncoder(sender, delta_config["keyframe_interval"]) if enable_delta else None
+    # the messages of the basestation are read on arrival, see LoRaHatDriver.listen, and handled in
+    # receive_downlink. Beacons and switches are timed from their arrival.
+    downlink = follower is not None or tdma is not None or encoder is not None
     while True:
-        try:
-            topic_bin, data_bin = buffer.pop()
-
-            topic = topic_bin.decode("utf-8")
-            # data = pickle.loads(data_bin)
-
-            # for debugging: create my own data for now
-            data = np.empty(8, dtype=TimeOrientPosMessage.array_dtype)
-            data[0] = datetime.utcnow().timestamp()
-            data[1:] = np.random.standard_normal(7)
-
-            if topic == "imu":
-                message = TimeOrientPosMessage(data, sender, topic=Topic.IMU)
-            elif topic == "attitude":
-                message = TimeOrientPosMessage(data, sender, topic=Topic.ATTITUDE)
-            else:
-                message = TimeOrientPosMessage(data, sender)
-            lora_hat.send(message.serialize())
-        except IndexError:
+        timeout = no_data_timeout
+        if downlink:
+            receive_downlink(lora_hat, follower, tdma, encoder)
+        if follower is not None:
+            timeout = min(timeout, follower.poll(lora_hat))
+        if downlink:
+            lora_hat.listen(timeout, new_data)
+        else:
+            new_data.wait(timeout=timeout)
+        if not new_data.is_set():
             logging.debug("No new data to send")
-        time.sleep(seconds_between_messages)
+            no_new_data.inc()
+            continue
+        new_data.clear()
+        messages = []
+        while buffer:
+            topic_bin, data_bin = buffer.popitem()
+            # delta encoded messages are already serialized
+            messages.append(make_message(topic_bin, data_bin, sender, encoder))
+        for batch in BatchMessage.pack(messages, sender, lora_hat.packet_message_len):
+            batch_bytes = batch.serialize()
+            if tdma is not None:
+                receive_downlink(lora_hat, follower, tdma, encoder)
+                lora_hat.listen(tdma.delay(lora_hat, len(batch_bytes)))
+            # paced by the driver, returns once the batch is written
+            tx_done = lora_hat.send_message(batch_bytes)
+            sent_batches.inc()
+            # until the batch is on air
+            if downlink:
+                lora_hat.listen(tx_done - time.monotonic())
+            else:
+                time.sleep(max(tx_done - time.monotonic(), 0))
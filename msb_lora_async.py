@@ -0,0 +1,94 @@
+import asyncio
+import pprint
+from socket import gethostname
+import time
+
+import zmq
+import zmq.asyncio
+
+import numpy as np
+
+import logging.config
+
+import metrics
+from async_driver import AsyncLoRaHatDriver
+from loraconfig import lora_hat_config, lora_hat_options, logging_config_dict, metrics_config
+from message import BatchMessage, Topic, TimeOrientPosMessage
+
+logging.config.dictConfig(logging_config_dict)
+
+socket_name = "tcp://127.0.0.1:5556"
+no_data_timeout = 1
+
+no_new_data = metrics.counter("lora_no_new_data_total", "Intervals of no_data_timeout without new data.")
+sent_batches = metrics.counter("lora_sent_batches_total", "Batches sent.")
+
+
+async def read_from_zeromq(socket_name, latest, new_data):
+    logging.debug(f"trying to bind zmq to {socket_name}")
+    context = zmq.asyncio.Context()
+    socket = context.socket(zmq.SUB)
+    with socket.connect(socket_name):
+        # subscribe to all available data
+        socket.setsockopt(zmq.SUBSCRIBE, b"")
+        logging.debug("successfully bound to zeroMQ receiver socket as subscriber")
+
+        while True:
+            topic_bin, data_bin = await socket.recv_multipart()
+            latest[topic_bin] = data_bin
+            new_data.set()
+
+
+def make_message(topic_bin, data_bin, sender):
+    topic = topic_bin.decode("utf-8")
+    # data = pickle.loads(data_bin)
+
+    # for debugging: create my own data for now
+    data = np.empty(8, dtype=TimeOrientPosMessage.array_dtype)
+    data[0] = time.time()
+    data[1:] = np.random.standard_normal(7)
+
+    if topic == "imu":
+        return TimeOrientPosMessage(data, sender, topic=Topic.IMU)
+    elif topic == "attitude":
+        return TimeOrientPosMessage(data, sender, topic=Topic.ATTITUDE)
+    else:
+        return TimeOrientPosMessage(data, sender)
+
+
+async def send_to_lora(lora_hat, latest, new_data):
+    sender = int(gethostname()[4:8])
+    while True:
+        try:
+            await asyncio.wait_for(new_data.wait(), no_data_timeout)
+        except asyncio.TimeoutError:
+            logging.debug("No new data to send")
+            no_new_data.inc()
+            continue
+        new_data.clear()
+        messages = [make_message(*item, sender) for item in latest.items()]
+        latest.clear()
+        max_len = lora_hat.driver.packet_message_len
+        for batch in BatchMessage.pack(messages, sender, max_len):
+            # paced by the driver, returns once the batch is on air
+            await lora_hat.send(batch.serialize(), block=True)
+            sent_batches.inc()
+
+
+async def main():
+    # most recent data per zmq topic, all of it is sent in a single batch
+    latest = {}
+    new_data = asyncio.Event()
+    metrics.gauge("lora_pending_topics", "Topics with data waiting to be sent.", lambda: len(latest))
+    metrics.serve(**metrics_config)
+    async with AsyncLoRaHatDriver(lora_hat_config, **lora_hat_options) as lora_hat:
+        logging.debug(f"LoRa hat config: {pprint.pformat(lora_hat.config)}")
+        reader = asyncio.create_task(read_from_zeromq(socket_name, latest, new_data))
+        try:
+            await send_to_lora(lora_hat, latest, new_data)
+        finally:
+            reader.cancel()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,205 @@
+"""
+Queries over the messages persisted by store.MessageStore.
+
+Segments whose senders, topics or receive times do not match are skipped using the index, within a segment
+only the blocks of the sparse time index that overlap the time range are read from the memory map.
+
+Records of different Message classes are stored in separate tables with different dtypes. query_tables
+selects from every table of the store, query from a single one.
+
+    records = query("persist_lora", senders=[150, 153], start=t0, end=t1, topic=Topic.ATTITUDE)
+    tables = query_tables("persist_lora", start=t0)   # {class name: records}
+
+    python query.py persist_lora --sender 150 153 --start 2024-05-01T14:00 --end 2024-05-01T18:00 \\
+        --topic ATTITUDE --output afternoon.npz
+
+With records of several classes, the CLI exports one file per class, e.g. afternoon.TextMessage.npz.
+"""
+
+import argparse
+import ast
+import csv
+import os
+from datetime import datetime
+from typing import Optional
+
+import numpy as np
+
+from message import Topic, topic_id
+from store import BLOCK_LEN, load_index, segment_path, table_names
+
+
+def _overlaps(t_min: float, t_max: float, start: Optional[float], end: Optional[float]) -> bool:
+    return (start is None or t_max >= start) and (end is None or t_min < end)
+
+
+def query(
+    directory: str,
+    senders=None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    topic=None,
+    name: Optional[str] = None,
+) -> np.ndarray:
+    """
+    Select stored records of one Message class.
+
+    :param directory: Directory of the store.
+    :param senders: Sender ids to select, None selects all.
+    :param start: Earliest receive time (time.time()), inclusive.
+    :param end: Latest receive time, exclusive.
+    :param topic: Topic or topic id to select, None selects all.
+    :param name: Name of the Message class the records were stored for. If None, the only class with
+        matching records is selected.
+    :return: The matching records ordered by segment and position, see store.record_dtype.
+    :raises ValueError: If name is None and records of several classes match.
+    """
+    if name is None:
+        tables = query_tables(directory, senders, start, end, topic)
+        if len(tables) > 1:
+            raise ValueError(f"Records of {', '.join(tables)} match, select one by name or use query_tables.")
+        return next(iter(tables.values()), np.empty(0))
+
+    index = load_index(directory, name)
+    if index is None:
+        return np.empty(0)
+    senders = None if senders is None else [int(s) for s in senders]
+    topic = None if topic is None else topic_id(topic)
+
+    parts = []
+    for segment in index["segments"]:
+        if not segment["count"]:
+            continue
+        if senders is not None and not set(senders).intersection(segment["senders"]):
+            continue
+        if topic is not None and topic not in segment["topics"]:
+            continue
+        blocks = [
+            i
+            for i, (t_min, t_max) in enumerate(segment["blocks"])
+            if _overlaps(t_min, t_max, start, end)
+        ]
+        if not blocks:
+            continue
+
+        records = np.load(segment_path(directory, name, segment), mmap_mode="r")
+        # read contiguous runs of blocks at once
+        runs = np.split(blocks, np.flatnonzero(np.diff(blocks) != 1) + 1)
+        for run in runs:
+            chunk = records[run[0] * BLOCK_LEN : min((run[-1] + 1) * BLOCK_LEN, segment["count"])]
+            mask = np.ones(len(chunk), dtype=bool)
+            if start is not None:
+                mask &= chunk["receive_time"] >= start
+            if end is not None:
+                mask &= chunk["receive_time"] < end
+            if senders is not None:
+                mask &= np.isin(chunk["sender"], senders)
+            if topic is not None:
+                mask &= chunk["topic"] == topic
+            parts.append(chunk[mask])
+    if not parts:
+        return np.empty(0, dtype=np.dtype(ast.literal_eval(index["dtype"])))
+    return np.concatenate(parts)
+
+
+def query_tables(
+    directory: str,
+    senders=None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    topic=None,
+    names=None,
+) -> dict:
+    """
+    Select stored records of several Message classes, see query.
+
+    :param names: Names of the Message classes, None selects every class in the store.
+    :return: The matching records per class name, classes without matching records are left out.
+    """
+    tables = {}
+    for name in table_names(directory) if names is None else names:
+        records = query(directory, senders, start, end, topic, name)
+        if len(records):
+            tables[name] = records
+    return tables
+
+
+def export_npz(records: np.ndarray, path: str):
+    """Write every column of the records as an array of an .npz file."""
+    np.savez_compressed(path, **{column: records[column] for column in records.dtype.names})
+
+
+def export_csv(records: np.ndarray, path: str):
+    """Write the records as CSV, array columns are spread over several columns."""
+    names = records.dtype.names
+    header = []
+    for column in names:
+        shape = records.dtype[column].shape
+        if shape:
+            header += [f"{column}_{i}" for i in range(int(np.prod(shape)))]
+        elif column != "content_len":
+            header.append(column)
+
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for record in records:
+            row = []
+            for column in names:
+                value = record[column]
+                if column == "content_len":
+                    continue
+                if records.dtype[column].shape:
+                    row += np.ravel(value).tolist()
+                elif isinstance(value, bytes):
+                    # content of messages that are not NumpyMessages
+                    row.append(value[: record["content_len"]].decode("utf-8", "replace"))
+                else:
+                    row.append(value.item())
+            writer.writerow(row)
+
+
+def parse_time(value: str) -> float:
+    """Parse a unix time or an ISO date as in the CLI arguments."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("directory", help="directory of the store")
+    parser.add_argument("--name", nargs="+", help="Message classes of the records, default all stored")
+    parser.add_argument("--sender", type=int, nargs="+", help="sender ids")
+    parser.add_argument("--start", type=parse_time, help="unix time or ISO date, e.g. 2024-05-01T14:00")
+    parser.add_argument("--end", type=parse_time, help="unix time or ISO date")
+    parser.add_argument("--topic", choices=[t.name for t in Topic])
+    parser.add_argument("--output", help="export to this .npz or .csv file")
+    args = parser.parse_args()
+
+    tables = query_tables(
+        args.directory,
+        args.sender,
+        args.start,
+        args.end,
+        None if args.topic is None else Topic[args.topic],
+        args.name,
+    )
+    for name, records in tables.items():
+        print(
+            f"{name}: {len(records)} records "
+            f"from {datetime.fromtimestamp(records['receive_time'].min())} "
+            f"to {datetime.fromtimestamp(records['receive_time'].max())}, "
+            f"senders {np.unique(records['sender']).tolist()}"
+        )
+    if not tables:
+        print("0 records")
+    if args.output:
+        root, ext = os.path.splitext(args.output)
+        for name, records in tables.items():
+            path = args.output if len(tables) == 1 else f"{root}.{name}{ext}"
+            if ext == ".csv":
+                export_csv(records, path)
+            else:
+                export_npz(records, path)
@@ -5,26 +5,29 @@ import queue
 import threading
 import sys
 
-from loraconfig import lora_hat_config
-from loraconfig import logging_config_dict
+from loraconfig import lora_hat_config, lora_hat_options
+from loraconfig import logging_config_dict, metrics_config
+import metrics
 from driver import LoRaHatDriver
-from message import TextMessage
+from message import Message
 
 logging.config.dictConfig(logging_config_dict)
+metrics.serve(**metrics_config)
 
 q = queue.SimpleQueue()
 
 
 def print_received_data():
     while True:
-        message = TextMessage.from_bytes(q.get())
+        message = Message.decode(q.get())
         print(f"{message.topic.name}: {message.content}")
 
 
 threading.Thread(target=print_received_data, daemon=True).start()
 
-with LoRaHatDriver(lora_hat_config) as lora_hat:
+with LoRaHatDriver(lora_hat_config, **lora_hat_options) as lora_hat:
     logging.debug(pprint.pformat(lora_hat.config))
     print("Press \033[1;32mCtrl+C\033[0m to exit")
     while True:
-        q.put(lora_hat.receive())
+        for message in lora_hat.receive_messages():
+            q.put(message)
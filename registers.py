@@ -0,0 +1,295 @@
+"""
+Register map of the SX126X LoRa HAT.
+
+Every setting is described once in REGISTER_MAP by its position in the registers REG0-REG8.
+Serialization, parsing and validation of configurations are derived from it, see
+https://www.waveshare.com/wiki/SX1268_433M_LoRa_HAT for the register documentation.
+
+A command is a 3 byte header (command, start register, number of registers) followed by the registers:
+
+    0xC2 0x00 0x09 REG0 REG1 REG2 REG3 REG4 REG5 REG6 REG7 REG8
+
+Commands may cover any contiguous range of registers, e.g. 0xC2 0x05 0x01 REG5 only sets the channel.
+"""
+
+from enum import Enum
+from typing import Optional
+
+CFG_HEADER = 0xC2  # Header to use if we want to set registers.
+PERSISTENT_CFG_HEADER = 0xC0  # Like CFG_HEADER, but the registers are kept after a power cycle.
+RET_HEADER = 0xC1  # Header of the answer after registers have been set. Use it to check if set was successful.
+START_REG = 0x00  # begin with the first register
+NUM_REG = 0x09  # set 9 registers
+KEY_REG = 0x07  # the key is in the last two registers, they are write only
+# Reads the RSSI registers in transmission mode if enable_ambient_noise is set:
+# NOISE_HEADER start length, answered with RET_HEADER start length values.
+NOISE_HEADER = bytes([0xC0, 0xC1, 0xC2, 0xC3])
+NOISE_REG = 0x00  # ambient noise RSSI, followed by the RSSI of the last received packet
+
+COMMAND_NAMES = {
+    CFG_HEADER: "Configure temporary registers",
+    RET_HEADER: "Answer / Read registers",
+    PERSISTENT_CFG_HEADER: "Configure registers",
+}
+
+
+class ConfigError(ValueError):
+    """Raised if a configuration or command is invalid."""
+
+    pass
+
+
+class BaudRate(Enum):
+    BR_1200 = 0b000
+    BR_2400 = 0b001
+    BR_4800 = 0b010
+    BR_9600 = 0b011
+    BR_19200 = 0b100
+    BR_38400 = 0b101
+    BR_57600 = 0b110
+    BR_115200 = 0b111
+
+
+class ParityBit(Enum):
+    PB_8N1 = 0b00
+    PB_8O1 = 0b01
+    PB_8E1 = 0b10
+
+
+class AirSpeed(Enum):
+    AS_0_3K = 0b000
+    AS_1_2K = 0b001
+    AS_2_4K = 0b010
+    AS_4_8K = 0b011
+    AS_9_6K = 0b100
+    AS_19_2K = 0b101
+    AS_38_4K = 0b110
+    AS_62_5K = 0b111
+
+
+class PacketLen(Enum):
+    PL_240B = 0b00
+    PL_128B = 0b01
+    PL_64B = 0b10
+    PL_32B = 0b11
+
+
+class TransmitPower(Enum):
+    TP_22dBm = 0b00
+    TP_17dBm = 0b01
+    TP_12dBm = 0b10
+    TP_10dBm = 0b11
+
+
+class WORMode(Enum):
+    WOR_transmit = 0b0
+    WOR_listen = 0b1
+
+
+class WORPeriod(Enum):
+    WP_500ms = 0b000
+    WP_1000ms = 0b001
+    WP_1500ms = 0b010
+    WP_2000ms = 0b011
+    WP_2500ms = 0b100
+    WP_3000ms = 0b101
+    WP_3500ms = 0b110
+    WP_4000ms = 0b111
+
+
+class Field:
+    """
+    A setting stored in the registers.
+
+    :param name: Key of the setting in the config dict.
+    :param register: First register of the setting.
+    :param shift: Position of the lowest bit within the register(s).
+    :param n_bits: Number of bits. Settings of more than 8 bits span registers, high byte first.
+    :param type_: Enum class, bool or int.
+    :param max_value: Largest valid value of int settings.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        register: int,
+        shift: int,
+        n_bits: int,
+        type_=int,
+        max_value: Optional[int] = None,
+    ):
+        self.name = name
+        self.register = register
+        self.shift = shift
+        self.n_bits = n_bits
+        self.type = type_
+        self.max_value = (1 << n_bits) - 1 if max_value is None else max_value
+        self.n_registers = (shift + n_bits + 7) // 8
+        self.mask = ((1 << n_bits) - 1) << shift
+
+    def encode(self, value) -> int:
+        """Validate a value and return its bits in place."""
+        if isinstance(self.type, type) and issubclass(self.type, Enum):
+            if not isinstance(value, self.type):
+                raise ConfigError(f"{self.name} must be a {self.type.__name__}, but was {value!r}.")
+            raw = value.value
+        elif self.type is bool:
+            if not isinstance(value, (bool, int)) or value not in (0, 1):
+                raise ConfigError(f"{self.name} must be a bool, but was {value!r}.")
+            raw = int(value)
+        else:
+            if type(value) != int or not 0 <= value <= self.max_value:
+                raise ConfigError(
+                    f"{self.name} must be an int between 0 and {self.max_value}, but was {value!r}."
+                )
+            raw = value
+        return raw << self.shift
+
+    def decode(self, bits: int):
+        """Return the value of the bits in place."""
+        raw = (bits & self.mask) >> self.shift
+        try:
+            if self.type is bool:
+                return bool(raw)
+            if self.type is int and raw > self.max_value:
+                raise ValueError(f"{raw} is larger than {self.max_value}")
+            return self.type(raw)
+        except ValueError as e:
+            raise ConfigError(f"Invalid value for {self.name}: {e}") from e
+
+
+REGISTER_MAP = [
+    # 0xFFFF broadcasts and listens to all addresses
+    Field("module_address", 0, 0, 16),
+    # modules only communicate within the same network
+    Field("net_id", 2, 0, 8),
+    Field("baud_rate", 3, 5, 3, BaudRate),
+    Field("parity_bit", 3, 3, 2, ParityBit),
+    # higher air speed: lower latency and shorter range
+    Field("air_speed", 3, 0, 3, AirSpeed),
+    # longer messages are split into packets of this size
+    Field("packet_len", 4, 6, 2, PacketLen),
+    # allows to read the noise RSSI with 0xC0 0xC1 0xC2 0xC3 in transmission and WOR mode
+    Field("enable_ambient_noise", 4, 5, 1, bool),
+    Field("transmit_power", 4, 0, 2, TransmitPower),
+    # 850.125 + channel MHz (SX1262), 410.125 + channel MHz (SX1268)
+    Field("channel", 5, 0, 8, int, max_value=83),
+    # received packets are followed by their RSSI byte on the serial port
+    Field("enable_RSSI_byte", 6, 7, 1, bool),
+    # the first three bytes of every message are target address high, low and channel
+    Field("enable_point_to_point_mode", 6, 6, 1, bool),
+    # forward packets that are not addressed to this module
+    Field("enable_relay_function", 6, 5, 1, bool),
+    # listen before talk, transmissions are deferred by up to 2 s while the channel is busy
+    Field("enable_LBT", 6, 4, 1, bool),
+    # only used in mode 1 (WOR)
+    Field("WOR_mode", 6, 3, 1, WORMode),
+    Field("WOR_period", 6, 0, 3, WORPeriod),
+    # encryption key, write only
+    Field("key", 7, 0, 16),
+]
+
+# bits of every register that are not used by a field, they must be 0
+_RESERVED_MASKS = [0xFF] * NUM_REG
+for _field in REGISTER_MAP:
+    for _i in range(_field.n_registers):
+        _register = _field.register + _field.n_registers - 1 - _i
+        _RESERVED_MASKS[_register] &= ~(_field.mask >> (8 * _i)) & 0xFF
+
+
+def encode_registers(config) -> bytes:
+    """
+    Make the values of all registers from a config.
+
+    :param config: The configuration, see loraconfig.py. Keys not in REGISTER_MAP are ignored.
+    :return: REG0-REG8.
+    """
+    registers = bytearray(NUM_REG)
+    for field in REGISTER_MAP:
+        try:
+            value = config[field.name]
+        except KeyError:
+            raise ConfigError(f"{field.name} is missing in the config.") from None
+        bits = field.encode(value)
+        for i in range(field.n_registers):
+            registers[field.register + field.n_registers - 1 - i] |= (bits >> (8 * i)) & 0xFF
+    return bytes(registers)
+
+
+def decode_registers(registers: bytes, start: int = START_REG) -> dict:
+    """
+    Parse registers into a config.
+
+    :param registers: Values of a contiguous range of registers.
+    :param start: The first register in registers.
+    :return: The settings that are completely contained in the range.
+    """
+    if start + len(registers) > NUM_REG:
+        raise ConfigError(f"Registers {start}-{start + len(registers) - 1} do not exist.")
+    for i, value in enumerate(registers):
+        if value & _RESERVED_MASKS[start + i]:
+            raise ConfigError(f"Reserved bits of register {start + i} are set: {value:#04x}.")
+
+    config = {}
+    for field in REGISTER_MAP:
+        first = field.register - start
+        if first < 0 or first + field.n_registers > len(registers):
+            continue
+        bits = int.from_bytes(registers[first : first + field.n_registers], "big")
+        config[field.name] = field.decode(bits)
+    return config
+
+
+def serialize_config(config, start: int = START_REG, length: int = NUM_REG, header: int = CFG_HEADER) -> bytes:
+    """
+    Make the command that writes (a range of) the registers of a config.
+
+    :param config: The configuration, see loraconfig.py.
+    :param start: First register to write.
+    :param length: Number of registers to write.
+    :param header: CFG_HEADER or PERSISTENT_CFG_HEADER.
+    :return: The command.
+    """
+    if start < 0 or length < 1 or start + length > NUM_REG:
+        raise ConfigError(f"Registers {start}-{start + length - 1} do not exist.")
+    registers = encode_registers(config)
+    return bytes([header, start, length]) + registers[start : start + length]
+
+
+def command_to_dict(command_bytes) -> dict:
+    """
+    Parse a register command or answer.
+
+    :param command_bytes: Header and registers.
+    :return: The settings in the command plus command (its name), start_register and data_length.
+    """
+    command_bytes = bytes(command_bytes)
+    if len(command_bytes) < 3:
+        raise ConfigError(f"Command is too short: {command_bytes.hex()}.")
+    header, start, length = command_bytes[:3]
+    if header not in COMMAND_NAMES:
+        raise ConfigError(f"Unknown command {header:#04x}.")
+    if len(command_bytes) != 3 + length:
+        raise ConfigError(f"Command has {len(command_bytes) - 3} registers, header says {length}.")
+
+    command_dict = {
+        "command": COMMAND_NAMES[header],
+        "start_register": start,
+        "data_length": length,
+    }
+    command_dict.update(decode_registers(command_bytes[3:], start))
+    return command_dict
+
+
+def changed_registers(old_config, new_config) -> Optional[tuple]:
+    """
+    The smallest contiguous range of registers that has to be written to change old_config into new_config.
+
+    :return: (start register, number of registers) or None if the registers are equal.
+    """
+    old = encode_registers(old_config)
+    new = encode_registers(new_config)
+    changed = [i for i in range(NUM_REG) if old[i] != new[i]]
+    if not changed:
+        return None
+    return changed[0], changed[-1] - changed[0] + 1
@@ -0,0 +1,126 @@
+"""
+Replay recorded LoRa traffic into the zmq pipeline.
+
+Reads the messages persisted by basestation_persist_lora.py (see store.py) and publishes them on the
+per-topic "LORA/<topic>" frames like basestation_lora.py, keeping the original inter-arrival times or a multiple of their rate:
+
+    python replay.py persist_lora --speed 10 --start 2024-05-01T14:00 --end 2024-05-01T15:00
+    python replay.py persist_lora --speed 0   # as fast as possible
+
+Messages of all stored classes are merged by receive time. The order is deterministic, so runs are repeatable.
+"""
+
+import argparse
+import logging
+import logging.config
+import os
+import time
+
+import numpy as np
+import zmq
+
+import message
+from lora_zmq import topic_frame
+from loraconfig import logging_config_dict
+from query import parse_time, query
+from store import message_from_record
+
+socket_name = "tcp://127.0.0.1:5555"
+
+
+def load(directory: str, senders=None, start=None, end=None) -> list:
+    """
+    Select the recorded messages of all classes.
+
+    :return: (receive times, Message classes, records) per stored class.
+    """
+    tables = []
+    for name in sorted(os.listdir(directory)):
+        message_cls = getattr(message, name, None)
+        if not isinstance(message_cls, type) or not issubclass(message_cls, message.Message):
+            logging.warning(f"Skipping {name}, it is not a Message class.")
+            continue
+        records = query(directory, senders, start, end, name=name)
+        if len(records):
+            tables.append((records["receive_time"], message_cls, records))
+    return tables
+
+
+def iter_messages(tables):
+    """
+    Merge the records of several classes by receive time.
+
+    :param tables: See load().
+    :return: Generator of (receive time, message), the messages are made lazily.
+    """
+    if not tables:
+        return
+    times = np.concatenate([t for t, _, _ in tables])
+    table_index = np.concatenate([np.full(len(t), i) for i, (t, _, _) in enumerate(tables)])
+    row_index = np.concatenate([np.arange(len(t)) for t, _, _ in tables])
+    for i in np.argsort(times, kind="stable"):
+        _, message_cls, records = tables[table_index[i]]
+        yield float(times[i]), message_from_record(message_cls, records[row_index[i]])
+
+
+def replay(messages, publish, speed: float = 1.0) -> dict:
+    """
+    Publish messages with their recorded timing.
+
+    :param messages: Iterable of (receive time, message), ordered by time.
+    :param publish: Function called with every message.
+    :param speed: Speed-up factor of the replay, 0 publishes as fast as possible.
+    :return: Statistics: number of messages, duration and the largest delay behind schedule in seconds.
+    """
+    n_messages = 0
+    max_lag = 0.0
+    start = time.monotonic()
+    first = None
+    for receive_time, msg in messages:
+        if first is None:
+            first = receive_time
+        if speed > 0:
+            due = start + (receive_time - first) / speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                max_lag = max(max_lag, -delay)
+        publish(msg)
+        n_messages += 1
+    return {
+        "messages": n_messages,
+        "duration_s": time.monotonic() - start,
+        "max_lag_s": max_lag,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("directory", help="directory of the store")
+    parser.add_argument("--speed", type=float, default=1.0, help="speed-up factor, 0 for max rate")
+    parser.add_argument("--sender", type=int, nargs="+", help="sender ids")
+    parser.add_argument("--start", type=parse_time, help="unix time or ISO date")
+    parser.add_argument("--end", type=parse_time, help="unix time or ISO date")
+    parser.add_argument("--loop", action="store_true", help="replay forever")
+    parser.add_argument("--socket", default=socket_name)
+    args = parser.parse_args()
+
+    logging.config.dictConfig(logging_config_dict)
+    tables = load(args.directory, args.sender, args.start, args.end)
+    logging.info(f"Replaying {sum(len(t) for t, _, _ in tables)} messages.")
+
+    context = zmq.Context()
+    socket = context.socket(zmq.PUB)
+    with socket.connect(args.socket):
+        # give subscribers time to connect, messages published before are dropped by zmq
+        time.sleep(0.5)
+        while True:
+            stats = replay(
+                iter_messages(tables),
+                lambda msg: socket.send_multipart([topic_frame(msg.topic), msg.serialize()]),
+                args.speed,
+            )
+            logging.info(f"Replay finished: {stats}")
+            if not args.loop:
+                break
@@ -1,22 +1,25 @@
 import socket
 import time
-from loraconfig import lora_hat_config
-from loraconfig import logging_config_dict
+from loraconfig import lora_hat_config, lora_hat_options
+from loraconfig import logging_config_dict, metrics_config
+import metrics
 from driver import LoRaHatDriver
 import logging
 import logging.config
 import pprint
 import sys
-from message import TextMessage
+from message import TextMessage, Topic
 
 logging.config.dictConfig(logging_config_dict)
+metrics.serve(**metrics_config)
 
 
 hostname = socket.gethostname()
-with LoRaHatDriver(lora_hat_config) as lora_hat:
+with LoRaHatDriver(lora_hat_config, **lora_hat_options) as lora_hat:
     logging.debug(pprint.pformat(lora_hat.config))
     print("Press \033[1;32mCtrl+C\033[0m to exit")
     while True:
         text = f"{hostname} local time is: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}\r\n"
-        lora_hat.send(TextMessage(text).serialize())
+        message = TextMessage(text, lora_hat.module_address, topic=Topic.TEXT)
+        lora_hat.send_message(message.serialize())
         time.sleep(2)
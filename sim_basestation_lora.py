@@ -4,10 +4,10 @@ import time
 import zmq
 import numpy as np
 
-from datetime import datetime
 
 import logging.config
 
+from lora_zmq import topic_frame
 from loraconfig import logging_config_dict
 from message import TimeOrientPosMessage, Topic
 
@@ -24,9 +24,9 @@ with socket.connect(socket_name):
     sender_iter = itertools.cycle([150, 151, 153])
     while True:
         data = np.empty(8, dtype=TimeOrientPosMessage.array_dtype)
-        data[0] = datetime.utcnow().timestamp()
+        data[0] = time.time()
         data[1:] = np.random.standard_normal(7)
         sender = next(sender_iter)
         message = TimeOrientPosMessage(data, sender, topic=Topic.ATTITUDE)
-        socket.send_multipart(["LORA".encode("utf-8"), message.serialize()])  # topic
+        socket.send_multipart([topic_frame(message.topic), message.serialize()])
         time.sleep(0.3)
@@ -0,0 +1,383 @@
+"""
+Discrete-event simulation of many nodes sharing a radio channel with one gateway.
+
+Every node behaves like msb_lora.py: it publishes a TimeOrientPosMessage per topic every interval seconds,
+keeps only the most recent one per topic while a transmission is in progress, packs them with
+BatchMessage.pack and sends them with the pacing of its LoRaHatDriver. The gateway decodes what it receives
+with the driver's frame decoder and reassembler and Message.decode, as basestation_lora.py does.
+
+Modelled are:
+- the serial transfer to the module at the configured baud rate and the module's buffer (MODULE_BUFFER_SIZE),
+- point to point headers and the split into packets of packet_len bytes,
+- the time on air at the configured air speed, see airtime.py,
+- listen before talk (if enabled): transmissions are deferred while the channel is busy, at most LBT_MAX_DELAY,
+- collisions with capture: a packet survives overlapping packets that are at least capture_db weaker.
+
+All nodes hear each other. Time is virtual, so hours of traffic are simulated in seconds:
+
+    python simulator.py --nodes 1 5 10 20 --interval 0.5 --air-speed AS_2_4K --duration 3600
+"""
+
+import argparse
+import heapq
+import json
+import logging
+import random
+from collections import deque
+from typing import Optional
+
+import numpy as np
+
+from airtime import time_on_air
+from driver import AIR_SPEED_MODULATION, MODULE_BUFFER_SIZE, PACKET_LEN_BYTES, AirSpeed, LoRaHatDriver, PacketLen
+from emulator import UART_IDLE_GAP, FakeGPIO
+from framing import encode_frame
+from loraconfig import lora_hat_config
+from message import BatchMessage, Message, TimeOrientPosMessage, Topic
+
+GATEWAY_ADDRESS = 0
+# Longest time a transmission is deferred by listen before talk, it is sent anyway afterwards.
+LBT_MAX_DELAY = 2.0
+# Random delay after the channel became free before listening again.
+LBT_BACKOFF = 0.02
+
+
+class _Transmission:
+    def __init__(self, node, payload: bytes, start: float, end: float):
+        self.node = node
+        self.payload = payload
+        self.start = start
+        self.end = end
+        self.collided = False
+
+
+class SimulatedNode:
+    """
+    A node with its LoRa hat.
+
+    :param simulator: The simulator the node belongs to.
+    :param config: The hat's configuration, see loraconfig.py.
+    :param rssi: RSSI of the node's packets at the gateway in dBm.
+    """
+
+    def __init__(self, simulator, config, rssi: float):
+        self.simulator = simulator
+        self.address = config["module_address"]
+        self.rssi = rssi
+        self.driver = LoRaHatDriver(config, port=None, gpio=FakeGPIO())
+        self.n_published = 0
+        self.n_superseded = 0
+        self.n_sent = 0
+        self.n_overflow = 0
+        self.n_lbt_deferrals = 0
+
+        # most recent message per topic, as in msb_lora.py
+        self._buffer = {}
+        self._sending = False
+        self._writes = deque()
+        self._tx_done = 0.0
+        self._uart_free = 0.0
+        # (payload, number of buffered bytes) of the radio packets in the module
+        self._radio_queue = deque()
+        self._n_buffered = 0
+        self._radio_busy = False
+        self._lbt_start = None
+
+    def publish(self, now: float, topics):
+        for topic in topics:
+            content = np.zeros(8, dtype=TimeOrientPosMessage.array_dtype)
+            # the sequence number identifies the sample at the gateway
+            content[0] = self.simulator.register_sample(self.address, now)
+            content[1] = 1
+            if topic in self._buffer:
+                self.n_superseded += 1
+            self._buffer[topic] = TimeOrientPosMessage(content, self.address, topic=topic)
+            self.n_published += 1
+        if not self._sending:
+            self._start_send(now)
+
+    def _start_send(self, now: float):
+        messages = list(self._buffer.values())
+        self._buffer.clear()
+        self._sending = True
+        for batch in BatchMessage.pack(messages, self.address, self.driver.packet_message_len):
+            for fragment in self.driver._fragmenter.split(batch.serialize()):
+                self._writes.append(self.driver.make_packet(encode_frame(fragment)))
+        self._write(now)
+
+    def _write(self, now: float):
+        # LoRaHatDriver.send on the virtual clock
+        while self._writes:
+            packet = self._writes[0]
+            delay = max(self.driver.tx_delay(len(packet), now), self.driver.write_delay(now))
+            if delay > 0:
+                self.simulator.schedule(now + delay, self._write)
+                return
+            self._writes.popleft()
+            self._tx_done = self.driver.register_tx(len(packet), now)
+            self._uart_free = max(self._uart_free, now) + len(packet) * self.driver.char_time()
+            self.simulator.schedule(self._uart_free, self._module_receive, packet)
+        # send_message(..., block=True)
+        self.simulator.schedule(self._tx_done, self._send_done)
+
+    def _send_done(self, now: float):
+        self._sending = False
+        if self._buffer:
+            self._start_send(now)
+
+    def _module_receive(self, now: float, data: bytes):
+        space = MODULE_BUFFER_SIZE - self._n_buffered
+        if len(data) > space:
+            logging.debug(f"Node {self.address}: module buffer is full, dropping {len(data) - space} bytes.")
+            self.n_overflow += len(data) - space
+            data = data[:space]
+        if not data:
+            return
+        self._n_buffered += len(data)
+
+        config = self.driver.config
+        header = b""
+        if config["enable_point_to_point_mode"]:
+            header, data = data[:3], data[3:]
+        packet_len = PACKET_LEN_BYTES[config["packet_len"]]
+        for i in range(0, len(data), packet_len):
+            payload = data[i : i + packet_len]
+            # the header is transmitted and freed with the first packet
+            n_buffered = len(payload) + (len(header) if i == 0 else 0)
+            self._radio_queue.append((header + payload, n_buffered))
+        if not self._radio_busy:
+            self._radio_busy = True
+            self.simulator.schedule(now + UART_IDLE_GAP, self._try_transmit)
+
+    def _try_transmit(self, now: float):
+        if not self._radio_queue:
+            self._radio_busy = False
+            return
+        if self.driver.config["enable_LBT"] and self.simulator.channel_busy():
+            if self._lbt_start is None:
+                self._lbt_start = now
+            if now - self._lbt_start < LBT_MAX_DELAY:
+                self.n_lbt_deferrals += 1
+                retry = self.simulator.channel_free_at() + self.simulator.random.uniform(0, LBT_BACKOFF)
+                self.simulator.schedule(retry, self._try_transmit)
+                return
+        self._lbt_start = None
+
+        payload, n_buffered = self._radio_queue.popleft()
+        spreading_factor, bandwidth = AIR_SPEED_MODULATION[self.driver.config["air_speed"]]
+        end = now + time_on_air(len(payload), spreading_factor, bandwidth)
+        self.simulator.transmit(_Transmission(self, payload, now, end))
+        self.simulator.schedule(end, self._tx_end, n_buffered)
+
+    def _tx_end(self, now: float, n_buffered: int):
+        self._n_buffered -= n_buffered
+        self.n_sent += 1
+        self._try_transmit(now)
+
+
+class Simulator:
+    """
+    Nodes sending to a gateway over a shared channel.
+
+    :param config: Configuration of the hats, see loraconfig.py. Module addresses are assigned by the simulator.
+    :param n_nodes: Number of nodes.
+    :param interval: Seconds between the samples a node publishes per topic.
+    :param topics: Topics every node publishes.
+    :param jitter: Random deviation of the publish times as fraction of the interval.
+    :param rssi_range: The RSSI of every node at the gateway is drawn uniformly from this range in dBm.
+    :param capture_db: A packet survives a collision if it is this much stronger than every overlapping packet.
+    :param seed: Seed of the random numbers.
+    """
+
+    def __init__(
+        self,
+        config,
+        n_nodes: int,
+        interval: float,
+        topics=(Topic.ATTITUDE,),
+        jitter: float = 0.1,
+        rssi_range=(-110.0, -60.0),
+        capture_db: float = 6.0,
+        seed: Optional[int] = None,
+    ):
+        self.interval = interval
+        self.topics = topics
+        self.jitter = jitter
+        self.capture_db = capture_db
+        self.random = random.Random(seed)
+        self.now = 0.0
+
+        self._events = []
+        self._n_scheduled = 0
+        self._on_air = []
+        self._busy_start = 0.0
+        self._samples = {}
+        self._sequence = 0
+
+        self.n_packets = 0
+        self.n_collisions = 0
+        self.busy_time = 0.0
+        self.air_time = 0.0
+        self.latencies = []
+
+        gateway_config = dict(config, module_address=GATEWAY_ADDRESS, target_address=GATEWAY_ADDRESS)
+        self.gateway = LoRaHatDriver(gateway_config, port=None, gpio=FakeGPIO())
+        self.nodes = []
+        for i in range(n_nodes):
+            node_config = dict(config, module_address=i + 1, target_address=GATEWAY_ADDRESS)
+            self.nodes.append(SimulatedNode(self, node_config, self.random.uniform(*rssi_range)))
+
+    def schedule(self, time: float, callback, *args):
+        """Call callback(time, *args) at the virtual time."""
+        heapq.heappush(self._events, (time, self._n_scheduled, callback, args))
+        self._n_scheduled += 1
+
+    def register_sample(self, sender: int, now: float) -> int:
+        """Remember when a sample was created, returns its sequence number."""
+        self._sequence += 1
+        self._samples[(sender, self._sequence)] = now
+        return self._sequence
+
+    def channel_busy(self) -> bool:
+        return bool(self._on_air)
+
+    def channel_free_at(self) -> float:
+        return max(transmission.end for transmission in self._on_air)
+
+    def transmit(self, transmission: _Transmission):
+        if not self._on_air:
+            self._busy_start = transmission.start
+        for other in self._on_air:
+            if transmission.node.rssi - other.node.rssi < self.capture_db:
+                transmission.collided = True
+            if other.node.rssi - transmission.node.rssi < self.capture_db:
+                other.collided = True
+        self._on_air.append(transmission)
+        self.air_time += transmission.end - transmission.start
+        self.schedule(transmission.end, self._end_transmission, transmission)
+
+    def _end_transmission(self, now: float, transmission: _Transmission):
+        self._on_air.remove(transmission)
+        if not self._on_air:
+            self.busy_time += now - self._busy_start
+        self.n_packets += 1
+        if transmission.collided:
+            self.n_collisions += 1
+            return
+
+        payload = transmission.payload
+        if self.gateway.enable_point_to_point_mode:
+            # the receiving module does not output the header
+            payload = payload[3:]
+        # the gateway's module outputs the packet on its serial port
+        delivered = now + len(payload) * self.gateway.char_time()
+        for fragment in self.gateway._frame_decoder.feed(payload):
+            message = self.gateway._reassembler.add(fragment, now=delivered)
+            if message is not None:
+                self._deliver(message, delivered)
+
+    def _deliver(self, bytes_: bytes, now: float):
+        message = Message.decode(bytes_)
+        messages = message.unpack() if isinstance(message, BatchMessage) else [message]
+        for message in messages:
+            created = self._samples.pop((int(message.sender), int(message.content[0])), None)
+            if created is not None:
+                self.latencies.append(now - created)
+
+    def _publish(self, now: float, node: SimulatedNode, duration: float):
+        node.publish(now, self.topics)
+        next_time = now + self.interval * (1 + self.random.uniform(-self.jitter, self.jitter))
+        if next_time < duration:
+            self.schedule(next_time, self._publish, node, duration)
+
+    def run(self, duration: float) -> dict:
+        """
+        Publish for duration seconds of virtual time and process all events until the channel is idle.
+
+        :param duration: Simulated time in seconds.
+        :return: The results, see results().
+        """
+        for node in self.nodes:
+            self.schedule(self.random.uniform(0, self.interval), self._publish, node, duration)
+        while self._events:
+            self.now, _, callback, args = heapq.heappop(self._events)
+            callback(self.now, *args)
+        return self.results()
+
+    def results(self) -> dict:
+        n_published = sum(node.n_published for node in self.nodes)
+        n_delivered = len(self.latencies)
+        elapsed = max(self.now, 1e-9)
+        result = {
+            "nodes": len(self.nodes),
+            "elapsed_s": self.now,
+            "published": n_published,
+            "delivered": n_delivered,
+            "pdr": n_delivered / n_published if n_published else 0.0,
+            "superseded": sum(node.n_superseded for node in self.nodes),
+            "packets": self.n_packets,
+            "collisions": self.n_collisions,
+            "lbt_deferrals": sum(node.n_lbt_deferrals for node in self.nodes),
+            "overflow_bytes": sum(node.n_overflow for node in self.nodes),
+            "channel_utilisation": self.busy_time / elapsed,
+            "offered_load": self.air_time / elapsed,
+        }
+        if self.latencies:
+            latencies = np.array(self.latencies)
+            result["latency_mean_s"] = float(latencies.mean())
+            for percentile in (50, 90, 99):
+                result[f"latency_p{percentile}_s"] = float(np.percentile(latencies, percentile))
+            result["latency_max_s"] = float(latencies.max())
+        return result
+
+
+def print_results(results):
+    print(
+        f"{'nodes':>6}{'pdr':>8}{'p50':>9}{'p99':>9}{'util':>7}{'load':>7}"
+        f"{'collided':>10}{'lbt':>7}{'overflow':>10}"
+    )
+    for result in results:
+        print(
+            f"{result['nodes']:>6}{result['pdr']:>8.3f}"
+            f"{result.get('latency_p50_s', float('nan')) * 1e3:>7.0f}ms"
+            f"{result.get('latency_p99_s', float('nan')) * 1e3:>7.0f}ms"
+            f"{result['channel_utilisation']:>7.2f}{result['offered_load']:>7.2f}"
+            f"{result['collisions']:>10}{result['lbt_deferrals']:>7}{result['overflow_bytes']:>9}B"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--nodes", type=int, nargs="+", default=[1, 2, 5, 10, 20])
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between samples")
+    parser.add_argument("--topics", nargs="+", default=["ATTITUDE"], choices=[t.name for t in Topic])
+    parser.add_argument("--air-speed", default=lora_hat_config["air_speed"].name, choices=[a.name for a in AirSpeed])
+    parser.add_argument("--packet-len", default=lora_hat_config["packet_len"].name, choices=[p.name for p in PacketLen])
+    parser.add_argument("--lbt", action="store_true", help="enable listen before talk")
+    parser.add_argument("--capture-db", type=float, default=6.0)
+    parser.add_argument("--duration", type=float, default=600.0, help="simulated seconds")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    config = dict(
+        lora_hat_config,
+        air_speed=AirSpeed[args.air_speed],
+        packet_len=PacketLen[args.packet_len],
+        enable_LBT=args.lbt,
+    )
+    results = []
+    for n_nodes in args.nodes:
+        simulator = Simulator(
+            config,
+            n_nodes,
+            args.interval,
+            topics=[Topic[name] for name in args.topics],
+            capture_db=args.capture_db,
+            seed=args.seed,
+        )
+        results.append(simulator.run(args.duration))
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
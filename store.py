@@ -0,0 +1,294 @@
+"""
+Append-only columnar store for received messages.
+
+Messages are stored per Message class in fixed-width NumPy record segments:
+
+    <directory>/<class name>/index.json
+    <directory>/<class name>/000000.npy, 000001.npy, ...
+
+Every record has the columns receive_time (time.time(), float64), sender, topic and content.
+The content column holds the array of NumpyMessages and the serialized content of other messages
+(content_len bytes of a fixed-width byte string).
+
+Segments are .npy files of segment_len records that are preallocated and filled through a memory map,
+so readers can np.load(path, mmap_mode="r") them. index.json lists the segments with their number of
+valid records and is replaced atomically on flush. After a crash, records written after the last flush
+are recovered from the last segment: unused records have a receive_time of 0.
+
+For queries (see query.py) the index also holds the senders and topics of every segment and a sparse
+time index: the range of receive times of every block of BLOCK_LEN records.
+
+    with MessageStore("persist_lora") as store:
+        store.append(message)
+
+    for records in read_segments("persist_lora", "TimeOrientPosMessage"):
+        records["content"][:, 0]
+"""
+
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+import numpy as np
+
+from message import Message, NumpyMessage, topic_from_id, topic_id
+
+INDEX_FILE = "index.json"
+# Number of records per entry of the sparse time index.
+BLOCK_LEN = 1024
+# Width of the content column of messages that are not NumpyMessages.
+MAX_CONTENT_LEN = 255
+
+
+def record_dtype(message: Message) -> np.dtype:
+    """The record dtype of the message's class."""
+    fields = [("receive_time", "<f8"), ("sender", "<u2"), ("topic", "u1")]
+    if isinstance(message, NumpyMessage):
+        fields.append(("content", message.content.dtype.newbyteorder("<"), message.content.shape))
+    else:
+        fields += [("content_len", "<u2"), ("content", f"S{MAX_CONTENT_LEN}")]
+    return np.dtype(fields)
+
+
+def message_from_record(message_cls, record) -> Message:
+    """
+    Make a message from a stored record.
+
+    :param message_cls: The Message class the record was stored for.
+    :param record: The record.
+    :return: The message.
+    """
+    topic = topic_from_id(int(record["topic"]))
+    if issubclass(message_cls, NumpyMessage):
+        content = np.array(record["content"], dtype=message_cls.array_dtype)
+    else:
+        content = message_cls._deserialize(bytes(record["content"][: record["content_len"]]))
+    return message_cls(content, int(record["sender"]), topic)
+
+
+def segment_stats(records: np.ndarray) -> dict:
+    """The index entries of a segment's valid records, see module docstring."""
+    times = records["receive_time"]
+    return {
+        "senders": np.unique(records["sender"]).tolist(),
+        "topics": np.unique(records["topic"]).tolist(),
+        "blocks": [
+            [float(times[i : i + BLOCK_LEN].min()), float(times[i : i + BLOCK_LEN].max())]
+            for i in range(0, len(times), BLOCK_LEN)
+        ],
+    }
+
+
+def segment_path(directory: str, name: str, segment: dict) -> str:
+    return os.path.join(directory, name, segment["file"])
+
+
+def load_index(directory: str, name: str) -> Optional[dict]:
+    """The index of a message class or None if nothing has been stored for it."""
+    try:
+        with open(os.path.join(directory, name, INDEX_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def table_names(directory: str) -> list:
+    """The names of the Message classes that have been stored, sorted."""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(name for name in names if os.path.isfile(os.path.join(directory, name, INDEX_FILE)))
+
+
+def read_segments(directory: str, name: str):
+    """
+    Memory map the stored records of a message class.
+
+    :param directory: Directory of the store.
+    :param name: Name of the Message class.
+    :return: Generator of the valid records of every segment, oldest first.
+    """
+    index = load_index(directory, name)
+    if index is None:
+        return
+    for segment in index["segments"]:
+        if segment["count"]:
+            records = np.load(segment_path(directory, name, segment), mmap_mode="r")
+            yield records[: segment["count"]]
+
+
+def read(directory: str, name: str) -> np.ndarray:
+    """All stored records of a message class in one array."""
+    segments = list(read_segments(directory, name))
+    if not segments:
+        return np.empty(0)
+    return np.concatenate(segments)
+
+
+class _Table:
+    # the segments of one message class
+    def __init__(self, directory: str, dtype: np.dtype, segment_len: int, max_segments: Optional[int]):
+        self.directory = directory
+        self.segment_len = segment_len
+        self.max_segments = max_segments
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(os.path.join(directory, INDEX_FILE)) as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            self.index = {"dtype": str(dtype.descr), "segments": []}
+        if self.index["dtype"] != str(dtype.descr):
+            raise ValueError(f"{directory} holds records of another dtype: {self.index['dtype']}.")
+
+        self.records = None
+        if self.index["segments"]:
+            segment = self.index["segments"][-1]
+            self.records = np.load(os.path.join(directory, segment["file"]), mmap_mode="r+")
+            # recover records written after the last flush
+            count = segment["count"]
+            while count < len(self.records) and self.records[count]["receive_time"] > 0:
+                count += 1
+            if count > segment["count"]:
+                logging.info(f"Recovered {count - segment['count']} records in {directory}.")
+                segment["count"] = count
+                segment.update(segment_stats(self.records[:count]))
+        if self.records is None or self.index["segments"][-1]["count"] == len(self.records):
+            self._new_segment(dtype)
+        self.dirty = False
+
+    def append(self, record):
+        segment = self.index["segments"][-1]
+        count = segment["count"]
+        self.records[count] = record
+        segment["count"] += 1
+
+        receive_time, sender, topic = record[:3]
+        if count % BLOCK_LEN == 0:
+            segment["blocks"].append([receive_time, receive_time])
+        else:
+            block = segment["blocks"][-1]
+            block[0] = min(block[0], receive_time)
+            block[1] = max(block[1], receive_time)
+        if sender not in segment["senders"]:
+            segment["senders"].append(sender)
+        if topic not in segment["topics"]:
+            segment["topics"].append(topic)
+        self.dirty = True
+        if segment["count"] == len(self.records):
+            self._new_segment(self.records.dtype)
+
+    def _new_segment(self, dtype: np.dtype):
+        segments = self.index["segments"]
+        number = 0
+        if segments:
+            self.records.flush()
+            number = int(segments[-1]["file"].split(".")[0]) + 1
+        file = f"{number:06d}.npy"
+        self.records = np.lib.format.open_memmap(
+            os.path.join(self.directory, file), mode="w+", dtype=dtype, shape=(self.segment_len,)
+        )
+        segments.append({"file": file, "count": 0, "senders": [], "topics": [], "blocks": []})
+        removed = []
+        if self.max_segments is not None and len(segments) > self.max_segments:
+            removed = segments[: -self.max_segments]
+            del segments[: -self.max_segments]
+        self.flush()
+        # delete after the index does not reference them anymore
+        for segment in removed:
+            os.remove(os.path.join(self.directory, segment["file"]))
+
+    def flush(self):
+        self.records.flush()
+        path = os.path.join(self.directory, INDEX_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        self.dirty = False
+
+    def close(self):
+        self.flush()
+        self.records = None
+
+
+class MessageStore:
+    """
+    Writes received messages to the store.
+
+    :param directory: Directory of the store.
+    :param segment_len: Number of records per segment file.
+    :param flush_interval: Seconds after which appended records are committed to the index.
+    :param max_segments: Number of segments to keep per message class, older ones are deleted.
+    None keeps everything.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        segment_len: int = 2 ** 16,
+        flush_interval: float = 1.0,
+        max_segments: Optional[int] = None,
+    ):
+        self.directory = directory
+        self.segment_len = segment_len
+        self.flush_interval = flush_interval
+        self.max_segments = max_segments
+        self.n_appended = 0
+        self._tables = {}
+        self._last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def append(self, message: Message, receive_time: Optional[float] = None):
+        """
+        Store a message.
+
+        :param message: The message.
+        :param receive_time: time.time() of reception, defaults to now.
+        """
+        name = type(message).__name__
+        table = self._tables.get(name)
+        if table is None:
+            table = self._tables[name] = _Table(
+                os.path.join(self.directory, name),
+                record_dtype(message),
+                self.segment_len,
+                self.max_segments,
+            )
+        if receive_time is None:
+            receive_time = time.time()
+        record = (float(receive_time), int(message.sender), topic_id(message.topic))
+        if isinstance(message, NumpyMessage):
+            record += (message.content,)
+        else:
+            content = message._serialize()
+            if len(content) > MAX_CONTENT_LEN:
+                logging.warning(f"Truncating {name} content of {len(content)} bytes.")
+                content = content[:MAX_CONTENT_LEN]
+            record += (len(content), content)
+        table.append(record)
+        self.n_appended += 1
+
+        now = time.monotonic()
+        if now - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Commit all appended records to the indices."""
+        for table in self._tables.values():
+            if table.dirty:
+                table.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        for table in self._tables.values():
+            table.close()
+        self._tables.clear()
@@ -0,0 +1,310 @@
+"""
+Time division of the uplink.
+
+Without coordination the nodes send whenever they have data, so packets of different nodes collide like in
+pure ALOHA. With TDMA the basestation (TdmaScheduler) starts every frame with a BeaconMessage that carries its
+time and the slot assignment, and every node (TdmaNode) only transmits in its own slot:
+
+    | beacon + downlink | slot 0 | slot 1 | ... | beacon + downlink | slot 0 | ...
+
+Slot lengths follow from the estimated time on air of packet_len bytes at the current air speed, see
+LoRaHatDriver.time_on_air, so they shrink with faster air speeds (see adr.py). Every slot ends with a guard
+time that covers the error of the estimate and of the synchronisation of the nodes' clocks to the beacon.
+
+Nodes that are not in the assignment, e.g. a node that was not heard yet, and nodes that lost the beacon for
+beacon_timeout seconds send at once. The basestation assigns a slot to every sender it hears.
+
+    scheduler = TdmaScheduler(lora_hat, nodes=[150, 151, 153])    # basestation
+    while True:
+        timeout = scheduler.poll(lora_hat)
+        for message in lora_hat.receive_messages(timeout):
+            scheduler.observe(message)
+
+    node = TdmaNode(150)                                            # node
+    for message, packet in lora_hat.receive_messages(timeout=0, metadata=True):
+        node.handle(message, packet, lora_hat)
+    lora_hat.listen(node.delay(lora_hat, len(message)))
+    tx_done = lora_hat.send_message(message)
+    lora_hat.listen(tx_done - time.monotonic())
+
+The node has to read the beacon when it arrives, so it waits with LoRaHatDriver.listen instead of time.sleep.
+"""
+
+import logging
+import math
+import struct
+import time
+from typing import Optional
+
+import metrics
+from adr import BROADCAST_ADDRESS
+from driver import PACKET_LEN_BYTES
+from message import DeserializeError, Message, Topic, register_topic
+
+# Share of the time on air of a packet added to the guard time, AIR_SPEED_MODULATION is only an estimate.
+GUARD_FRACTION = 0.1
+
+_slot_wait = metrics.histogram("lora_tdma_slot_wait_seconds", "Time messages waited for the node's slot.")
+
+
+def guard_time(lora_hat, clock_error: float = 0.01) -> float:
+    """
+    Idle time at the end of every slot.
+
+    :param lora_hat: The LoRaHatDriver.
+    :param clock_error: Error of the synchronisation of the nodes' clocks in seconds.
+    """
+    packet_air = lora_hat.time_on_air(PACKET_LEN_BYTES[lora_hat.packet_len])
+    # the nodes detect the end of the beacon only after the idle gap
+    return GUARD_FRACTION * packet_air + lora_hat.idle_gap() + clock_error
+
+
+def transmit_time(lora_hat, n_packets: int) -> float:
+    """
+    Time from writing n_packets full packets to the module until the last one is on air.
+
+    The module starts transmitting once the first packet is transferred, later packets are transferred while
+    the previous one is on air.
+    """
+    packet_len = PACKET_LEN_BYTES[lora_hat.packet_len]
+    return packet_len * lora_hat.char_time() + n_packets * lora_hat.time_on_air(packet_len)
+
+
+class BeaconMessage(Message):
+    """
+    Frame start and slot assignment broadcast by the basestation.
+
+    Content is a dict with
+    - time: time.time() of the basestation at the start of the frame, when the beacon was written
+    - first_slot: seconds from the start of the frame to the first slot
+    - slot_duration: seconds per slot, including the guard time
+    - guard: guard time in seconds at the end of every slot
+    - slots: node addresses in the order of their slots
+    """
+
+    topic = Topic.BEACON
+    _header = struct.Struct(">dfff")
+    _entry = struct.Struct(">H")
+
+    def __init__(self, content, sender: int, topic: Topic = Topic.BEACON):
+        super().__init__(content, sender, topic)
+
+    @classmethod
+    def _check_content(cls, content):
+        return {
+            "time": float(content["time"]),
+            "first_slot": float(content["first_slot"]),
+            "slot_duration": float(content["slot_duration"]),
+            "guard": float(content["guard"]),
+            "slots": [int(address) for address in content["slots"]],
+        }
+
+    def _serialize(self):
+        content = self.content
+        parts = [
+            self._header.pack(content["time"], content["first_slot"], content["slot_duration"], content["guard"])
+        ]
+        parts += [self._entry.pack(address) for address in content["slots"]]
+        return b"".join(parts)
+
+    @classmethod
+    def _deserialize(cls, bytes_: bytes):
+        bytes_ = bytes(bytes_)
+        time_, first_slot, slot_duration, guard = cls._header.unpack_from(bytes_)
+        entries = bytes_[cls._header.size :]
+        if len(entries) % cls._entry.size:
+            raise ValueError("Truncated slot entry.")
+        return {
+            "time": time_,
+            "first_slot": first_slot,
+            "slot_duration": slot_duration,
+            "guard": guard,
+            "slots": [address for (address,) in cls._entry.iter_unpack(entries)],
+        }
+
+    @property
+    def frame_duration(self) -> float:
+        return self.content["first_slot"] + len(self.content["slots"]) * self.content["slot_duration"]
+
+
+register_topic(Topic.BEACON, BeaconMessage)
+
+
+class TdmaScheduler:
+    """
+    Starts the frames on the basestation, see module docstring.
+
+    :param lora_hat: The basestation's LoRaHatDriver.
+    :param nodes: Node addresses that get a slot from the start.
+    :param packets_per_slot: Number of full packets a node can send per slot.
+    :param downlink_packets: Number of full packets the basestation can send per frame, the beacon included.
+    :param clock_error: Error of the synchronisation of the nodes' clocks in seconds, see guard_time.
+    :param max_nodes: Maximum number of slots, senders heard later do not get one.
+    """
+
+    def __init__(
+        self,
+        lora_hat,
+        nodes=(),
+        packets_per_slot: int = 1,
+        downlink_packets: int = 2,
+        clock_error: float = 0.01,
+        max_nodes: int = 32,
+    ):
+        if packets_per_slot < 1 or downlink_packets < 1:
+            raise ValueError("packets_per_slot and downlink_packets must be positive.")
+        self.address = lora_hat.config["module_address"]
+        self.slots = list(nodes)[:max_nodes]
+        self.packets_per_slot = packets_per_slot
+        self.downlink_packets = downlink_packets
+        self.clock_error = clock_error
+        self.max_nodes = max_nodes
+        self.n_beacons = 0
+        # time.time() of the start of the current frame and of the end of its downlink
+        self._frame_start = None
+        self._downlink_end = None
+        self._next_frame = None
+
+    def observe(self, message: bytes):
+        """Assign a slot to the sender of a received message if it has none, from the next frame on."""
+        try:
+            _, sender, _ = Message.parse_header(message)
+        except DeserializeError:
+            return
+        sender = int(sender)
+        if sender in self.slots:
+            return
+        if len(self.slots) >= self.max_nodes:
+            logging.debug(f"No slot left for {sender}.")
+            return
+        logging.info(f"Assigning slot {len(self.slots)} to {sender}.")
+        self.slots.append(sender)
+
+    def beacon(self, lora_hat, now: float) -> BeaconMessage:
+        """The beacon of a frame starting now, its slot lengths follow the current air speed and packet length."""
+        guard = guard_time(lora_hat, self.clock_error)
+        content = {
+            "time": now,
+            "first_slot": transmit_time(lora_hat, self.downlink_packets) + guard,
+            "slot_duration": transmit_time(lora_hat, self.packets_per_slot) + guard,
+            "guard": guard,
+            "slots": self.slots,
+        }
+        return BeaconMessage(content, self.address)
+
+    def poll(self, lora_hat, now: Optional[float] = None) -> float:
+        """
+        Start a frame if it is due.
+
+        :param lora_hat: The basestation's LoRaHatDriver.
+        :param now: time.time(), for testing.
+        :return: Seconds until poll has to be called again.
+        """
+        now = time.time() if now is None else now
+        if self._next_frame is None or now >= self._next_frame:
+            beacon = self.beacon(lora_hat, now)
+            lora_hat.send_message(beacon.serialize(), target_address=BROADCAST_ADDRESS)
+            self.n_beacons += 1
+            self._frame_start = now
+            self._next_frame = now + beacon.frame_duration
+            # other downlink messages have to be on air before the first slot
+            self._downlink_end = (
+                now
+                + beacon.content["first_slot"]
+                - beacon.content["guard"]
+                - transmit_time(lora_hat, 1)
+            )
+        return max(self._next_frame - now, 0)
+
+    def in_downlink(self, now: Optional[float] = None) -> bool:
+        """Whether a packet sent now, e.g. a RateMessage, is on air before the first slot of the frame."""
+        now = time.time() if now is None else now
+        return self._frame_start is not None and self._frame_start <= now <= self._downlink_end
+
+
+class TdmaNode:
+    """
+    Keeps a node's transmissions in its slot, see module docstring.
+
+    :param address: The node's address, the sender of its messages.
+    :param beacon_timeout: Seconds without a beacon after which the node sends at once.
+    """
+
+    def __init__(self, address: int, beacon_timeout: float = 10.0):
+        self.address = address
+        self.beacon_timeout = beacon_timeout
+        self.n_beacons = 0
+        self.beacon = None
+        # basestation time minus local time.time()
+        self.offset = 0.0
+        self._last_heard = None
+
+    def handle(self, message: bytes, packet, lora_hat) -> bool:
+        """
+        Synchronise to a received beacon.
+
+        :param message: Any received serialized message.
+        :param packet: The driver.Packet that completed it, see LoRaHatDriver.receive_messages. It has to be read
+        on arrival, see LoRaHatDriver.listen.
+        :param lora_hat: The node's LoRaHatDriver, to estimate the delay of the beacon.
+        :return: Whether it was a BeaconMessage.
+        """
+        try:
+            topic, _, _ = Message.parse_header(message)
+            if topic != Topic.BEACON:
+                return False
+            beacon = BeaconMessage.from_bytes(message)
+        except DeserializeError:
+            return False
+        # transferred to the basestation's module, on air, transferred from the node's module
+        n_bytes = len(packet.data)
+        delay = lora_hat.time_on_air(n_bytes) + 2 * n_bytes * lora_hat.char_time() + lora_hat.idle_gap()
+        self.offset = beacon.content["time"] + delay - packet.time
+        self.beacon = beacon
+        self._last_heard = packet.time
+        self.n_beacons += 1
+        return True
+
+    def synchronised(self, now: Optional[float] = None) -> bool:
+        """Whether a beacon was heard within beacon_timeout."""
+        now = time.time() if now is None else now
+        return self._last_heard is not None and now - self._last_heard < self.beacon_timeout
+
+    def delay(self, lora_hat, n_bytes: int, now: Optional[float] = None) -> float:
+        """
+        Time to wait before a message can be sent within the node's slot.
+
+        The transmission may start up to half the guard time late, e.g. because the sleep until the slot
+        overslept, the other half is left for the synchronisation error. A message longer than a slot is sent
+        at the start of the next slot and overruns it.
+
+        :param lora_hat: The node's LoRaHatDriver.
+        :param n_bytes: Length of the serialized message.
+        :param now: time.time(), for testing.
+        :return: Seconds to wait, 0 if the node is not synchronised or has no slot.
+        """
+        now = time.time() if now is None else now
+        if not self.synchronised(now):
+            if self._last_heard is not None:
+                logging.warning(f"No beacon for {self.beacon_timeout} s, sending without slot.")
+                self._last_heard = None
+                self.beacon = None
+            return 0.0
+        content = self.beacon.content
+        if self.address not in content["slots"]:
+            return 0.0
+
+        n_packets = max(math.ceil(n_bytes / lora_hat.packet_message_len), 1)
+        duration = transmit_time(lora_hat, n_packets)
+        period = self.beacon.frame_duration
+        basestation_now = now + self.offset
+        frame = math.floor((basestation_now - content["time"]) / period)
+        slot = content["first_slot"] + content["slots"].index(self.address) * content["slot_duration"]
+        wait = None
+        for start in (content["time"] + k * period + slot for k in (frame, frame + 1)):
+            latest = max(start + content["slot_duration"] - content["guard"] / 2 - duration, start)
+            if basestation_now <= latest:
+                wait = max(start - basestation_now, 0.0)
+                break
+        _slot_wait.observe(wait)
+        return wait
@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+import driver
+from driver import LoRaHatDriver
+from loraconfig import lora_hat_config
+
+
+class FakeGPIO:
+    BCM = OUT = LOW = 0
+    HIGH = 1
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+@pytest.fixture
+def pty_pair(monkeypatch):
+    """Serial port name of a pseudo terminal and the fd of its other end."""
+    monkeypatch.setattr(driver, "GPIO", FakeGPIO())
+    master, slave = os.openpty()
+    yield os.ttyname(slave), master
+    os.close(master)
+    os.close(slave)
+
+
+@pytest.fixture
+def hat_on_pty(pty_pair):
+    port, master = pty_pair
+    lora_hat = LoRaHatDriver(lora_hat_config)
+    lora_hat.ser.port = port
+    lora_hat.ser.open()
+    yield lora_hat, master
+    lora_hat.ser.close()
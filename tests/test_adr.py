@@ -0,0 +1,156 @@
+import time
+
+import pytest
+
+from adr import RateController, RateFollower, RateMessage, sensitivity
+from driver import AirSpeed, LoRaHatDriver, Packet, TransmitPower
+from emulator import Air, LoRaHatEmulator
+from loraconfig import lora_hat_config
+from message import Message, TextMessage, Topic
+
+
+def make_config(**kwargs):
+    config = dict(
+        lora_hat_config,
+        module_address=0xFFFF,
+        enable_point_to_point_mode=False,
+        enable_RSSI_byte=True,
+        air_speed=AirSpeed.AS_9_6K,
+    )
+    config.update(kwargs)
+    return config
+
+
+def observe(controller, sender, message_ids, rssi, now=0.0):
+    message = TextMessage("data", sender, Topic.TEXT).serialize()
+    for message_id in message_ids:
+        controller.observe(message, Packet(b"", rssi, 0.0, message_id), now)
+
+
+def test_rate_message():
+    content = {
+        "air_speed": AirSpeed.AS_19_2K,
+        "switch_in": 1.5,
+        "transmit_power": {150: TransmitPower.TP_10dBm, 153: TransmitPower.TP_17dBm},
+    }
+    decoded = Message.decode(RateMessage(content, 1).serialize())
+    assert isinstance(decoded, RateMessage)
+    assert decoded.content == content
+    assert sensitivity(AirSpeed.AS_0_3K) < sensitivity(AirSpeed.AS_62_5K)
+
+
+def test_controller_speeds_up_strong_links_and_slows_down_on_losses():
+    controller = RateController(make_config(), min_samples=5)
+    observe(controller, 150, range(10), rssi=-60)
+    observe(controller, 151, range(100, 110), rssi=-70)
+    air_speed, powers = controller.decide()
+    # one step at a time
+    assert air_speed == AirSpeed.AS_19_2K
+    assert powers == {150: TransmitPower.TP_10dBm, 151: TransmitPower.TP_10dBm}
+
+    # a weak link at full power loses every other message
+    controller = RateController(make_config(), min_samples=5)
+    observe(controller, 150, range(10), rssi=-60)
+    observe(controller, 152, range(0, 20, 2), rssi=-115)
+    assert controller.links[152].pdr() < 0.6
+    air_speed, powers = controller.decide()
+    assert air_speed == AirSpeed.AS_4_8K
+    assert 152 not in powers
+
+
+def test_controller_falls_back_if_a_node_is_lost_after_a_switch():
+    class Hat:
+        def __init__(self):
+            self.sent = []
+
+        def reconfigure(self, **changes):
+            return True
+
+        def send_message(self, message, block=False, target_address=None):
+            self.sent.append(Message.decode(message))
+
+    hat = Hat()
+    controller = RateController(make_config(), min_samples=5, lead=1.0, fallback_timeout=10.0)
+    observe(controller, 150, range(10), rssi=-60)
+    controller.poll(hat, now=0.0)
+    assert hat.sent[-1].content["air_speed"] == AirSpeed.AS_19_2K
+    assert hat.sent[-1].content["switch_in"] == 1.0
+    controller.poll(hat, now=1.0)
+    assert controller.air_speed == AirSpeed.AS_19_2K
+
+    controller.poll(hat, now=12.0)
+    assert controller.n_fallbacks == 1
+    assert hat.sent[-1].content["air_speed"] == AirSpeed.AS_9_6K
+    controller.poll(hat, now=13.0)
+    assert controller.air_speed == AirSpeed.AS_9_6K
+    # the air speed that failed is not tried again for a while
+    observe(controller, 150, range(20, 30), rssi=-60, now=13.5)
+    assert controller.decide()[0] == AirSpeed.AS_9_6K
+
+
+def test_controller_switches_outside_the_downlink():
+    class Hat:
+        def __init__(self):
+            self.sent = []
+
+        def reconfigure(self, **changes):
+            return True
+
+        def send_message(self, message, block=False, target_address=None):
+            self.sent.append(Message.decode(message))
+
+    hat = Hat()
+    controller = RateController(make_config(), min_samples=5, lead=1.0, announce_interval=2.0)
+    observe(controller, 150, range(10), rssi=-60)
+    # nothing is decided or sent without permission to send
+    assert controller.poll(hat, now=0.0, announce=False) == float("inf")
+    assert hat.sent == [] and controller._switch is None
+    controller.poll(hat, now=0.0)
+    assert len(hat.sent) == 1
+    assert controller.poll(hat, now=0.5, announce=False) == 0.5
+    controller.poll(hat, now=1.0, announce=False)
+    assert controller.air_speed == AirSpeed.AS_19_2K
+    # the announcement waits for the next downlink
+    controller.poll(hat, now=3.0, announce=False)
+    assert len(hat.sent) == 1
+    controller.poll(hat, now=3.5)
+    assert len(hat.sent) == 2 and hat.sent[-1].content["switch_in"] is None
+
+
+def test_follower_measures_switch_from_arrival():
+    content = {"air_speed": AirSpeed.AS_19_2K, "switch_in": 1.0, "transmit_power": {}}
+    message = RateMessage(content, 0).serialize()
+    follower = RateFollower(150, make_config())
+    # read 0.3 s after it arrived
+    assert follower.handle(message, Packet(b"", None, time.time() - 0.3), now=100.0)
+    assert follower._switch[0] == pytest.approx(100.7, abs=0.05)
+
+
+def test_coordinated_switch():
+    air = Air(rssi=-60)
+    with LoRaHatEmulator(air) as base_emulator, LoRaHatEmulator(air) as node_emulator:
+        with LoRaHatDriver(make_config(), base_emulator.port, base_emulator.gpio) as base, LoRaHatDriver(
+            make_config(module_address=0), node_emulator.port, node_emulator.gpio
+        ) as node:
+            controller = RateController(base.config, min_samples=5, lead=0.3, announce_interval=0.2)
+            # the transmit power is looked up by the sender of the node's messages, not its module address
+            follower = RateFollower(150, node.config)
+            deadline = time.monotonic() + 10
+            while controller.n_switches < 1 or follower.n_switches < 1:
+                assert time.monotonic() < deadline
+                node.send_message(TextMessage("data", 150, Topic.TEXT).serialize(), block=True)
+                for message, packet in base.receive_messages(timeout=0.05, metadata=True):
+                    controller.observe(message, packet)
+                controller.poll(base)
+                follower.receive(node)
+                follower.poll(node)
+
+            assert base.air_speed == node.air_speed == AirSpeed.AS_19_2K
+            assert node.transmit_power == TransmitPower.TP_10dBm
+            # the link works at the new air speed
+            node.send_message(TextMessage("fast", 150, Topic.TEXT).serialize(), block=True)
+            received = []
+            while not received:
+                assert time.monotonic() < deadline
+                received += base.receive_messages(timeout=0.1)
+            assert TextMessage.from_bytes(received[-1]).content == "fast"
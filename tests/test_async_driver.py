@@ -0,0 +1,60 @@
+import asyncio
+import os
+
+from async_driver import AsyncLoRaHatDriver
+from fragment import Fragmenter, Reassembler
+from framing import FrameDecoder, encode_frame
+from loraconfig import lora_hat_config
+
+
+def test_send_and_receive_frames(pty_pair):
+    port, master = pty_pair
+
+    async def run():
+        lora_hat = AsyncLoRaHatDriver({**lora_hat_config, "target_address": 0xFFFF})
+        lora_hat.driver.ser.port = port
+        lora_hat.driver.ser.open()
+        lora_hat.start()
+        try:
+            await lora_hat.send(b"ping")
+            fragmenter = Fragmenter(lora_hat.driver.fragment_len)
+            long_message = bytes(range(256)) * 2
+            for message in [b"pong", long_message]:
+                for fragment in fragmenter.split(message):
+                    os.write(master, encode_frame(fragment))
+            received = [await lora_hat.receive(timeout=1)]
+            async for frame in lora_hat:
+                received.append(frame)
+                break
+            return received
+        finally:
+            lora_hat.stop()
+            lora_hat.driver.ser.close()
+
+    assert asyncio.run(run()) == [b"pong", bytes(range(256)) * 2]
+    written = os.read(master, 1024)
+    # point to point mode prepends the 3 byte address header
+    assert Reassembler().add(FrameDecoder().feed(written[3:])[0]) == b"ping"
+
+
+def test_rssi_bytes_are_removed(pty_pair):
+    port, master = pty_pair
+
+    async def run():
+        lora_hat = AsyncLoRaHatDriver({**lora_hat_config, "enable_RSSI_byte": True})
+        lora_hat.driver.ser.port = port
+        lora_hat.driver.ser.open()
+        lora_hat.start()
+        try:
+            fragmenter = Fragmenter(lora_hat.driver.fragment_len)
+            for i, message in enumerate([b"first", b"second"]):
+                (fragment,) = fragmenter.split(message)
+                os.write(master, encode_frame(fragment) + bytes([256 - 80 + i]))
+            received = [await lora_hat.receive(timeout=1) for _ in range(2)]
+            return received, lora_hat.last_rssi
+        finally:
+            lora_hat.stop()
+            lora_hat.driver.ser.close()
+
+    # the RSSI byte of the last packet is only known once the next data arrives
+    assert asyncio.run(run()) == ([b"first", b"second"], -80)
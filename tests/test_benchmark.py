@@ -0,0 +1,10 @@
+import json
+
+import benchmark
+
+
+def test_run_is_json_serializable():
+    report = benchmark.run("config", min_time=0.001, repeats=2)
+    assert set(report["results"]) == {"serialize_config"}
+    assert report["results"]["serialize_config"]["calls_per_s"] > 0
+    json.dumps(report)
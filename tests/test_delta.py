@@ -0,0 +1,88 @@
+import time
+
+import numpy as np
+
+from delta import DeltaDecoder, DeltaEncoder, KeyframeRequest
+from message import BatchMessage, Message, QuantizedTimeOrientPosMessage, Topic
+
+
+def pose_stream(n, sender=150, topic=Topic.QUANTIZED_ATTITUDE):
+    rng = np.random.default_rng(0)
+    content = np.array([time.time(), 1, 0, 0, 0, 1, 2, 3], dtype=np.float64)
+    for _ in range(n):
+        content = content.copy()
+        content[0] += 0.1 + rng.uniform(-0.004, 0.004)
+        content[1:5] += rng.normal(0, 0.0002, 4)
+        content[1:5] /= np.linalg.norm(content[1:5])
+        content[5:8] += rng.normal(0, 0.01, 3)
+        yield QuantizedTimeOrientPosMessage(content, sender, topic)
+
+
+def test_deltas_decode_like_quantized_messages():
+    encoder = DeltaEncoder(150, keyframe_interval=10)
+    decoder = DeltaDecoder()
+    sizes = []
+    for message in pose_stream(30):
+        encoded = encoder.encode(message)
+        sizes.append(len(encoded))
+        decoded = decoder.decode(encoded)
+        expected = QuantizedTimeOrientPosMessage.from_bytes(message.serialize())
+        assert decoded.sender == 150 and decoded.topic == Topic.QUANTIZED_ATTITUDE
+        assert np.allclose(decoded.content, expected.content)
+    assert sizes.count(3 + 1 + 1 + 14 + 2) == 3
+    assert sizes.count(3 + 1 + 1 + 7) == 27
+
+
+def test_gap_waits_for_next_keyframe():
+    encoder = DeltaEncoder(150, keyframe_interval=5)
+    decoder = DeltaDecoder()
+    encoded = [encoder.encode(m) for m in pose_stream(10)]
+    del encoded[2]
+    decoded = [decoder.decode(e) for e in encoded]
+    assert [d is None for d in decoded] == [False, False, True, True, False] + [False] * 4
+    assert decoder.n_gaps == 1
+
+
+def test_gap_requests_keyframe():
+    encoder = DeltaEncoder(150, keyframe_interval=100)
+    other = DeltaEncoder(151, keyframe_interval=100)
+    decoder = DeltaDecoder(request_interval=1.0)
+    messages = list(pose_stream(6))
+    for message in messages[:2]:
+        assert decoder.decode(encoder.encode(message), now=0.0) is not None
+    encoder.encode(messages[2])
+    assert decoder.decode(encoder.encode(messages[3]), now=0.0) is None
+    # requested once per request_interval
+    assert decoder.decode(encoder.encode(messages[4]), now=0.5) is None
+    request = decoder.keyframe_request(0)
+    assert decoder.keyframe_request(0) is None
+    decoded = Message.decode(request.serialize())
+    assert isinstance(decoded, KeyframeRequest)
+    assert decoded.content == [(150, Topic.QUANTIZED_ATTITUDE.value)]
+
+    assert not encoder.handle(messages[0].serialize())
+    other.encode(messages[0])
+    assert other.handle(request.serialize()) and other.n_requests == 0
+    assert encoder.handle(request.serialize()) and encoder.n_requests == 1
+    assert len(encoder.encode(messages[5])) == 3 + 1 + 1 + 14 + 2
+    assert len(other.encode(messages[1])) == 3 + 1 + 1 + 7
+
+
+def test_expand_batches():
+    encoder = DeltaEncoder(150)
+    decoder = DeltaDecoder()
+    imu = list(pose_stream(2, topic=Topic.QUANTIZED_IMU))
+    attitude = list(pose_stream(2))
+    entries = [encoder.encode(imu[0]), encoder.encode(attitude[0]), encoder.encode(imu[1])]
+    (batch,) = BatchMessage.pack(entries, 150, 200)
+    expanded = Message.decode(decoder.expand(batch.serialize()))
+    decoded = list(expanded.unpack())
+    assert [m.topic for m in decoded] == [Topic.QUANTIZED_IMU, Topic.QUANTIZED_ATTITUDE, Topic.QUANTIZED_IMU]
+    for message, original in zip(decoded, [imu[0], attitude[0], imu[1]]):
+        assert isinstance(message, QuantizedTimeOrientPosMessage) and message.sender == 150
+        expected = QuantizedTimeOrientPosMessage.from_bytes(original.serialize())
+        assert np.allclose(message.content, expected.content)
+
+    # a delta without its keyframe is dropped, nothing is left of the batch
+    (batch,) = BatchMessage.pack([encoder.encode(attitude[1])], 150, 200)
+    assert DeltaDecoder().expand(batch.serialize()) is None
@@ -0,0 +1,59 @@
+import os
+import threading
+import time
+
+import pytest
+
+import driver
+
+
+def test_receive_timeout(hat_on_pty):
+    lora_hat, _ = hat_on_pty
+    start = time.monotonic()
+    assert lora_hat.receive(timeout=0.05) == b""
+    assert time.monotonic() - start < 0.5
+
+
+def test_receive_joins_bytes_until_idle_gap(hat_on_pty):
+    lora_hat, master = hat_on_pty
+    os.write(master, b"\x01\x02")
+    os.write(master, b"\x03")
+    assert lora_hat.receive(timeout=1) == b"\x01\x02\x03"
+    assert lora_hat.receive(timeout=0.01) == b""
+
+
+def test_send_is_paced_by_module_buffer(hat_on_pty, monkeypatch):
+    lora_hat, master = hat_on_pty
+    monkeypatch.setattr(driver, "MODULE_BUFFER_SIZE", 100)
+    lora_hat.enable_point_to_point_mode = False
+
+    first_done = lora_hat.send(bytes(60))
+    assert lora_hat.tx_delay(60) == pytest.approx(first_done - time.monotonic(), abs=0.01)
+    assert lora_hat.tx_delay(40) == 0
+
+    start = time.monotonic()
+    second_done = lora_hat.send(bytes(60))
+    assert time.monotonic() >= first_done
+    assert second_done - start >= lora_hat.time_on_air(60)
+    # the pty may hand out the two writes separately
+    written = b""
+    while len(written) < 120:
+        written += os.read(master, 1024)
+    assert len(written) == 120
+
+
+def test_listen_keeps_packets_with_their_arrival_time(hat_on_pty):
+    lora_hat, master = hat_on_pty
+    os.write(master, b"\x01\x02")
+    start = time.time()
+    lora_hat.listen(0.2)
+    assert lora_hat.readable()
+    packet = lora_hat.receive_packet(timeout=0)
+    assert packet.data == b"\x01\x02" and packet.time - start < 0.1
+    assert not lora_hat.readable()
+
+    event = threading.Event()
+    event.set()
+    start = time.monotonic()
+    lora_hat.listen(1.0, event)
+    assert time.monotonic() - start < 0.1
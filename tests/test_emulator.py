@@ -0,0 +1,211 @@
+import json
+import time
+
+import serial
+
+from driver import AirSpeed, LoRaHatDriver, PacketLen, serialize_config
+from emulator import Air, LoRaHatEmulator
+from loraconfig import lora_hat_config
+
+
+def make_config(**kwargs):
+    config = lora_hat_config.copy()
+    config.update(module_address=0, enable_point_to_point_mode=False, **kwargs)
+    return config
+
+
+def test_config_handshake_and_transmission():
+    air = Air()
+    with LoRaHatEmulator(air) as emulator_a, LoRaHatEmulator(air) as emulator_b:
+        config = make_config()
+        with LoRaHatDriver(config, emulator_a.port, emulator_a.gpio) as hat_a:
+            with LoRaHatDriver(config, emulator_b.port, emulator_b.gpio) as hat_b:
+                assert emulator_a.registers == serialize_config(config)[3:]
+
+                message = bytes(range(256)) * 2
+                hat_a.send_message(message)
+                received = []
+                deadline = time.monotonic() + 2
+                while not received and time.monotonic() < deadline:
+                    received += hat_b.receive_messages(timeout=0.1)
+                assert received == [message]
+                # split into packets of packet_len
+                assert emulator_a.n_sent == len(hat_a._fragmenter.split(message))
+
+
+def test_register_read_rssi_byte_and_loss():
+    air = Air(loss_probability=1.0, rssi=-70)
+    with LoRaHatEmulator(air, auto_config=True) as emulator_a, LoRaHatEmulator(
+        air, auto_config=True
+    ) as emulator_b:
+        with serial.Serial(emulator_b.port, timeout=1) as ser_b, serial.Serial(
+            emulator_a.port, timeout=1
+        ) as ser_a:
+            command = bytearray(serialize_config(make_config(enable_RSSI_byte=True)))
+            ser_b.write(command)
+            assert ser_b.read(12) == bytes([0xC1]) + command[1:]
+            ser_b.write(bytes([0xC1, 0x05, 0x01]))
+            assert ser_b.read(4) == bytes([0xC1, 0x05, 0x01, command[3 + 5]])
+
+            ser_a.write(serialize_config(make_config()))
+            assert ser_a.read(12)[0] == 0xC1
+
+            ser_a.write(b"lost")
+            time.sleep(0.2)
+            assert air.n_lost == 1
+            air.loss_probability = 0.0
+            ser_a.write(b"hello")
+            assert ser_b.read(6) == b"hello" + bytes([256 - 70])
+
+
+def test_config_persist_and_cache(tmp_path, monkeypatch):
+    writes = []
+    write_registers = LoRaHatDriver._write_registers
+
+    def spy(self, config, start, length, persist=False):
+        writes.append((start, length, persist))
+        return write_registers(self, config, start, length, persist)
+
+    monkeypatch.setattr(LoRaHatDriver, "_write_registers", spy)
+    config = make_config(channel=40)
+    cache = str(tmp_path / "config_cache.json")
+    with LoRaHatEmulator(Air()) as emulator:
+        with LoRaHatDriver(config, emulator.port, emulator.gpio, persist_config=True, config_cache=cache):
+            assert emulator.registers == serialize_config(config)[3:]
+            assert emulator.persistent_registers == emulator.registers
+        assert writes == [(0, 9, True)]
+
+        emulator.power_cycle()
+        with LoRaHatDriver(config, emulator.port, emulator.gpio, persist_config=True, config_cache=cache) as hat:
+            # read back, nothing to write
+            assert writes == [(0, 9, True)]
+            assert emulator.mode == 0
+            assert hat.ser.is_open
+
+            # runtime changes are not persisted
+            persistent = bytes(emulator.persistent_registers)
+            assert hat.reconfigure(air_speed=AirSpeed.AS_9_6K)
+            assert emulator.config["air_speed"] == AirSpeed.AS_9_6K
+            assert emulator.persistent_registers == persistent
+            assert not writes[-1][2]
+
+        emulator.power_cycle()
+        with LoRaHatDriver(config, emulator.port, emulator.gpio, persist_config=True, config_cache=cache):
+            assert emulator.registers == serialize_config(config)[3:]
+
+    # another hat on the same port is configured despite the cache
+    with open(cache) as f:
+        (entry,) = json.load(f).values()
+    with LoRaHatEmulator(Air()) as emulator:
+        with open(cache, "w") as f:
+            json.dump({emulator.port: entry}, f)
+        assert emulator.registers != serialize_config(config)[3:]
+        with LoRaHatDriver(config, emulator.port, emulator.gpio, config_cache=cache):
+            assert emulator.registers == serialize_config(config)[3:]
+
+
+def test_config_written_only_if_different(tmp_path):
+    with LoRaHatEmulator(Air()) as emulator:
+        config = make_config()
+        with LoRaHatDriver(config, emulator.port, emulator.gpio) as hat:
+            hat.gpio.output(hat.M1, hat.gpio.HIGH)
+            current = hat.read_config_from_hat()
+            hat.gpio.output(hat.M1, hat.gpio.LOW)
+        assert current["module_address"] == config["module_address"]
+        assert current["air_speed"] == config["air_speed"]
+
+        # REG7 is a key register, it cannot be read back. A key left from an earlier configuration is reset.
+        emulator.registers[7] = 0x12
+        with LoRaHatDriver(config, emulator.port, emulator.gpio):
+            pass
+        assert emulator.registers[7] == 0
+
+        # once the cache knows the key it is not written again
+        cache = str(tmp_path / "config_cache.json")
+        with LoRaHatDriver(config, emulator.port, emulator.gpio, config_cache=cache):
+            pass
+        emulator.registers[7] = 0x12
+        with LoRaHatDriver(config, emulator.port, emulator.gpio, config_cache=cache):
+            pass
+        assert emulator.registers[7] == 0x12
+
+        # only the channel register and the key of the new configuration are written
+        config["channel"] = 41
+        with LoRaHatDriver(config, emulator.port, emulator.gpio, config_cache=cache) as hat:
+            assert emulator.registers[5] == 41
+
+            assert hat.reconfigure(air_speed=AirSpeed.AS_9_6K, packet_len=PacketLen.PL_64B)
+            assert emulator.config["air_speed"] == AirSpeed.AS_9_6K
+            assert emulator.config["packet_len"] == PacketLen.PL_64B
+            assert hat.fragment_len < 64
+
+
+def test_rssi_byte_and_noise_sampling():
+    air = Air(rssi=-70, noise_rssi=-105)
+    with LoRaHatEmulator(air) as emulator_a, LoRaHatEmulator(air) as emulator_b:
+        config = make_config(enable_RSSI_byte=True, enable_ambient_noise=True)
+        with LoRaHatDriver(config, emulator_a.port, emulator_a.gpio) as hat_a:
+            with LoRaHatDriver(config, emulator_b.port, emulator_b.gpio, noise_interval=0.05) as hat_b:
+                # the noise is sampled while the channel is quiet
+                assert hat_b.receive_packet(timeout=0.3) is None
+                assert hat_b.noise_rssi == -105
+
+                message = bytes(range(1, 100))
+                hat_a.send_message(message)
+                received = []
+                deadline = time.monotonic() + 2
+                while not received and time.monotonic() < deadline:
+                    received += hat_b.receive_messages(timeout=0.1, metadata=True)
+                ((received_message, packet),) = received
+                assert received_message == message
+                assert packet.rssi == -70
+
+
+def test_listen_before_talk_defers_on_busy_channel():
+    air = Air(rssi=-70, noise_rssi=-105)
+    with LoRaHatEmulator(air) as emulator_a, LoRaHatEmulator(air) as emulator_b:
+        # packets of about a second on air
+        config = make_config(enable_ambient_noise=True, air_speed=AirSpeed.AS_2_4K)
+        with LoRaHatDriver(config, emulator_a.port, emulator_a.gpio) as hat_a:
+            with LoRaHatDriver(
+                config, emulator_b.port, emulator_b.gpio, csma_threshold=-90, csma_max_delay=0.5
+            ) as hat_b:
+                # a quiet channel does not defer
+                hat_b.send(b"quiet", block=True)
+                assert hat_b.csma_stats["samples"] == 1
+                assert hat_b.csma_stats["deferred"] == 0
+
+                message = bytes(range(1, 256)) * 2
+                hat_a.send_message(message)
+                time.sleep(0.1)
+                start = time.monotonic()
+                hat_b.send(b"busy")
+                assert hat_b.csma_stats["deferred"] == 1
+                assert hat_b.busy_ratio > 0
+                # forced after csma_max_delay at the latest
+                assert time.monotonic() - start < 0.5 + 0.5
+
+                # packets received while sensing are not lost
+                received = []
+                deadline = time.monotonic() + 5
+                while not received and time.monotonic() < deadline:
+                    received += hat_b.receive_messages(timeout=0.1)
+                assert received == [message]
+
+
+def test_point_to_point_packets_back_to_back():
+    air = Air()
+    with LoRaHatEmulator(air) as emulator_a, LoRaHatEmulator(air) as emulator_b:
+        config = dict(make_config(), enable_point_to_point_mode=True, target_address=0xFFFF)
+        with LoRaHatDriver(config, emulator_a.port, emulator_a.gpio) as hat_a:
+            with LoRaHatDriver(config, emulator_b.port, emulator_b.gpio) as hat_b:
+                # several packets per message and several messages without pause
+                messages = [bytes([i]) * 500 for i in range(1, 4)]
+                for message in messages:
+                    hat_a.send_message(message)
+                received = []
+                deadline = time.monotonic() + 5
+                while len(received) < len(messages) and time.monotonic() < deadline:
+                    received += hat_b.receive_messages(timeout=0.1)
+                assert received == messages
+                assert hat_b._frame_decoder.n_errors == 0
@@ -0,0 +1,69 @@
+import pytest
+
+from fragment import HEADER_LEN, SINGLE_HEADER_LEN, Fragmenter, Reassembler
+
+
+def test_split_fills_fragments_and_reassembles_out_of_order():
+    fragmenter = Fragmenter(32)
+    data = bytes(range(100))
+    fragments = fragmenter.split(data)
+    assert [len(f) for f in fragments] == [32, 32, 32, 100 - 3 * (32 - HEADER_LEN) + HEADER_LEN]
+
+    reassembler = Reassembler()
+    assert [reassembler.add(f) for f in fragments[::-1]][-1] == data
+    assert reassembler.add(fragmenter.split(b"small")[0]) == b"small"
+    assert reassembler.n_complete == 2
+
+
+def test_single_packet_messages_have_a_short_header():
+    fragmenter = Fragmenter(32)
+    reassembler = Reassembler()
+    message_ids = []
+    for data in (bytes(32 - SINGLE_HEADER_LEN), bytes(32 - SINGLE_HEADER_LEN + 1), b""):
+        fragments = fragmenter.split(data)
+        for fragment in fragments:
+            completed = reassembler.add(fragment)
+        assert completed == data
+        message_ids.append(reassembler.last_message_id)
+        assert len(fragments) == (2 if len(data) > 32 - SINGLE_HEADER_LEN else 1)
+    assert len(fragmenter.split(b"small")[0]) == SINGLE_HEADER_LEN + 5
+    # consecutive across short and long messages
+    assert [(i - message_ids[0]) & 0x7FFF for i in message_ids] == [0, 1, 2]
+
+
+def test_incomplete_messages_expire_and_respect_memory_cap():
+    # 12 bytes per fragment
+    fragmenter = Fragmenter(HEADER_LEN + 12)
+    reassembler = Reassembler(timeout=1.0, max_bytes=40)
+
+    first = fragmenter.split(bytes(40))
+    reassembler.add(first[0], now=0.0)
+    reassembler.add(first[1], now=0.0)
+    second = fragmenter.split(bytes(40))
+    # exceeds the memory cap, the oldest message is dropped
+    reassembler.add(second[0], now=0.5)
+    reassembler.add(second[1], now=0.5)
+    assert reassembler.add(first[2], now=0.6) is None
+    assert reassembler.n_dropped == 1
+
+    third = fragmenter.split(bytes(40))
+    reassembler.add(third[0], now=2.0)
+    assert reassembler.n_dropped == 3  # second and the restarted first expired
+
+
+def test_too_many_fragments():
+    with pytest.raises(ValueError):
+        Fragmenter(HEADER_LEN + 1).split(bytes(256))
+
+
+def test_fragments_of_senders_with_the_same_message_id_do_not_mix():
+    node_a = Fragmenter(16, sender=150)
+    node_b = Fragmenter(16, sender=151)
+    node_b._next_id = node_a._next_id
+    data_a, data_b = bytes(range(30)), bytes(range(100, 130))
+    reassembler = Reassembler()
+    completed = []
+    for fragment_a, fragment_b in zip(node_a.split(data_a), node_b.split(data_b)):
+        completed += [reassembler.add(fragment_a), reassembler.add(fragment_b)]
+    assert [c for c in completed if c is not None] == [data_a, data_b]
+    assert reassembler.n_dropped == 0
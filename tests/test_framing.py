@@ -0,0 +1,31 @@
+from framing import FrameDecoder, encode_frame, frame_len
+
+
+def test_round_trip_split_and_merged():
+    payloads = [b"", b"\x00\x00", bytes(range(256)) * 2, b"hello"]
+    stream = b"".join(encode_frame(p) for p in payloads)
+    assert all(len(encode_frame(p)) <= frame_len(len(p)) for p in payloads)
+
+    decoder = FrameDecoder()
+    frames = []
+    for i in range(0, len(stream), 7):
+        frames += decoder.feed(stream[i : i + 7])
+    assert frames == payloads
+    assert decoder.n_errors == 0
+
+
+def test_resync_after_garbage_and_corruption():
+    good = encode_frame(b"good")
+    corrupted = bytearray(encode_frame(b"corrupted"))
+    corrupted[3] ^= 0x01
+
+    decoder = FrameDecoder()
+    frames = decoder.feed(b"\x17garbage" + bytes(corrupted) + good + good[:4])
+    assert frames == [b"good"]
+    assert decoder.n_errors == 2
+    assert decoder.feed(good[4:]) == [b"good"]
+
+
+def test_oversized_frame_is_dropped():
+    decoder = FrameDecoder(max_frame_len=16)
+    assert decoder.feed(encode_frame(bytes(range(1, 64))) + encode_frame(b"ok")) == [b"ok"]
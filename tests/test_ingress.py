@@ -0,0 +1,61 @@
+import threading
+
+import pytest
+
+from ingress import DropPolicy, IngressBuffer
+from message import TextMessage, Topic
+
+
+def message(sender, text):
+    return TextMessage(text, sender, Topic.TEXT).serialize()
+
+
+@pytest.mark.parametrize(
+    "policy, expected",
+    [
+        (DropPolicy.DROP_OLDEST, ["2", "3", "4"]),
+        (DropPolicy.DROP_NEWEST, ["0", "1", "2"]),
+    ],
+)
+def test_drop_policies(policy, expected):
+    buffer = IngressBuffer(3, policy)
+    results = [buffer.put(message(150, str(i))) for i in range(5)]
+    assert results == ([True] * 5 if policy == DropPolicy.DROP_OLDEST else [True] * 3 + [False] * 2)
+    assert len(buffer) == 3
+    assert [TextMessage.from_bytes(buffer.get()).content for _ in range(3)] == expected
+    assert buffer.get(timeout=0.01) is None
+    assert buffer.stats() == {"depth": 0, "max_depth": 3, "put": 5, "dropped": 2, "replaced": 0}
+
+
+def test_latest_per_sender():
+    buffer = IngressBuffer(2, DropPolicy.LATEST_PER_SENDER)
+    for sender, text in [(150, "a"), (151, "b"), (150, "c"), (152, "d")]:
+        buffer.put(message(sender, text))
+    # 150 was replaced by its newer message, then dropped as the oldest for 152
+    received = [TextMessage.from_bytes(buffer.get()) for _ in range(2)]
+    assert [(m.sender, m.content) for m in received] == [(150, "c"), (152, "d")]
+    assert buffer.n_replaced == 1
+    assert buffer.n_dropped == 1
+    # unparsable messages are kept like with DROP_OLDEST
+    buffer.put(b"")
+    buffer.put(b"")
+    assert len(buffer) == 2
+
+
+def test_high_water_warning(caplog):
+    buffer = IngressBuffer(8, high_water=4)
+    for i in range(8):
+        buffer.put(message(150, str(i)))
+    assert sum("Ingress buffer" in r.message for r in caplog.records) == 1
+    for _ in range(7):
+        buffer.get()
+    buffer.put(message(150, "x"))
+    buffer.put(message(150, "y"))
+    buffer.put(message(150, "z"))
+    assert sum("Ingress buffer" in r.message for r in caplog.records) == 2
+
+
+def test_get_waits_for_put():
+    buffer = IngressBuffer(4)
+    threading.Timer(0.05, buffer.put, args=[message(150, "late")]).start()
+    assert TextMessage.from_bytes(buffer.get(timeout=2)).content == "late"
@@ -0,0 +1,39 @@
+import time
+
+from framing import encode_frame
+from lora_perf import END, PROBE, ProbeReceiver, make_probe, split_rssi
+
+
+def test_report_counts_losses_and_duplicates():
+    receiver = ProbeReceiver(run_id=7)
+    received = [0, 1, 4, 5, 5, 9]
+    data = b"".join(encode_frame(make_probe(PROBE, 7, s, 100)) for s in received)
+    data += encode_frame(make_probe(PROBE, 8, 2, 100))  # other run
+    receiver.feed(data, now=time.time() + 0.5)
+    assert not receiver.done
+    receiver.feed(encode_frame(make_probe(END, 7, 12, 15)))
+    assert receiver.done
+
+    report = receiver.report()
+    assert report["sent"] == 12
+    assert report["received"] == 5
+    assert report["duplicates"] == 1
+    assert report["pdr"] == 5 / 12
+    # 2-3, 6-8, 10-11
+    assert receiver.loss_bursts() == [2, 3, 2]
+    assert report["max_loss_burst"] == 3
+    assert 0.4 < report["latency_p50_s"] < 1.0
+
+
+def test_rssi_bytes_are_split_off():
+    frames = [encode_frame(make_probe(PROBE, 0, s, 50)) for s in range(3)]
+    data = b"".join(frame + bytes([256 - 80 + s]) for s, frame in enumerate(frames))
+    stripped, rssi = split_rssi(data)
+    assert rssi == [-80, -79, -78]
+
+    receiver = ProbeReceiver(rssi_byte=True)
+    receiver.feed(data)
+    report = receiver.report()
+    assert report["received"] == 3
+    assert report["frame_errors"] == 0
+    assert report["rssi_min_dbm"] == -80
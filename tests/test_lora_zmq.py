@@ -0,0 +1,70 @@
+import pickle
+
+import numpy as np
+import pytest
+import zmq
+
+import metrics
+from lora_zmq import ZMQ_TOPIC, frames_to_publish, make_frames, make_publisher, topic_frame
+from message import BatchMessage, DeserializeError, Message, TextMessage, TimeOrientPosMessage, Topic
+
+
+def test_make_frames_splits_batches():
+    attitude = TimeOrientPosMessage(np.arange(8, dtype=np.float32), 150, Topic.ATTITUDE)
+    text = TextMessage("text", 151, Topic.TEXT)
+    (batch,) = BatchMessage.pack([attitude, text], 150, 240)
+
+    multiparts = make_frames(batch.serialize(), decoded=True)
+    assert [frames[0] for frames in multiparts] == [b"LORA/ATTITUDE", b"LORA/TEXT"]
+    assert multiparts[0][1] == attitude.serialize()
+    assert pickle.loads(multiparts[1][2]).content == "text"
+
+    (frames,) = make_frames(text.serialize())
+    assert frames == [b"LORA/TEXT", text.serialize()]
+    assert topic_frame(42) == b"LORA/42"
+
+
+def test_malformed_messages_are_counted_and_skipped():
+    errors = metrics.counter("lora_deserialize_errors_total")
+    before = errors.value
+    text = TextMessage("text", 151, Topic.TEXT)
+    (batch,) = BatchMessage.pack([text], 150, 240)
+    truncated = batch.serialize()[:-1]
+    with pytest.raises(DeserializeError):
+        make_frames(truncated)
+    # DeserializeError itself does not count
+    assert errors.value == before
+
+    assert frames_to_publish(truncated) == []
+    assert frames_to_publish(b"") == []
+    assert errors.value == before + 2
+    assert frames_to_publish(text.serialize()) == [[b"LORA/TEXT", text.serialize()]]
+    assert errors.value == before + 2
+
+
+def test_subscribers_filter_by_topic():
+    context = zmq.Context()
+    publisher = make_publisher(context, 100)
+    publisher.bind("inproc://lora")
+    everything = context.socket(zmq.SUB)
+    everything.setsockopt(zmq.SUBSCRIBE, ZMQ_TOPIC)
+    text_only = context.socket(zmq.SUB)
+    text_only.setsockopt(zmq.SUBSCRIBE, topic_frame(Topic.TEXT))
+    for socket in (everything, text_only):
+        socket.setsockopt(zmq.RCVTIMEO, 1000)
+        socket.connect("inproc://lora")
+
+    messages = [
+        TimeOrientPosMessage(np.zeros(8, dtype=np.float32), 150, Topic.ATTITUDE),
+        TextMessage("text", 151, Topic.TEXT),
+    ]
+    for message in messages:
+        for frames in make_frames(message.serialize()):
+            publisher.send_multipart(frames, copy=False)
+
+    received = [everything.recv_multipart() for _ in messages]
+    assert [Message.decode(data).topic for _, data in received] == [Topic.ATTITUDE, Topic.TEXT]
+    topic_bin, data_bin = text_only.recv_multipart()
+    assert topic_bin == b"LORA/TEXT"
+    assert text_only.poll(100) == 0
+    context.destroy(linger=0)
@@ -0,0 +1,111 @@
+import time
+
+import numpy as np
+import pytest
+
+from message import (
+    BatchMessage,
+    DeserializeError,
+    Message,
+    QuantizedTimeOrientPosMessage,
+    TextMessage,
+    TimeOrientPosMessage,
+    Topic,
+    register_topic,
+    topic_from_id,
+    unregister_topic,
+)
+
+
+def random_contents(n, rng):
+    contents = np.empty((n, 8))
+    contents[:, 0] = time.time() + rng.uniform(-10, 10, n)
+    contents[:, 1:5] = rng.standard_normal((n, 4))
+    contents[:, 1:5] /= np.linalg.norm(contents[:, 1:5], axis=1, keepdims=True)
+    contents[:, 5:8] = rng.uniform(-30, 30, (n, 3))
+    return contents
+
+
+def test_quantized_round_trip():
+    content = random_contents(1, np.random.default_rng(0))[0]
+    message = QuantizedTimeOrientPosMessage(content, 150, topic=Topic.QUANTIZED_ATTITUDE)
+    serialized = message.serialize()
+    assert len(serialized) == 3 + 14
+    assert len(serialized) < len(
+        TimeOrientPosMessage(content.astype(np.float32), 150).serialize()
+    )
+
+    decoded = Message.decode(serialized)
+    assert isinstance(decoded, QuantizedTimeOrientPosMessage)
+    assert decoded.sender == 150 and decoded.topic == Topic.QUANTIZED_ATTITUDE
+    assert abs(decoded.timestamp - message.timestamp) <= 0.002
+    assert np.allclose(decoded.position, message.position, atol=0.0005)
+    assert abs(abs(np.dot(decoded.orientation, message.orientation)) - 1) < 1e-6
+
+
+def test_quantized_round_trip_error_is_bounded():
+    contents = random_contents(1000, np.random.default_rng(1))
+    error = QuantizedTimeOrientPosMessage.round_trip_error(contents)
+    assert error.shape == contents.shape
+    assert error[:, 0].max() <= QuantizedTimeOrientPosMessage.time_scale / 2 + 1e-6
+    assert error[:, 1:5].max() < 1e-4
+    assert error[:, 5:8].max() <= QuantizedTimeOrientPosMessage.position_scale / 2 + 1e-9
+
+
+def test_batch_round_trip_with_shared_sender():
+    data = np.arange(8, dtype=np.float32)
+    messages = [
+        TimeOrientPosMessage(data, 150, topic=Topic.IMU),
+        TimeOrientPosMessage(data + 1, 150, topic=Topic.ATTITUDE),
+        TimeOrientPosMessage(data + 2, 151, topic=Topic.ATTITUDE),
+    ]
+    (batch,) = BatchMessage.pack(messages, 150, max_len=240)
+    serialized = batch.serialize()
+    assert len(serialized) == 3 + 3 + sum(len(m.serialize()) for m in messages) - 2 * 2
+
+    decoded = BatchMessage.from_bytes(serialized)
+    assert decoded.topic == Topic.BATCH and decoded.sender == 150
+    for original, unpacked in zip(messages, decoded.unpack(TimeOrientPosMessage)):
+        assert (unpacked.sender, unpacked.topic) == (original.sender, original.topic)
+        assert np.array_equal(unpacked.content, original.content)
+
+    with pytest.raises(DeserializeError):
+        BatchMessage.from_bytes(serialized[:-1])
+
+
+def test_batch_pack_respects_max_len():
+    messages = [TimeOrientPosMessage(np.zeros(8, dtype=np.float32), 150)] * 5
+    batches = BatchMessage.pack(messages, 150, max_len=71)
+    assert [len(b.content) for b in batches] == [2, 2, 1]
+    assert all(len(b.serialize()) <= 71 for b in batches)
+
+
+class CustomMessage(TextMessage):
+    pass
+
+
+@pytest.fixture
+def custom_topic():
+    # the registry is shared by the whole process
+    register_topic(100, CustomMessage)
+    yield 100
+    unregister_topic(100)
+
+
+def test_decode_dispatches_on_topic(custom_topic):
+    text = TextMessage("hello", 150, topic=Topic.TEXT)
+    custom = CustomMessage("custom", 151, topic=custom_topic)
+    batch = BatchMessage([text.serialize(), custom.serialize()], 150)
+
+    decoded = Message.decode(batch.serialize())
+    assert isinstance(decoded, BatchMessage)
+    unpacked = list(decoded.unpack())
+    assert type(unpacked[0]) is TextMessage and unpacked[0].content == "hello"
+    assert type(unpacked[1]) is CustomMessage and unpacked[1].topic == custom_topic
+
+    with pytest.raises(DeserializeError):
+        Message.decode(bytes([101, 0, 0]))
+    with pytest.raises(ValueError):
+        register_topic(Topic.TEXT.value, CustomMessage)
+    assert topic_from_id(Topic.TEXT.value) is Topic.TEXT
+    assert topic_from_id(custom_topic) == custom_topic
@@ -0,0 +1,45 @@
+import urllib.request
+
+import pytest
+
+import metrics
+
+
+def test_render():
+    registry = metrics.Registry()
+    registry.counter("packets_total", "Packets.").inc(3)
+    registry.gauge("depth", function=lambda: 7)
+    histogram = registry.histogram("wait_seconds", buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+
+    assert registry.counter("packets_total").value == 3
+    with pytest.raises(ValueError):
+        registry.gauge("packets_total")
+    assert registry.render().splitlines() == [
+        "# HELP packets_total Packets.",
+        "# TYPE packets_total counter",
+        "packets_total 3",
+        "# TYPE depth gauge",
+        "depth 7",
+        "# TYPE wait_seconds histogram",
+        'wait_seconds_bucket{le="0.1"} 2',
+        'wait_seconds_bucket{le="1.0"} 3',
+        'wait_seconds_bucket{le="+Inf"} 4',
+        "wait_seconds_sum 2.65",
+        "wait_seconds_count 4",
+    ]
+
+
+def test_serve():
+    registry = metrics.Registry()
+    registry.counter("packets_total").inc()
+    server = metrics.serve(0, registry=registry)
+    try:
+        url = f"http://127.0.0.1:{server.server_port}/metrics"
+        with urllib.request.urlopen(url, timeout=5) as response:
+            assert "packets_total 1" in response.read().decode("utf-8")
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert metrics.serve(None) is None
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from message import TextMessage, TimeOrientPosMessage, Topic
+from query import export_csv, export_npz, query, query_tables
+from store import BLOCK_LEN, MessageStore, table_names
+
+
+def fill_store(directory, n):
+    with MessageStore(directory, segment_len=3 * BLOCK_LEN) as store:
+        for i in range(n):
+            content = np.full(8, i, dtype=TimeOrientPosMessage.array_dtype)
+            topic = Topic.ATTITUDE if i % 2 else Topic.IMU
+            store.append(TimeOrientPosMessage(content, 150 + i % 4, topic), receive_time=1000.0 + i)
+        store.append(TextMessage("hi", 7, Topic.TEXT), receive_time=5000.0)
+
+
+def test_query(tmp_path):
+    directory = str(tmp_path)
+    fill_store(directory, 10 * BLOCK_LEN)
+
+    records = query(directory, senders=[151, 153], start=1500.0, end=6000.0, topic=Topic.ATTITUDE)
+    expected = np.arange(500, 5000)
+    expected = expected[np.isin(expected % 4, [1, 3])]
+    assert np.array_equal(records["content"][:, 0], expected)
+    assert np.all(records["topic"] == Topic.ATTITUDE.value)
+
+    assert len(query(directory, name="TimeOrientPosMessage")) == 10 * BLOCK_LEN
+    assert len(query(directory, senders=[999])) == 0
+    assert len(query(directory, start=100000.0)) == 0
+    assert query(directory, name="TextMessage", senders=[7])["content"][0][:2] == b"hi"
+
+
+def test_query_tables(tmp_path):
+    directory = str(tmp_path)
+    assert table_names(directory) == []
+    fill_store(directory, 10)
+    assert table_names(directory) == ["TextMessage", "TimeOrientPosMessage"]
+
+    tables = query_tables(directory)
+    assert {name: len(records) for name, records in tables.items()} == {
+        "TextMessage": 1,
+        "TimeOrientPosMessage": 10,
+    }
+    assert list(query_tables(directory, start=2000.0)) == ["TextMessage"]
+    assert list(query_tables(directory, names=["TimeOrientPosMessage"])) == ["TimeOrientPosMessage"]
+
+    # without a name, query selects the only class with matching records
+    assert query(directory, senders=[7])["content"][0][:2] == b"hi"
+    assert len(query(directory, topic=Topic.ATTITUDE)) == 5
+    assert len(query(directory, senders=[999])) == 0
+    with pytest.raises(ValueError):
+        query(directory)
+
+
+def test_export(tmp_path):
+    directory = str(tmp_path)
+    fill_store(directory, 5)
+    records = query(directory, senders=[150])
+
+    export_npz(records, str(tmp_path / "out.npz"))
+    with np.load(tmp_path / "out.npz") as exported:
+        assert np.array_equal(exported["receive_time"], records["receive_time"])
+        assert exported["content"].shape == (2, 8)
+
+    export_csv(records, str(tmp_path / "out.csv"))
+    lines = (tmp_path / "out.csv").read_text().splitlines()
+    assert lines[0].startswith("receive_time,sender,topic,content_0")
+    assert len(lines) == 3
+
+    export_csv(query(directory, name="TextMessage"), str(tmp_path / "text.csv"))
+    assert (tmp_path / "text.csv").read_text().splitlines()[1].endswith(",hi")
@@ -0,0 +1,46 @@
+import pytest
+
+from loraconfig import lora_hat_config
+from registers import (
+    CFG_HEADER,
+    AirSpeed,
+    ConfigError,
+    changed_registers,
+    command_to_dict,
+    serialize_config,
+)
+
+
+def test_partial_command_round_trip():
+    config = lora_hat_config.copy()
+    command = serialize_config(config, start=3, length=3)
+    assert command[:3] == bytes([CFG_HEADER, 3, 3])
+    parsed = command_to_dict(command)
+    # only settings completely contained in REG3-REG5
+    assert parsed["air_speed"] == config["air_speed"]
+    assert parsed["channel"] == config["channel"]
+    assert "net_id" not in parsed and "enable_LBT" not in parsed
+
+
+def test_changed_registers():
+    config = lora_hat_config.copy()
+    assert changed_registers(config, config) is None
+    assert changed_registers(config, dict(config, channel=40)) == (5, 1)
+    assert changed_registers(config, dict(config, air_speed=AirSpeed.AS_0_3K, enable_LBT=True)) == (3, 4)
+    assert changed_registers(config, dict(config, module_address=0x1234)) == (0, 2)
+
+
+@pytest.mark.parametrize(
+    "changes",
+    [{"channel": 84}, {"net_id": 256}, {"module_address": -1}, {"air_speed": 2}, {"enable_LBT": 2}],
+)
+def test_validation(changes):
+    with pytest.raises(ConfigError):
+        serialize_config(dict(lora_hat_config, **changes))
+
+
+def test_reserved_bits_are_rejected():
+    command = bytearray(serialize_config(lora_hat_config))
+    command[3 + 4] |= 0b00000100
+    with pytest.raises(ConfigError):
+        command_to_dict(command)
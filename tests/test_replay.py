@@ -0,0 +1,36 @@
+import time
+
+import numpy as np
+
+from message import TextMessage, TimeOrientPosMessage, Topic
+from replay import iter_messages, load, replay
+from store import MessageStore
+
+
+def test_replay_keeps_order_and_timing(tmp_path):
+    directory = str(tmp_path)
+    receive_times = [100.0, 100.1, 100.3, 100.35]
+    with MessageStore(directory) as store:
+        for i in (0, 2, 3):
+            content = np.full(8, i, dtype=TimeOrientPosMessage.array_dtype)
+            store.append(TimeOrientPosMessage(content, 150, Topic.ATTITUDE), receive_times[i])
+        store.append(TextMessage("text", 151, Topic.TEXT), receive_times[1])
+
+    published = []
+    start = time.monotonic()
+    stats = replay(
+        iter_messages(load(directory)),
+        lambda msg: published.append((time.monotonic() - start, msg)),
+        speed=2,
+    )
+    assert stats["messages"] == 4
+    assert isinstance(published[1][1], TextMessage)
+    assert published[1][1].content == "text"
+    assert [int(msg.content[0]) for _, msg in published if isinstance(msg, TimeOrientPosMessage)] == [0, 2, 3]
+    offsets = np.array([t for t, _ in published])
+    assert np.allclose(offsets - offsets[0], (np.array(receive_times) - 100.0) / 2, atol=0.02)
+
+    published.clear()
+    stats = replay(iter_messages(load(directory, senders=[150])), published.append, speed=0)
+    assert len(published) == 3
+    assert stats["duration_s"] < 0.1
@@ -0,0 +1,33 @@
+from driver import AirSpeed
+from loraconfig import lora_hat_config
+from simulator import Simulator
+
+
+def make_config(**kwargs):
+    config = lora_hat_config.copy()
+    config.update(**kwargs)
+    return config
+
+
+def test_single_node_delivers_everything():
+    simulator = Simulator(make_config(), n_nodes=1, interval=0.5, seed=0)
+    results = simulator.run(60)
+    assert results["published"] > 100
+    assert results["pdr"] == 1.0
+    assert results["collisions"] == 0
+    assert results["overflow_bytes"] == 0
+    # serial transfer to and from the modules dominates at 62.5k air speed
+    assert 0.05 < results["latency_p50_s"] < 0.5
+
+
+def test_collisions_and_listen_before_talk():
+    config = make_config(air_speed=AirSpeed.AS_9_6K)
+    without_lbt = Simulator(config, n_nodes=10, interval=1.0, capture_db=100, seed=0).run(120)
+    assert without_lbt["collisions"] > 0
+    assert without_lbt["pdr"] < 1.0
+    assert 0 < without_lbt["channel_utilisation"] <= without_lbt["offered_load"]
+
+    config["enable_LBT"] = True
+    with_lbt = Simulator(config, n_nodes=10, interval=1.0, capture_db=100, seed=0).run(120)
+    assert with_lbt["lbt_deferrals"] > 0
+    assert with_lbt["collisions"] < without_lbt["collisions"]
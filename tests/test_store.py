@@ -0,0 +1,57 @@
+import json
+import os
+
+import numpy as np
+
+from message import TextMessage, TimeOrientPosMessage, Topic
+from store import INDEX_FILE, MessageStore, read, read_segments
+
+
+def make_message(i, sender=150):
+    content = np.full(8, i, dtype=TimeOrientPosMessage.array_dtype)
+    return TimeOrientPosMessage(content, sender, topic=Topic.ATTITUDE)
+
+
+def test_append_and_read(tmp_path):
+    directory = str(tmp_path)
+    with MessageStore(directory, segment_len=4) as store:
+        for i in range(10):
+            store.append(make_message(i, 150 + i % 2), receive_time=1000.0 + i)
+        store.append(TextMessage("hello", 3, Topic.TEXT), receive_time=2000.0)
+
+    records = read(directory, "TimeOrientPosMessage")
+    assert len(records) == 10
+    assert len(list(read_segments(directory, "TimeOrientPosMessage"))) == 3
+    assert np.all(records["receive_time"] == 1000.0 + np.arange(10))
+    assert np.all(records["content"][:, 0] == np.arange(10))
+    assert list(records["sender"][:2]) == [150, 151]
+    assert np.all(records["topic"] == Topic.ATTITUDE.value)
+
+    text = read(directory, "TextMessage")
+    assert text["content"][0][: text["content_len"][0]] == b"hello"
+
+    # appending continues after a restart
+    with MessageStore(directory, segment_len=4) as store:
+        store.append(make_message(10), receive_time=1010.0)
+    assert len(read(directory, "TimeOrientPosMessage")) == 11
+
+
+def test_recovery_and_retention(tmp_path):
+    directory = str(tmp_path)
+    store = MessageStore(directory, segment_len=4, flush_interval=1000, max_segments=2)
+    for i in range(3):
+        store.append(make_message(i), receive_time=1000.0 + i)
+    # crash: the index does not know about the records yet
+    index_path = os.path.join(directory, "TimeOrientPosMessage", INDEX_FILE)
+    with open(index_path) as f:
+        assert json.load(f)["segments"][-1]["count"] == 0
+    store._tables["TimeOrientPosMessage"].records.flush()
+    del store
+
+    with MessageStore(directory, segment_len=4, max_segments=2) as store:
+        for i in range(3, 12):
+            store.append(make_message(i), receive_time=1000.0 + i)
+    records = read(directory, "TimeOrientPosMessage")
+    # the oldest segment has been deleted
+    assert list(records["content"][:, 0]) == list(range(8, 12))
+    assert len(os.listdir(os.path.join(directory, "TimeOrientPosMessage"))) == 3
@@ -0,0 +1,127 @@
+import time
+
+import pytest
+
+from driver import AirSpeed, LoRaHatDriver, Packet, PacketLen
+from emulator import Air, LoRaHatEmulator
+from loraconfig import lora_hat_config
+from message import Message, TextMessage, Topic
+from tdma import BeaconMessage, TdmaNode, TdmaScheduler
+
+
+class Hat:
+    # time on air of 0.1 s per packet, no serial transfer time
+    config = {"module_address": 0}
+    packet_len = PacketLen.PL_240B
+    packet_message_len = 200
+
+    def __init__(self):
+        self.sent = []
+
+    def time_on_air(self, n_bytes):
+        return 0.1 * -(-n_bytes // 240)
+
+    def char_time(self):
+        return 0.0
+
+    def idle_gap(self):
+        return 0.005
+
+    def send_message(self, message, target_address=None):
+        self.sent.append((message, target_address))
+
+
+def test_beacon_message():
+    content = {
+        "time": 1.7e9 + 0.25,
+        "first_slot": 0.25,
+        "slot_duration": 0.125,
+        "guard": 0.03125,
+        "slots": [150, 153],
+    }
+    decoded = Message.decode(BeaconMessage(content, 0).serialize())
+    assert isinstance(decoded, BeaconMessage)
+    assert decoded.content == content
+    assert decoded.frame_duration == 0.5
+
+
+def test_slots_do_not_overlap():
+    hat = Hat()
+    scheduler = TdmaScheduler(hat, nodes=[150, 151, 153], clock_error=0.01)
+    assert scheduler.poll(hat, now=1000.0) == pytest.approx(0.225 + 3 * 0.125)
+    ((beacon_bytes, target_address),) = hat.sent
+    assert target_address == 0xFFFF
+    assert scheduler.in_downlink(now=1000.05)
+    assert not scheduler.in_downlink(now=1000.2)
+    # not due yet
+    scheduler.poll(hat, now=1000.1)
+    assert len(hat.sent) == 1
+
+    # received 0.105 s after the start of the frame by a node whose clock is 2 s behind
+    packet = Packet(b"x" * 40, None, 998.105)
+    nodes = [TdmaNode(address) for address in (150, 151, 153)]
+    for node in nodes:
+        assert node.handle(beacon_bytes, packet, hat)
+        assert node.offset == pytest.approx(2.0)
+    assert not nodes[0].handle(TextMessage("data", 0, Topic.TEXT).serialize(), packet, hat)
+
+    guard = 0.1 * 0.1 + 0.005 + 0.01
+    starts = []
+    for node in nodes:
+        wait = node.delay(hat, 100, now=998.11)
+        starts.append(998.11 + wait)
+    # one slot after the downlink of two packets, each slot holds a packet and the guard time
+    assert starts == pytest.approx([998.0 + 0.2 + guard + i * (0.1 + guard) for i in range(3)])
+    for first, second in zip(starts, starts[1:]):
+        assert first + 0.1 + guard <= second + 1e-9
+
+    # too late for this frame's slot, waits for the next one
+    period = 0.2 + guard + 3 * (0.1 + guard)
+    assert nodes[0].delay(hat, 100, now=starts[0] + 0.02) == pytest.approx(period - 0.02)
+    # late by less than half the guard time
+    assert nodes[0].delay(hat, 100, now=starts[0] + 0.01) == 0.0
+
+
+def test_unassigned_and_unsynchronised_nodes_send_at_once():
+    hat = Hat()
+    scheduler = TdmaScheduler(hat, nodes=[150], max_nodes=2)
+    scheduler.poll(hat, now=1000.0)
+    ((beacon_bytes, _),) = hat.sent
+
+    node = TdmaNode(152, beacon_timeout=5.0)
+    assert node.delay(hat, 100, now=1000.0) == 0.0
+    node.handle(beacon_bytes, Packet(b"x" * 40, None, 1000.105), hat)
+    assert node.delay(hat, 100, now=1000.2) == 0.0
+
+    # heard by the basestation, gets a slot from the next frame on
+    scheduler.observe(TextMessage("data", 152, Topic.TEXT).serialize())
+    scheduler.observe(TextMessage("data", 153, Topic.TEXT).serialize())
+    assert scheduler.slots == [150, 152]
+    scheduler.poll(hat, now=1001.0)
+    node.handle(hat.sent[-1][0], Packet(b"x" * 40, None, 1001.105), hat)
+    assert node.delay(hat, 100, now=1001.11) > 0
+
+    # lost the beacon
+    assert node.delay(hat, 100, now=1001.105 + 5.0) == 0.0
+    assert not node.synchronised()
+
+
+def test_beacon_is_timed_from_arrival_when_read_late():
+    air = Air()
+    config = dict(lora_hat_config, enable_point_to_point_mode=False, air_speed=AirSpeed.AS_62_5K)
+    with LoRaHatEmulator(air) as base_emulator, LoRaHatEmulator(air) as node_emulator:
+        with LoRaHatDriver(config, base_emulator.port, base_emulator.gpio) as base, LoRaHatDriver(
+            dict(config, module_address=150), node_emulator.port, node_emulator.gpio
+        ) as node_hat:
+            scheduler = TdmaScheduler(base, nodes=[150])
+            node = TdmaNode(150)
+            scheduler.poll(base)
+            # the node is busy, e.g. waiting for its slot, while the beacon arrives
+            node_hat.listen(0.5)
+            read = time.time()
+            ((message, packet),) = node_hat.receive_messages(timeout=0, metadata=True)
+            assert node.handle(message, packet, node_hat)
+            assert read - packet.time > 0.3
+            # both clocks are the same, but the emulator does not take the time to transfer bytes over the UART
+            uart = 2 * len(packet.data) * node_hat.char_time()
+            assert node.offset == pytest.approx(uart, abs=0.03)